@@ -0,0 +1,71 @@
+"""
+認證相依函式 (get_current_user) 的每次請求成本：python-jose / PyJWT 解碼與 token 快取命中的比較，
+以及以 TestClient 對 /api/protected 的端對端比較 (快取關閉與開啟)。
+
+使用方式 (於專案根目錄)：
+    python benchmarks/bench_auth.py
+    python benchmarks/bench_auth.py --iterations 50000 --requests 2000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+SERVICE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "jlm_cloudrun_login")
+sys.path.insert(0, SERVICE_DIR)
+
+from jose import jwt  # noqa: E402
+
+from auth_cache import TokenCache, make_decoder  # noqa: E402
+
+SECRET_KEY = "benchmark-secret-key-with-at-least-32-bytes"
+ALGORITHM = "HS256"
+
+def make_token():
+    expire = datetime.utcnow() + timedelta(minutes=30)
+    return jwt.encode({"sub": "1", "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
+
+def per_call_us(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def bench_decoders(iterations):
+    token = make_token()
+    print(f"{'path':<28} {'us/call':>10}")
+    for backend in ("jose", "pyjwt"):
+        decode = make_decoder(backend, SECRET_KEY, ALGORITHM)
+        print(f"{'decode (' + backend + ')':<28} {per_call_us(lambda: decode(token), iterations):>10.1f}")
+    cache = TokenCache()
+    cache.put(token, make_decoder("jose", SECRET_KEY, ALGORITHM)(token))
+    print(f"{'token cache hit':<28} {per_call_us(lambda: cache.get(token), iterations):>10.1f}")
+
+def bench_endpoint(requests):
+    """需要 fastapi 與 httpx；不連線資料庫 (/api/protected 不查詢資料庫)。"""
+    os.environ.setdefault("JWT_SECRET_KEY", SECRET_KEY)
+    os.chdir(SERVICE_DIR)
+    import main
+    from fastapi.testclient import TestClient
+
+    token = jwt.encode({"sub": "1", "exp": datetime.utcnow() + timedelta(minutes=30)}, main.SECRET_KEY, algorithm=ALGORITHM)
+    headers = {"Authorization": f"Bearer {token}"}
+    client = TestClient(main.app)
+    print(f"\n{'/api/protected':<28} {'us/request':>10}")
+    for label, ttl in (("token cache off", 0), ("token cache on", 300)):
+        main.token_cache.max_ttl_seconds = ttl
+        client.get("/api/protected", headers=headers)
+        print(f"{label:<28} {per_call_us(lambda: client.get('/api/protected', headers=headers), requests):>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="比較 JWT 驗證與 token 快取的成本")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=1000, help="端對端測試的請求數，0 表示略過")
+    args = parser.parse_args()
+    bench_decoders(args.iterations)
+    if args.requests:
+        bench_endpoint(args.requests)
+
+if __name__ == "__main__":
+    main()
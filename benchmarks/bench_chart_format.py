@@ -0,0 +1,64 @@
+"""
+圖表資料格式化的效能比較：逐列 dict (format_rows) 與 NumPy 欄式 (format_columns)。
+
+使用方式 (於專案根目錄)：
+    python benchmarks/bench_chart_format.py
+    python benchmarks/bench_chart_format.py --sizes 10000 100000 --max-points 1000
+
+資料為隨機產生，不需連線資料庫；dict 資料模擬 DictCursor 的輸出，tuple 資料模擬 fetch_chart_columns 的輸出。
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "jlm_cloudrun_login"))
+
+import chart_format  # noqa: E402
+
+EPOCH = datetime(1970, 1, 1)
+
+def generate_rows(count, interval_seconds=5):
+    """產生 count 筆依時間排序的 dict 資料與對應的 tuple 資料。"""
+    start = datetime(2024, 1, 1)
+    total_watt_hours = 1000.0
+    dict_rows = []
+    tuple_rows = []
+    for i in range(count):
+        timestamp = start + timedelta(seconds=i * interval_seconds)
+        watt = random.uniform(50.0, 2000.0)
+        pf = random.uniform(0.8, 1.0)
+        total_watt_hours += watt * interval_seconds / 3600
+        dict_rows.append({'timestamp': timestamp, 'watt': watt, 'total_watt_hours': total_watt_hours, 'pf': pf})
+        tuple_rows.append((int((timestamp - EPOCH).total_seconds()), watt, total_watt_hours, pf))
+    return dict_rows, tuple_rows
+
+def best_of(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="比較 format_rows 與 format_columns 的耗時")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--max-points", type=int, default=None, help="同時測試降採樣 (預設不降採樣)")
+    parser.add_argument("--bucket", default="lttb")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'format_rows (ms)':>18} {'format_columns (ms)':>20} {'speedup':>8}")
+    for size in args.sizes:
+        dict_rows, tuple_rows = generate_rows(size)
+        rows_ms = best_of(lambda: chart_format.format_rows(dict_rows, args.max_points, args.bucket), args.repeat)
+        columns_ms = best_of(
+            lambda: chart_format.format_columns(tuple_rows, None, args.max_points, args.bucket), args.repeat
+        )
+        print(f"{size:>10} {rows_ms:>18.1f} {columns_ms:>20.1f} {rows_ms / columns_ms:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
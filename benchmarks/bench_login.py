@@ -0,0 +1,87 @@
+"""
+登入負載測試：模擬交班時大量同時登入，量測登入的吞吐量與 p50/p99 延遲，
+並同時以固定頻率請求一個不需要 bcrypt 的路由 (GET /)，觀察登入尖峰對其他請求的影響。
+
+需要一個已啟動的服務與有效的測試帳號，以及 httpx (pip install httpx)：
+    python benchmarks/bench_login.py --url http://localhost:8080 --account tester --password secret
+    python benchmarks/bench_login.py --url ... --concurrency 100 --requests 1000
+
+可分別以不同的 PASSWORD_HASH_WORKERS / PASSWORD_HASH_MAX_PENDING 設定啟動服務後比較結果；
+超過等待上限的登入會得到 503，會分開計數。
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def report(label, latencies_ms, elapsed_s=None):
+    line = f"{label:<10} n={len(latencies_ms):<6}"
+    if latencies_ms:
+        line += (f" p50={percentile(latencies_ms, 50):8.1f}ms p99={percentile(latencies_ms, 99):8.1f}ms"
+                 f" max={max(latencies_ms):8.1f}ms mean={statistics.mean(latencies_ms):8.1f}ms")
+    if elapsed_s:
+        line += f" throughput={len(latencies_ms) / elapsed_s:7.1f}/s"
+    print(line)
+
+async def run(args):
+    login_ms, probe_ms = [], []
+    status_counts = {}
+    remaining = iter(range(args.requests))
+    done = asyncio.Event()
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        async def login_worker():
+            for _ in remaining:
+                start = time.perf_counter()
+                try:
+                    response = await client.post("/api/login", json={"account": args.account, "password": args.password})
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = "error"
+                elapsed = (time.perf_counter() - start) * 1000
+                status_counts[status] = status_counts.get(status, 0) + 1
+                if status == 200:
+                    login_ms.append(elapsed)
+
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                try:
+                    await client.get("/", follow_redirects=False)
+                    probe_ms.append((time.perf_counter() - start) * 1000)
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(args.probe_interval)
+
+        probe_task = asyncio.create_task(probe())
+        start = time.perf_counter()
+        await asyncio.gather(*(login_worker() for _ in range(args.concurrency)))
+        elapsed_s = time.perf_counter() - start
+        done.set()
+        await probe_task
+
+    print(f"{args.requests} 次登入，同時 {args.concurrency} 個連線，耗時 {elapsed_s:.2f}s，狀態碼: {status_counts}")
+    report("login", login_ms, elapsed_s)
+    report("probe GET /", probe_ms)
+
+def main():
+    parser = argparse.ArgumentParser(description="登入負載測試")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--account", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--probe-interval", type=float, default=0.05, help="探測請求的間隔秒數")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+服務啟動時間：反覆以 --cmd 啟動服務，量測由啟動到第一個請求成功回應的時間 (time to first request)，
+並取得 GET /api/startup 的各階段秒數 (imports、ready、pool_ready，為回應該請求的 worker 所記錄)。模擬 Cloud Run 由零個執行個體擴展時的冷啟動。
+
+使用方式 (需要 httpx；於專案根目錄，連線設定與服務相同，可搭配本機 MySQL 的 DB_HOST)：
+    python benchmarks/bench_startup.py --output after.json
+    python benchmarks/bench_startup.py --env STARTUP_WARM_UP=blocking --env GUNICORN_PRELOAD=false --output before.json
+    python benchmarks/report.py compare before.json after.json
+    python benchmarks/bench_startup.py --service esp32 --runs 5
+--cmd 預設與 start.sh 相同 (不含 Cloud SQL Proxy)；--path 可改為需要資料庫的路由 (搭配 --token)，量到的即包含建立連線池的時間。
+"""
+import argparse
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+
+import report
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 與 start.sh (查詢服務) 及 Dockerfile (ESP32 服務) 相同的啟動方式
+COMMANDS = {
+    "login": (
+        "jlm_cloudrun_login",
+        "gunicorn -w {workers} -k uvicorn.workers.UvicornWorker -b 127.0.0.1:{port} {preload} main:app",
+    ),
+    "esp32": ("jlm_cloudrun_esp32", "uvicorn main:app --host 127.0.0.1 --port {port}"),
+}
+
+def wait_first_response(url, headers, timeout):
+    """每 10ms 送出一次請求，回傳第一個非 5xx 回應的 (經過秒數, 狀態碼)，逾時回傳 (None, None)。"""
+    started = time.perf_counter()
+    with httpx.Client(timeout=1.0) as client:
+        while time.perf_counter() - started < timeout:
+            try:
+                response = client.get(url, headers=headers)
+            except httpx.HTTPError:
+                time.sleep(0.01)
+                continue
+            if response.status_code < 500:
+                return time.perf_counter() - started, response.status_code
+            time.sleep(0.01)
+    return None, None
+
+def run_once(args, env):
+    service_dir, template = COMMANDS[args.service]
+    preload = "" if env.get("GUNICORN_PRELOAD", "true") == "false" else "--preload"
+    cmd = args.cmd or template.format(workers=args.workers, port=args.port, preload=preload)
+    env = dict(env, STARTUP_BEGIN=f"{time.time():.6f}")
+    process = subprocess.Popen(
+        shlex.split(cmd), cwd=os.path.join(ROOT, service_dir), env=env,
+        stdout=subprocess.DEVNULL if not args.verbose else None, stderr=subprocess.DEVNULL if not args.verbose else None,
+        start_new_session=True,
+    )
+    base = f"http://127.0.0.1:{args.port}"
+    try:
+        headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+        elapsed_s, status = wait_first_response(base + args.path, headers, args.timeout)
+        phases = {}
+        if elapsed_s is not None:
+            # 各階段在背景完成，稍等後再取得
+            time.sleep(args.settle)
+            try:
+                phases = httpx.get(base + "/api/startup", timeout=5).json().get("phases_s", {})
+            except (httpx.HTTPError, ValueError):
+                pass
+        return elapsed_s, status, phases
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="服務啟動時間 (time to first request)")
+    parser.add_argument("--service", choices=sorted(COMMANDS), default="login")
+    parser.add_argument("--cmd", default=None, help="自訂啟動指令 (於服務目錄中執行，須監聽 --port)")
+    parser.add_argument("--env", action="append", default=[], help="額外的環境變數 KEY=VALUE，可重複指定")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--path", default="/api/startup", help="判斷服務已可回應的路由")
+    parser.add_argument("--token", default=None)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--settle", type=float, default=1.0, help="第一個回應後等待背景工作的秒數")
+    parser.add_argument("--verbose", action="store_true", help="顯示服務的輸出")
+    parser.add_argument("--output", default=None, help="結果存成 JSON，供 report.py compare 比較")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("JWT_SECRET_KEY", "benchmark-secret-key-with-at-least-32-bytes")
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    recorder = report.Recorder()
+    for run in range(1, args.runs + 1):
+        elapsed_s, status, phases = run_once(args, env)
+        if elapsed_s is None:
+            recorder.add("time_to_first_response", "timeout", args.timeout * 1000)
+            print(f"#{run} {args.timeout}s 內沒有回應")
+            continue
+        recorder.add("time_to_first_response", 200, elapsed_s * 1000)
+        # 各階段為回應 /api/startup 的 worker 所記錄 (first_request 可能就是這個請求，不列入)
+        for phase in ("proxy_ready", "imports", "ready", "pool_ready"):
+            if phase in phases:
+                recorder.add(phase, 200, phases[phase] * 1000)
+        print(f"#{run} 第一個回應 {elapsed_s * 1000:.0f}ms (HTTP {status})，各階段 {phases}")
+    params = {key: value for key, value in vars(args).items() if key not in ("output", "token", "verbose")}
+    report.finish("startup", params, recorder.summaries(), args.output)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+"""
+產生測試用的電表資料：為每台機器寫入數個月、符合實際用電型態的讀數，供負載測試與查詢效能比較。
+
+- 讀數間隔預設 300 秒 (GCP_db3 韌體深度睡眠 5 分鐘)，可用 --interval 調密
+- 機器各有額定功率；平日早班 (08:00-17:00) 高負載、部分機器有晚班，其餘時間與週末為待機
+- 'total_watt_hours' 依功率累計，可模擬離線 (缺資料) 與電表歸零 (--reset-rate)
+- --layout 與 STORAGE_LAYOUT 相同：per_table 寫入各機器的資料表 (不存在時建立)，
+  unified 寫入 readings (需先以 jlm_cloudrun_login 的 migrations.py apply / storage.py create-schema 建立)，dual 兩者都寫
+
+連線到本機 MySQL (例如 docker run -e MYSQL_ROOT_PASSWORD=secret -e MYSQL_DATABASE=jlm -p 3306:3306 mysql:8)：
+    python benchmarks/generate_data.py --days 90
+    python benchmarks/generate_data.py --days 30 --interval 5 --tables 冰水機 空壓機
+連線設定與服務相同 (DB_HOST、DB_PORT、DB_USER、DB_PASSWORD、DB_NAME)，需要 mysql-connector-python。
+以 --output data.sql 輸出 SQL 檔而不連線，之後以 mysql < data.sql 匯入。
+
+產生資料後，若服務啟用了 rollup、energy_segments 或 counter_offsets，須在 jlm_cloudrun_login 執行對應的 backfill。
+"""
+import argparse
+import math
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "jlm_cloudrun_esp32"))
+
+from devices import DEFAULT_DEVICES  # noqa: E402
+
+# 各機器資料表的結構 (正式環境的資料表由 Cloud SQL 手動建立，此處依服務使用的欄位重建)
+CREATE_MACHINE_TABLE = """
+    CREATE TABLE IF NOT EXISTS `{table_name}` (
+        id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        voltage DOUBLE,
+        current DOUBLE,
+        frequency DOUBLE,
+        pf DOUBLE,
+        watt DOUBLE,
+        total_watt_hours DOUBLE,
+        timestamp DATETIME NOT NULL,
+        INDEX idx_timestamp_total_watt_hours (timestamp, total_watt_hours)
+    )
+"""
+
+MACHINE_COLUMNS = "(voltage, current, frequency, pf, watt, total_watt_hours, timestamp)"
+READINGS_COLUMNS = "(device_id, ts, voltage, current, frequency, pf, watt, total_watt_hours)"
+
+class Machine:
+    """一台機器的用電型態：額定功率、是否有晚班、待機比例與目前的電表讀數。"""
+
+    def __init__(self, name, rng):
+        self.name = name
+        self.rng = rng
+        self.rated_watt = rng.uniform(2_000, 30_000)
+        self.night_shift = rng.random() < 0.4
+        self.standby = rng.uniform(0.02, 0.08)
+        self.three_phase = self.rated_watt > 5_000
+        self.total_watt_hours = rng.uniform(0, 5_000_000)
+        self.offline_until = None
+
+    def load(self, ts):
+        """ts 時的負載比例 (0~1)。"""
+        weekday = ts.weekday() < 5
+        hour = ts.hour + ts.minute / 60
+        if weekday and 8 <= hour < 17 and not 12 <= hour < 13:
+            base = 0.75
+        elif weekday and self.night_shift and (hour >= 20 or hour < 5):
+            base = 0.55
+        else:
+            return self.standby * self.rng.uniform(0.5, 1.5)
+        # 生產中的負載隨工件起伏
+        return min(1.0, max(self.standby, base + 0.15 * math.sin(hour * 3) + self.rng.gauss(0, 0.08)))
+
+    def reading(self, ts, interval_seconds, reset_rate, offline_rate):
+        """回傳 ts 的讀數 (voltage, current, frequency, pf, watt, total_watt_hours)，離線中回傳 None。"""
+        if self.offline_until is not None and ts < self.offline_until:
+            return None
+        if self.rng.random() < offline_rate:
+            # 斷電或網路中斷數分鐘至數小時
+            self.offline_until = ts + timedelta(minutes=self.rng.uniform(10, 240))
+            return None
+        load = self.load(ts)
+        watt = self.rated_watt * load
+        pf = min(0.99, 0.6 + 0.38 * load + self.rng.gauss(0, 0.01))
+        voltage = (380.0 if self.three_phase else 220.0) * self.rng.uniform(0.98, 1.02)
+        phases = math.sqrt(3) if self.three_phase else 1.0
+        current = watt / (phases * voltage * pf)
+        frequency = 60.0 + self.rng.gauss(0, 0.02)
+        if self.rng.random() < reset_rate:
+            # 電表歸零 (更換電表或網頁的 /reset)
+            self.total_watt_hours = 0.0
+        self.total_watt_hours += watt * interval_seconds / 3600
+        return (
+            round(voltage, 2), round(current, 3), round(frequency, 2), round(pf, 3),
+            round(watt, 1), round(self.total_watt_hours, 3),
+        )
+
+def generate(names, start, end, interval_seconds, reset_rate, offline_rate, seed):
+    """依時間順序逐批產生 {機器名稱: [(voltage, current, frequency, pf, watt, total_watt_hours, timestamp)]}，每批一天。"""
+    rng = random.Random(seed)
+    machines = [Machine(name, random.Random(rng.random())) for name in names]
+    step = timedelta(seconds=interval_seconds)
+    day_start = start
+    while day_start < end:
+        day_end = min(day_start + timedelta(days=1), end)
+        batch = {machine.name: [] for machine in machines}
+        for machine in machines:
+            # 每台機器的上傳時間各自錯開
+            ts = day_start + timedelta(seconds=rng.uniform(0, interval_seconds))
+            while ts < day_end:
+                values = machine.reading(ts, interval_seconds, reset_rate, offline_rate)
+                if values is not None:
+                    batch[machine.name].append(values + (ts.replace(microsecond=0),))
+                ts += step
+        yield day_start, batch
+        day_start = day_end
+
+class SQLVariable(str):
+    """SQL 檔中的使用者變數 (例如 @device_1)，直接輸出、不加引號。"""
+
+def sql_literal(value):
+    if isinstance(value, SQLVariable):
+        return str(value)
+    if isinstance(value, datetime):
+        return f"'{value:%Y-%m-%d %H:%M:%S}'"
+    return repr(value)
+
+def layout_targets(layout):
+    return {
+        "per_table": (True, False),
+        "dual": (True, True),
+        "unified": (False, True),
+    }[layout]
+
+class MySQLWriter:
+    def __init__(self, args):
+        import mysql.connector
+
+        self.conn = mysql.connector.connect(
+            host=args.host, port=args.port, user=args.user, password=args.password, database=args.database
+        )
+        self.cursor = self.conn.cursor()
+
+    def create_machine_table(self, table_name):
+        self.cursor.execute(CREATE_MACHINE_TABLE.format(table_name=table_name))
+
+    def device_ids(self, names):
+        try:
+            self.cursor.execute("SELECT name, device_id FROM devices")
+        except Exception:
+            return {}
+        return dict(self.cursor.fetchall())
+
+    def insert(self, table, columns, rows, batch_size):
+        query = f"INSERT INTO {table} {columns} VALUES ({', '.join(['%s'] * len(rows[0]))})"
+        for i in range(0, len(rows), batch_size):
+            # mysql-connector 將 executemany 改寫為一句多列 INSERT
+            self.cursor.executemany(query, rows[i:i + batch_size])
+        self.conn.commit()
+
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
+class SQLFileWriter:
+    def __init__(self, args):
+        self.file = open(args.output, "w", encoding="utf-8")
+        self.file.write("SET NAMES utf8mb4;\n")
+
+    def create_machine_table(self, table_name):
+        self.file.write(" ".join(CREATE_MACHINE_TABLE.format(table_name=table_name).split()) + ";\n")
+
+    def device_ids(self, names):
+        """匯入時才由 devices 資料表查出 device_id，存在使用者變數中。"""
+        variables = {}
+        for index, name in enumerate(names, start=1):
+            escaped = name.replace("'", "''")
+            self.file.write(f"SET @device_{index} = (SELECT device_id FROM devices WHERE name = '{escaped}');\n")
+            variables[name] = SQLVariable(f"@device_{index}")
+        return variables
+
+    def insert(self, table, columns, rows, batch_size):
+        for i in range(0, len(rows), batch_size):
+            values = ",".join("(" + ",".join(sql_literal(value) for value in row) + ")" for row in rows[i:i + batch_size])
+            self.file.write(f"INSERT INTO {table} {columns} VALUES {values};\n")
+
+    def close(self):
+        self.file.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="產生測試用的電表資料")
+    parser.add_argument("--tables", nargs="*", default=DEFAULT_DEVICES, help="機器名稱 (預設為原本的機器列表)")
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--end", default=None, help="最後一筆的時間 (台灣時間，YYYY-MM-DD HH:MM:SS，預設為現在)")
+    parser.add_argument("--interval", type=int, default=300, help="每台機器的讀數間隔秒數")
+    parser.add_argument("--layout", choices=["per_table", "dual", "unified"], default=os.environ.get("STORAGE_LAYOUT", "per_table"))
+    parser.add_argument("--reset-rate", type=float, default=0.00002, help="每筆讀數發生電表歸零的機率")
+    parser.add_argument("--offline-rate", type=float, default=0.0005, help="每筆讀數開始離線的機率")
+    parser.add_argument("--seed", type=int, default=1, help="相同的 seed 產生相同的資料")
+    parser.add_argument("--batch-size", type=int, default=2000, help="每句 INSERT 的筆數")
+    parser.add_argument("--output", default=None, help="輸出 SQL 檔而不連線資料庫")
+    parser.add_argument("--host", default=os.environ.get("DB_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("DB_PORT", "3306")))
+    parser.add_argument("--user", default=os.environ.get("DB_USER", "root"))
+    parser.add_argument("--password", default=os.environ.get("DB_PASSWORD", ""))
+    parser.add_argument("--database", default=os.environ.get("DB_NAME", "jlm"))
+    args = parser.parse_args()
+
+    end = datetime.strptime(args.end, "%Y-%m-%d %H:%M:%S") if args.end else datetime.now().replace(microsecond=0)
+    start = end - timedelta(days=args.days)
+    per_table, unified = layout_targets(args.layout)
+
+    writer = SQLFileWriter(args) if args.output else MySQLWriter(args)
+    try:
+        device_ids = {}
+        if unified:
+            device_ids = writer.device_ids(args.tables)
+            missing = [name for name in args.tables if name not in device_ids]
+            if missing:
+                parser.error(f"devices 資料表沒有這些機器: {missing} (請先執行 migrations.py apply 或 POST /api/devices)")
+        if per_table:
+            for table_name in args.tables:
+                writer.create_machine_table(table_name)
+
+        total = 0
+        for day_start, batch in generate(
+            args.tables, start, end, args.interval, args.reset_rate, args.offline_rate, args.seed
+        ):
+            for table_name, rows in batch.items():
+                if not rows:
+                    continue
+                if per_table:
+                    writer.insert(f"`{table_name}`", MACHINE_COLUMNS, rows, args.batch_size)
+                if unified:
+                    device_id = device_ids[table_name]
+                    readings = [(device_id, row[6]) + row[:6] for row in rows]
+                    writer.insert("readings", READINGS_COLUMNS, readings, args.batch_size)
+                total += len(rows)
+            print(f"{day_start:%Y-%m-%d} 累計 {total} 筆")
+    finally:
+        writer.close()
+    print(f"完成：{len(args.tables)} 台機器，{start} 至 {end}，共 {total} 筆 ({args.layout})")
+
+if __name__ == "__main__":
+    main()
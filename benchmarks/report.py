@@ -0,0 +1,130 @@
+"""
+負載測試結果的統計與比較，供 simulate_fleet.py 與 scenarios.py 共用。
+
+每個測試印出相同格式的 p50/p99 表格，並可以 --output 存成 JSON；
+修改前後各跑一次後以 compare 比較兩份結果：
+    python benchmarks/report.py compare before.json after.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def summarize(label, latencies_ms, elapsed_s=None, statuses=None):
+    """latencies_ms 為成功請求的延遲 (毫秒)，statuses 為 {狀態碼: 次數} (含失敗的請求)。"""
+    summary = {"label": label, "n": len(latencies_ms)}
+    if latencies_ms:
+        summary.update({
+            "p50_ms": round(percentile(latencies_ms, 50), 2),
+            "p99_ms": round(percentile(latencies_ms, 99), 2),
+            "max_ms": round(max(latencies_ms), 2),
+            "mean_ms": round(statistics.mean(latencies_ms), 2),
+        })
+    if elapsed_s:
+        summary["throughput"] = round(len(latencies_ms) / elapsed_s, 1)
+    if statuses is not None:
+        summary["statuses"] = {str(status): count for status, count in sorted(statuses.items(), key=str)}
+    return summary
+
+def print_summary(summary):
+    line = f"{summary['label']:<24} n={summary['n']:<7}"
+    if summary["n"]:
+        line += (f" p50={summary['p50_ms']:8.1f}ms p99={summary['p99_ms']:8.1f}ms"
+                 f" max={summary['max_ms']:8.1f}ms mean={summary['mean_ms']:8.1f}ms")
+    if "throughput" in summary:
+        line += f" throughput={summary['throughput']:7.1f}/s"
+    if summary.get("statuses"):
+        line += f" statuses={summary['statuses']}"
+    print(line)
+
+class Recorder:
+    """依標籤累計每個請求的延遲與狀態碼。"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+
+    def add(self, label, status, elapsed_ms):
+        statuses = self.statuses.setdefault(label, {})
+        statuses[status] = statuses.get(status, 0) + 1
+        self.latencies.setdefault(label, [])
+        if status == 200:
+            self.latencies[label].append(elapsed_ms)
+
+    def summaries(self, elapsed_s=None):
+        return [
+            summarize(label, self.latencies[label], elapsed_s, self.statuses[label])
+            for label in self.latencies
+        ]
+
+async def timed_request(recorder, client, label, method, url, **kwargs):
+    """以 httpx.AsyncClient 送出請求並記錄延遲與狀態碼，連線錯誤記為 error；回傳 response (錯誤時為 None)。"""
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except Exception:
+        recorder.add(label, "error", (time.perf_counter() - start) * 1000)
+        return None
+    recorder.add(label, response.status_code, (time.perf_counter() - start) * 1000)
+    return response
+
+def finish(scenario, params, summaries, output=None):
+    """印出結果，指定 output 時連同測試參數存成 JSON。"""
+    for summary in summaries:
+        print_summary(summary)
+    if output:
+        result = {
+            "scenario": scenario,
+            "params": params,
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "results": summaries,
+        }
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"結果已存至 {output}")
+
+def compare(before_path, after_path):
+    """以標籤對照兩份結果，列出 p50/p99 與吞吐量的變化。"""
+    with open(before_path, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(after_path, encoding="utf-8") as f:
+        after = json.load(f)
+    if before["scenario"] != after["scenario"]:
+        print(f"注意：兩份結果的測試不同 ({before['scenario']} / {after['scenario']})")
+    if before["params"] != after["params"]:
+        print(f"注意：兩份結果的參數不同\n  before: {before['params']}\n  after:  {after['params']}")
+
+    previous = {summary["label"]: summary for summary in before["results"]}
+    print(f"{'label':<24} {'p50 before':>11} {'after':>9} {'p99 before':>11} {'after':>9} {'throughput':>11} {'after':>9}")
+    for summary in after["results"]:
+        old = previous.get(summary["label"])
+        if old is None or not old["n"] or not summary["n"]:
+            print(f"{summary['label']:<24} (無可比較的資料)")
+            continue
+        print(
+            f"{summary['label']:<24} {old['p50_ms']:9.1f}ms {summary['p50_ms']:7.1f}ms"
+            f" {old['p99_ms']:9.1f}ms {summary['p99_ms']:7.1f}ms"
+            f" {old.get('throughput', 0):9.1f}/s {summary.get('throughput', 0):7.1f}/s"
+        )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="比較兩份負載測試結果")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    args = parser.parse_args(argv)
+    compare(args.before, args.after)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,233 @@
+"""
+查詢服務與 ESP32 服務的負載情境，輸出格式與 simulate_fleet.py 相同的 p50/p99 報表。
+
+情境：
+- ingest     以固定速率 (--rps) 送出上傳請求，不受回應速度影響 (open loop)，觀察寫入吞吐量的上限
+- dashboard  模擬使用者開啟儀表板：驗證 token、取得使用者資訊，再同時取得所有機器的最新與今日用電量
+- live       --users 個使用者同時連線 /api/stream/live，記錄收到 snapshot 的時間與各類事件數
+             (同時執行 ingest 或 simulate_fleet.py 即可觀察推送；資料庫負載可由 /metrics 的 db_query_duration_seconds 比較)
+- shift      查詢各機器前日早班、前日晚班與今日早班至今的用電量
+- chart      依時間範圍 (例如 1d 7d 30d 90d) 取得圖表資料 (與儀表板相同，max_points=1000)
+
+使用方式 (需要 httpx；dashboard、shift、chart 需要測試帳號或 token)：
+    python benchmarks/scenarios.py ingest --url http://localhost:8081 --rps 200 --duration 30
+    python benchmarks/scenarios.py dashboard --url http://localhost:8080 --account tester --password secret --users 20
+    python benchmarks/scenarios.py live --url ... --token ... --users 200 --duration 60
+    python benchmarks/scenarios.py shift --url ... --token ... --users 10
+    python benchmarks/scenarios.py chart --url ... --token ... --ranges 1d 30d 90d --layout columns
+    python benchmarks/scenarios.py chart ... --output after.json && python benchmarks/report.py compare before.json after.json
+
+查詢服務有回應快取：chart 預設讓每次請求的結束時間略有不同 (--vary-seconds)，量到的是資料庫與格式化的成本，
+設為 0 則量測快取命中的情況；shift 的前日早班、晚班為已結束的區間，第一次之後多由快取回應。
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+import report
+from generate_data import DEFAULT_DEVICES, Machine
+
+TAIPEI_TZ = timezone(timedelta(hours=8))
+SHIFT_TYPES = ["day_shift", "night_shift", "since_morning"]
+RANGE_UNITS = {"h": timedelta(hours=1), "d": timedelta(days=1)}
+
+def parse_range(value):
+    """'7d'、'12h' → timedelta。"""
+    return int(value[:-1]) * RANGE_UNITS[value[-1]]
+
+async def access_token(client, args):
+    if args.token:
+        return args.token
+    if not (args.account and args.password):
+        raise SystemExit("此情境需要 --token 或 --account / --password")
+    response = await client.post("/api/login", json={"account": args.account, "password": args.password})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+async def run_users(users, duration, user_loop):
+    """users 個使用者同時執行 user_loop(user_index, deadline)，回傳實際耗時。"""
+    start = time.monotonic()
+    deadline = start + duration
+    await asyncio.gather(*(user_loop(index, deadline) for index in range(users)))
+    return time.monotonic() - start
+
+# --- ingest ---
+async def ingest(args, client, recorder):
+    rng = random.Random(args.seed)
+    machines = [Machine(name, random.Random(rng.random())) for name in args.tables]
+    inflight = asyncio.Semaphore(args.max_inflight)
+    dropped = 0
+    seq = 0
+
+    async def send(payload, path):
+        async with inflight:
+            await report.timed_request(recorder, client, path.rsplit("/", 1)[-1], "POST", path, json=payload)
+
+    def reading():
+        nonlocal seq
+        machine = rng.choice(machines)
+        voltage, current, frequency, pf, watt, total_watt_hours = machine.reading(datetime.now(), 5, 0.0, 0.0)
+        seq += 1
+        return {
+            "table_name": machine.name, "voltage": voltage, "current": current, "frequency": frequency,
+            "pf": pf, "watt": watt, "total_watt_hours": total_watt_hours,
+            "device_id": "bench", "seq": seq,
+        }
+
+    tasks = []
+    start = time.monotonic()
+    interval = 1.0 / args.rps
+    for i in range(int(args.rps * args.duration)):
+        # 依排定的時間送出，不等前一個請求完成
+        delay = start + i * interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if inflight.locked():
+            # 未完成的請求已達上限，表示服務跟不上此速率
+            dropped += 1
+            continue
+        if args.batch_size > 1:
+            payload, path = {"readings": [reading() for _ in range(args.batch_size)]}, "/api/upload_batch"
+        else:
+            payload, path = reading(), "/api/upload_data"
+        tasks.append(asyncio.create_task(send(payload, path)))
+    await asyncio.gather(*tasks)
+    elapsed_s = time.monotonic() - start
+    print(f"目標 {args.rps}/s × {args.duration}s，實際送出 {len(tasks)} 個請求，"
+          f"因未完成的請求達 {args.max_inflight} 個而略過 {dropped} 個")
+    return elapsed_s
+
+# --- dashboard ---
+async def dashboard(args, client, recorder):
+    headers = {"Authorization": f"Bearer {await access_token(client, args)}"}
+    rng = random.Random(args.seed)
+
+    async def user_loop(index, deadline):
+        await asyncio.sleep(rng.uniform(0, args.think_time))
+        while time.monotonic() < deadline:
+            # 與 jlm_en_query.html 載入時的順序相同
+            await report.timed_request(recorder, client, "protected", "GET", "/api/protected", headers=headers)
+            await report.timed_request(recorder, client, "users/me", "GET", "/api/users/me", headers=headers)
+            await asyncio.gather(
+                report.timed_request(recorder, client, "get_total_latest_kwh", "GET", "/api/get_total_latest_kwh", headers=headers),
+                report.timed_request(recorder, client, "get_total_daily_kwh", "GET", "/api/get_total_daily_kwh", headers=headers),
+            )
+            await asyncio.sleep(args.think_time)
+
+    return await run_users(args.users, args.duration, user_loop)
+
+# --- live ---
+async def live(args, client, recorder):
+    token = await access_token(client, args)
+    events = {}
+
+    async def user_loop(index, deadline):
+        start = time.perf_counter()
+        try:
+            async with client.stream(
+                "GET", "/api/stream/live", params={"token": token}, timeout=httpx.Timeout(args.timeout, read=None)
+            ) as response:
+                if response.status_code != 200:
+                    recorder.add("snapshot", response.status_code, (time.perf_counter() - start) * 1000)
+                    return
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                        if event == "snapshot":
+                            recorder.add("snapshot", 200, (time.perf_counter() - start) * 1000)
+                        events[event] = events.get(event, 0) + 1
+                    if time.monotonic() >= deadline:
+                        return
+        except httpx.HTTPError:
+            recorder.add("snapshot", "error", (time.perf_counter() - start) * 1000)
+
+    async def bounded(index, deadline):
+        # 沒有新數據時伺服器每 15 秒才送出 keepalive，到時間即中斷連線
+        try:
+            await asyncio.wait_for(user_loop(index, deadline), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+
+    elapsed_s = await run_users(args.users, args.duration, bounded)
+    print(f"{args.users} 個連線共收到事件 {events}")
+    return elapsed_s
+
+# --- shift ---
+async def shift(args, client, recorder):
+    headers = {"Authorization": f"Bearer {await access_token(client, args)}"}
+    rng = random.Random(args.seed)
+
+    async def user_loop(index, deadline):
+        while time.monotonic() < deadline:
+            shift_type = rng.choice(SHIFT_TYPES)
+            table_name = rng.choice(args.tables)
+            await report.timed_request(
+                recorder, client, shift_type, "GET", f"/api/get_watt_hours/{shift_type}/{table_name}", headers=headers
+            )
+            await asyncio.sleep(args.think_time)
+
+    return await run_users(args.users, args.duration, user_loop)
+
+# --- chart ---
+async def chart(args, client, recorder):
+    headers = {"Authorization": f"Bearer {await access_token(client, args)}"}
+    rng = random.Random(args.seed)
+    start = time.monotonic()
+    for range_name in args.ranges:
+        span = parse_range(range_name)
+        for _ in range(args.repeat):
+            end = datetime.now(TAIPEI_TZ) - timedelta(seconds=rng.uniform(0, args.vary_seconds))
+            params = {
+                "table_name": rng.choice(args.tables),
+                "start_iso": (end - span).isoformat(timespec="seconds"),
+                "end_iso": end.isoformat(timespec="seconds"),
+                "max_points": args.max_points,
+                "layout": args.layout,
+                "resolution": args.resolution,
+            }
+            await report.timed_request(
+                recorder, client, f"chart {range_name}", "GET", "/api/get_chart_data", params=params, headers=headers
+            )
+    return time.monotonic() - start
+
+SCENARIOS = {"ingest": ingest, "dashboard": dashboard, "live": live, "shift": shift, "chart": chart}
+
+async def main_async(args):
+    recorder = report.Recorder()
+    limits = httpx.Limits(max_connections=args.max_inflight)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        elapsed_s = await SCENARIOS[args.scenario](args, client, recorder)
+    params = {key: value for key, value in vars(args).items() if key not in ("output", "token", "password")}
+    report.finish(args.scenario, params, recorder.summaries(elapsed_s), args.output)
+
+def main():
+    parser = argparse.ArgumentParser(description="查詢服務與 ESP32 服務的負載情境")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--token", default=None)
+    parser.add_argument("--account", default=None)
+    parser.add_argument("--password", default=None)
+    parser.add_argument("--tables", nargs="*", default=DEFAULT_DEVICES)
+    parser.add_argument("--duration", type=float, default=30.0, help="測試秒數 (chart 以 --repeat 為準)")
+    parser.add_argument("--users", type=int, default=10, help="dashboard、live、shift 同時的使用者數")
+    parser.add_argument("--think-time", type=float, default=1.0, help="每位使用者兩次操作之間的秒數")
+    parser.add_argument("--rps", type=float, default=50.0, help="ingest 每秒送出的請求數")
+    parser.add_argument("--batch-size", type=int, default=1, help="ingest 大於 1 時改用 /api/upload_batch")
+    parser.add_argument("--max-inflight", type=int, default=200, help="同時未完成的請求上限")
+    parser.add_argument("--ranges", nargs="*", default=["1d", "7d", "30d", "90d"], help="chart 的時間範圍")
+    parser.add_argument("--repeat", type=int, default=20, help="chart 每個時間範圍的請求數")
+    parser.add_argument("--max-points", type=int, default=1000)
+    parser.add_argument("--layout", choices=["rows", "columns"], default="rows")
+    parser.add_argument("--resolution", default="raw")
+    parser.add_argument("--vary-seconds", type=float, default=3600.0, help="時間範圍隨機提早的秒數上限 (避開回應快取)")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="結果存成 JSON，供 report.py compare 比較")
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
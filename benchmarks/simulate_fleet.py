@@ -0,0 +1,182 @@
+"""
+模擬 ESP32 電表裝置群：依 GCP_db3 韌體的上傳方式對 ESP32 專用服務 (或查詢服務) 送出資料。
+
+韌體的行為：
+- 每片 ESP32 經 RS485 輪流讀取 4 台機器的電表，醒來時依序各送一次 POST /api/upload_data (每次新建 HTTPS 連線)
+- 等待 OTA 5 分鐘後再送一輪，接著深度睡眠 5 分鐘，週期約 10 分鐘
+- 每筆資料帶 device_id (MAC) 與遞增的 seq；連線失敗、5xx 或 429 時以相同的 seq 重送，最多 3 次、
+  間隔 2 秒 (有 Retry-After 時依其等待，最多 30 秒)
+本程式以 --boards 片 ESP32 各自錯開啟動時間重現此模式，--speedup 將所有等待時間等比例縮短以模擬更大的裝置數。
+例如 200 片、speedup 10 約等於 2000 片 ESP32 的上傳頻率。
+
+使用方式 (需要 httpx)：
+    python benchmarks/simulate_fleet.py --url http://localhost:8080 --boards 50 --duration 120 --speedup 10
+    python benchmarks/simulate_fleet.py --url ... --batch        # 改以 /api/upload_batch 一次送出 4 台的讀數
+    python benchmarks/simulate_fleet.py --url ... --packed       # 改以 /api/upload_packed 的二進位 frame 一次送出 4 台的讀數
+    python benchmarks/simulate_fleet.py --url ... --output fleet.json
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime
+
+import httpx
+
+import report
+from generate_data import DEFAULT_DEVICES, Machine
+import packed  # generate_data 已將 jlm_cloudrun_esp32 加入 sys.path
+
+# 韌體的等待時間 (秒)
+OTA_TIMEOUT = 5 * 60
+DEEP_SLEEP = 5 * 60
+UPLOAD_ATTEMPTS = 3
+UPLOAD_RETRY_DELAY = 2
+UPLOAD_RETRY_MAX_DELAY = 30
+
+class Board:
+    """一片 ESP32：MAC、上傳序號與所接的電表。"""
+
+    def __init__(self, index, meter_names, rng):
+        self.device_id = "24:6F:28:" + ":".join(f"{(index >> shift) & 0xFF:02X}" for shift in (16, 8, 0))
+        self.seq = rng.getrandbits(32)
+        self.meters = [Machine(name, random.Random(rng.random())) for name in meter_names]
+
+    def reading(self, meter):
+        """依目前的時間產生一筆讀數 (JSON 欄位與韌體相同)。"""
+        values = meter.reading(datetime.now(), DEEP_SLEEP, 0.0, 0.0)
+        voltage, current, frequency, pf, watt, total_watt_hours = values
+        payload = {
+            "table_name": meter.name,
+            "voltage": voltage,
+            "current": current,
+            "frequency": frequency,
+            "pf": pf,
+            "watt": watt,
+            "total_watt_hours": total_watt_hours,
+            "device_id": self.device_id,
+            "seq": self.seq,
+        }
+        self.seq = (self.seq + 1) % 2 ** 32
+        return payload
+
+    def frame(self):
+        """4 台電表的讀數編碼為一個 packed.py 格式的 frame；device_id 為機器在 DEFAULT_DEVICES 中的順序 (由 1 起)，
+        即 migrations.py apply 剛登錄 DEFAULT_DEVICES 時 devices 資料表的編號；服務端須已建立 devices 資料表。"""
+        readings = []
+        for meter in self.meters:
+            payload = self.reading(meter)
+            readings.append((
+                DEFAULT_DEVICES.index(meter.name) + 1, payload["seq"], 0,
+                payload["voltage"], payload["current"], payload["frequency"],
+                payload["pf"], payload["watt"], payload["total_watt_hours"],
+            ))
+        return packed.encode(self.device_id, readings)
+
+class Fleet:
+    def __init__(self, args):
+        self.args = args
+        self.recorder = report.Recorder()
+        self.retries = 0
+        self.duplicates = 0
+        self.client = None
+        if args.keepalive:
+            self.client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+
+    async def post(self, path, payload, **kwargs):
+        """與韌體相同：連線失敗、5xx 或 429 時以同一份資料重送。payload 為 JSON；二進位資料以 content= 傳入。"""
+        label = path.rsplit("/", 1)[-1]
+        if payload is not None:
+            kwargs["json"] = payload
+        for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+            if self.client is not None:
+                response = await report.timed_request(self.recorder, self.client, label, "POST", path, **kwargs)
+            else:
+                # 韌體每次上傳都新建連線
+                async with httpx.AsyncClient(base_url=self.args.url, timeout=self.args.timeout) as client:
+                    response = await report.timed_request(self.recorder, client, label, "POST", path, **kwargs)
+            if response is not None and response.status_code < 500 and response.status_code != 429:
+                if response.status_code == 200:
+                    body = response.json()
+                    self.duplicates += 1 if body.get("duplicate") else body.get("duplicates", 0)
+                return
+            if attempt < UPLOAD_ATTEMPTS:
+                self.retries += 1
+                delay = UPLOAD_RETRY_DELAY
+                retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+                if retry_after.isdigit():
+                    delay = min(max(int(retry_after), UPLOAD_RETRY_DELAY), UPLOAD_RETRY_MAX_DELAY)
+                await asyncio.sleep(delay / self.args.speedup)
+
+    async def send_all(self, board):
+        if self.args.packed:
+            await self.post(
+                "/api/upload_packed", None, content=board.frame(), headers={"Content-Type": packed.CONTENT_TYPE}
+            )
+            return
+        if self.args.batch:
+            readings = [board.reading(meter) for meter in board.meters]
+            await self.post("/api/upload_batch", {"readings": readings})
+            return
+        for meter in board.meters:
+            await self.post("/api/upload_data", board.reading(meter))
+
+    async def run_board(self, board, deadline, rng):
+        cycle = (OTA_TIMEOUT + DEEP_SLEEP) / self.args.speedup
+        # 各片 ESP32 的喚醒時間錯開
+        await asyncio.sleep(rng.uniform(0, cycle))
+        while time.monotonic() < deadline:
+            await self.send_all(board)
+            await asyncio.sleep(OTA_TIMEOUT / self.args.speedup)
+            if time.monotonic() >= deadline:
+                break
+            await self.send_all(board)
+            await asyncio.sleep(DEEP_SLEEP / self.args.speedup)
+
+    async def run(self):
+        rng = random.Random(self.args.seed)
+        meter_names = self.args.tables
+        boards = [
+            Board(index, [meter_names[(index * 4 + i) % len(meter_names)] for i in range(4)], rng)
+            for index in range(self.args.boards)
+        ]
+        start = time.monotonic()
+        deadline = start + self.args.duration
+        tasks = [asyncio.create_task(self.run_board(board, deadline, random.Random(rng.random()))) for board in boards]
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks), self.args.duration + self.args.timeout * UPLOAD_ATTEMPTS)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self.client is not None:
+                await self.client.aclose()
+        return time.monotonic() - start
+
+async def main_async(args):
+    fleet = Fleet(args)
+    elapsed_s = await fleet.run()
+    per_minute = args.boards * 4 * 2 / ((OTA_TIMEOUT + DEEP_SLEEP) / 60) * args.speedup
+    print(f"{args.boards} 片 ESP32 (相當於 {args.boards * args.speedup:.0f} 片的上傳頻率，約 {per_minute:.0f} 筆/分)，"
+          f"耗時 {elapsed_s:.1f}s，重送 {fleet.retries} 次，重複 {fleet.duplicates} 筆")
+    params = {key: value for key, value in vars(args).items() if key != "output"}
+    report.finish("fleet", params, fleet.recorder.summaries(elapsed_s), args.output)
+
+def main():
+    parser = argparse.ArgumentParser(description="模擬 ESP32 電表裝置群的上傳")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--boards", type=int, default=20, help="ESP32 片數 (每片 4 台電表)")
+    parser.add_argument("--tables", nargs="*", default=DEFAULT_DEVICES, help="電表對應的機器名稱，依序分配給各片")
+    parser.add_argument("--duration", type=float, default=60.0, help="測試秒數")
+    parser.add_argument("--speedup", type=float, default=1.0, help="等待時間縮短的倍數")
+    parser.add_argument("--batch", action="store_true", help="以 /api/upload_batch 一次送出 4 台的讀數")
+    parser.add_argument(
+        "--packed", action="store_true", help="以 /api/upload_packed 的二進位 frame 一次送出 4 台的讀數 (--tables 須為 DEFAULT_DEVICES 中的機器)"
+    )
+    parser.add_argument("--keepalive", action="store_true", help="共用連線 (韌體每次新建連線)")
+    parser.add_argument("--timeout", type=float, default=15.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="結果存成 JSON，供 report.py compare 比較")
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
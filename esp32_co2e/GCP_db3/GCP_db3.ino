@@ -10,6 +10,7 @@
  5. 最後，進入 5 分鐘的深度睡眠以節省電力，然後循環以上步驟。
  6.在rs485()增加3次驗證資料，以確保資料正確性
  7.在send_data()增加離線驗證，驗證電表是否關機
+ 8.上傳時附上 device_id 與 seq，失敗時以相同的 seq 重送，伺服器據此去除重複資料
 */
 #include <ModbusMaster.h>
 #include <HardwareSerial.h>
@@ -32,6 +33,11 @@ const long DEEP_SLEEP_SEC = 5 * 60;
 const char* host = "jlm-co2e-db-connect-221081318298.asia-east1.run.app";
 const char* api_path = "/api/upload_data";
 const int httpsPort = 443;
+// 上傳失敗 (連線錯誤、5xx 或 429) 時的重送次數與間隔
+const int UPLOAD_ATTEMPTS = 3;
+const int UPLOAD_RETRY_DELAY_MS = 2000;
+// 伺服器以 Retry-After 指定等待秒數時 (429 寫入佇列已滿、503 資料庫忙碌) 依其等待，但最多等待此時間
+const int UPLOAD_RETRY_MAX_DELAY_MS = 30000;
 
 // WiFi 憑證
 const char* ssid ="hinet-15_Plus";
@@ -58,6 +64,8 @@ String device[4] = {"破碎機(220V)", "冰水機", "雕刻機", "空壓機"};
 //--------------------- 全域變數與物件 ---------------------
 volatile bool my_flag = 0;
 volatile uint8_t status = 0;
+// 上傳序號：存在 RTC 記憶體，深度睡眠後延續；斷電重開機時以亂數重新起算，避免與先前的序號重複
+RTC_DATA_ATTR uint32_t upload_seq = 0;
 WebServer server(80);
 ModbusMaster node;
 
@@ -225,21 +233,40 @@ void sendToGCP(float voltage, float current, float frequency, float pf, float wa
   doc["pf"] = pf;
   doc["watt"] = watt;
   doc["total_watt_hours"] = total_watt_hours;
+  doc["device_id"] = WiFi.macAddress();
+  doc["seq"] = upload_seq++;
   String jsonString;
   serializeJson(doc, jsonString);
-  if (http.begin(client, url)) {
-    http.addHeader("Content-Type", "application/json");
-    int httpResponseCode = http.POST(jsonString);
-    if (httpResponseCode > 0) {
-      String response = http.getString();
-      Serial.printf("發送碼: %d\n", httpResponseCode);
-      Serial.println(response);
+  // 重送時沿用同一份 JSON (相同的 seq)，伺服器若已寫入過會回應 duplicate 而不重複寫入
+  const char* retryHeaders[] = {"Retry-After"};
+  for (int attempt = 1; attempt <= UPLOAD_ATTEMPTS; attempt++) {
+    int retryDelayMs = UPLOAD_RETRY_DELAY_MS;
+    if (!http.begin(client, url)) {
+      Serial.println("[HTTP] Unable to connect");
     } else {
-      Serial.printf("[HTTP] POST... failed, error: %s\n", http.errorToString(httpResponseCode).c_str());
+      http.addHeader("Content-Type", "application/json");
+      http.collectHeaders(retryHeaders, 1);
+      int httpResponseCode = http.POST(jsonString);
+      if (httpResponseCode > 0) {
+        String response = http.getString();
+        Serial.printf("發送碼: %d\n", httpResponseCode);
+        Serial.println(response);
+      } else {
+        Serial.printf("[HTTP] POST... failed, error: %s\n", http.errorToString(httpResponseCode).c_str());
+      }
+      if (http.hasHeader("Retry-After")) {
+        retryDelayMs = constrain(http.header("Retry-After").toInt() * 1000, UPLOAD_RETRY_DELAY_MS, UPLOAD_RETRY_MAX_DELAY_MS);
+      }
+      http.end();
+      // 成功 (2xx、3xx) 或其他 4xx (資料本身有誤，重送也不會成功) 時結束；
+      // 429 (寫入佇列已滿) 與 5xx (含 503 資料庫忙碌) 表示伺服器暫時無法處理，稍後以相同的 seq 重送
+      if (httpResponseCode > 0 && httpResponseCode < 500 && httpResponseCode != 429) {
+        return;
+      }
+    }
+    if (attempt < UPLOAD_ATTEMPTS) {
+      delay(retryDelayMs);
     }
-    http.end();
-  } else {
-    Serial.println("[HTTP] Unable to connect");
   }
 }
 
@@ -372,6 +399,9 @@ void setup() {
   xTaskCreatePinnedToCore(TaskCore0, "TaskCore0", 10000, NULL, 1, NULL, 0);
   
   Serial.println("ESP32 喚醒！");
+  if (esp_sleep_get_wakeup_cause() != ESP_SLEEP_WAKEUP_TIMER) {
+    upload_seq = esp_random();
+  }
 
   send_data();
   Serial.println("資料已發送 (第一次)。");
@@ -0,0 +1,51 @@
+import os
+
+# 每日邊界時刻的用電讀數索引 (energy_segments) 的寫入端
+# 查詢服務 (jlm_cloudrun_login/boundaries.py) 負責建立資料表、回補歷史資料與查詢；
+# 本服務在寫入原始資料的同一個交易中更新各區段的第一筆與最後一筆讀數。兩邊的區段切法必須一致。
+BOUNDARY_INDEX_ENABLED = os.environ.get("BOUNDARY_INDEX_ENABLED", "false").lower() == "true"
+
+# 邊界時刻 (台灣時間)：00:00 日界、05:00 夜班結束、08:00 日班開始、17:00 日班結束、19:00 夜班開始
+BOUNDARY_HOURS = (0, 5, 8, 17, 19)
+
+def segment_start(ts):
+    """取得時間所屬區段的起點，即不晚於該時間的最後一個邊界時刻。"""
+    hour = max(boundary for boundary in BOUNDARY_HOURS if boundary <= ts.hour)
+    return ts.replace(hour=hour, minute=0, second=0, microsecond=0)
+
+def aggregate_segments(rows_by_table):
+    """
+    將即將寫入的原始資料依 (資料表, 區段) 彙總出第一筆與最後一筆讀數。
+    rows 為 (voltage, current, frequency, pf, watt, total_watt_hours, timestamp) 的序列。
+    """
+    segments = {}
+    for table_name, rows in rows_by_table.items():
+        for voltage, current, frequency, pf, watt, total_watt_hours, timestamp in rows:
+            key = (table_name, segment_start(timestamp))
+            segment = segments.get(key)
+            if segment is None:
+                segments[key] = [timestamp, total_watt_hours, timestamp, total_watt_hours]
+                continue
+            if timestamp < segment[0]:
+                segment[0], segment[1] = timestamp, total_watt_hours
+            if timestamp >= segment[2]:
+                segment[2], segment[3] = timestamp, total_watt_hours
+    return [(table_name, start, *values) for (table_name, start), values in segments.items()]
+
+# MySQL 依序套用 UPDATE 子句，first/last 的值必須在對應時間欄位更新前先比較
+UPSERT_QUERY = """
+    INSERT INTO energy_segments
+    (table_name, segment_start, first_ts, first_total_watt_hours, last_ts, last_total_watt_hours)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        first_total_watt_hours = IF(VALUES(first_ts) < first_ts, VALUES(first_total_watt_hours), first_total_watt_hours),
+        first_ts = LEAST(first_ts, VALUES(first_ts)),
+        last_total_watt_hours = IF(VALUES(last_ts) >= last_ts, VALUES(last_total_watt_hours), last_total_watt_hours),
+        last_ts = GREATEST(last_ts, VALUES(last_ts))
+"""
+
+def upsert_segments(cursor, rows_by_table):
+    """在寫入原始資料的同一個交易中更新各區段的第一筆與最後一筆讀數。"""
+    rows = aggregate_segments(rows_by_table)
+    if rows:
+        cursor.executemany(UPSERT_QUERY, rows)
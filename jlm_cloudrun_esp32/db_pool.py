@@ -0,0 +1,249 @@
+import os
+import threading
+import time
+from collections import deque
+
+from fastapi import HTTPException
+
+import log
+import metrics
+
+# 資料庫連線池管理
+# mysql-connector 的連線池在連線用完時立即拋出例外 (不會等待)，建立失敗後也不會重試。
+# PoolManager 在外層加上：
+#   - 取得連線時最多等待 DB_POOL_ACQUIRE_TIMEOUT 秒，同時等待的請求超過 DB_POOL_MAX_WAITERS 個時直接回覆 503
+#   - 連線使用超過 DB_POOL_RECYCLE_SECONDS 秒後重新連線 (Cloud SQL 會關閉存在過久的連線)；
+#     取出連線時 mysql-connector 本身會檢查連線是否仍有效，中斷者自動重新連線
+#   - 建立失敗時不再讓之後的請求全部 500：下一個請求會重新建立，失敗間隔以指數退避拉長 (最多 DB_POOL_INIT_BACKOFF_MAX_SECONDS 秒)
+#   - 使用中、等待中的連線數與取得連線的延遲，供 GET /api/db/stats 查看 (Prometheus 格式見 GET /metrics)
+#
+# 每個 gunicorn worker 各有一個連線池，資料庫端的連線數上限須大於 worker 數 × DB_POOL_SIZE。
+
+def config_from_env():
+    return {
+        "size": int(os.environ.get("DB_POOL_SIZE", "10")),
+        "acquire_timeout": float(os.environ.get("DB_POOL_ACQUIRE_TIMEOUT", "5")),
+        "max_waiters": int(os.environ.get("DB_POOL_MAX_WAITERS", "32")),
+        "recycle_seconds": int(os.environ.get("DB_POOL_RECYCLE_SECONDS", "1800")),
+        "init_backoff_max": float(os.environ.get("DB_POOL_INIT_BACKOFF_MAX_SECONDS", "60")),
+    }
+
+logger = log.get_logger(__name__)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return round(sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))], 2)
+
+
+class TimedCursor:
+    """記錄每個 SQL 的執行時間 (db_query_duration_seconds，依操作與資料表分類)，其餘屬性直接轉給原本的 cursor。"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _timed(self, method, query, args):
+        started = time.perf_counter()
+        try:
+            result = method(query, args)
+        except Exception:
+            metrics.observe_query(query, time.perf_counter() - started, failed=True)
+            raise
+        metrics.observe_query(query, time.perf_counter() - started)
+        return result
+
+    def execute(self, query, params=None):
+        return self._timed(self._cursor.execute, query, params)
+
+    def executemany(self, query, seq_params):
+        return self._timed(self._cursor.executemany, query, seq_params)
+
+
+class PooledConnection:
+    """由 PoolManager 取出的連線，close() 時歸還連線池並釋出名額，其餘屬性直接轉給原本的連線。"""
+
+    def __init__(self, manager, conn):
+        self._manager = manager
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self._conn.cursor(*args, **kwargs))
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._manager._release(conn)
+
+
+class PoolManager:
+    """
+    包裝 mysql-connector 連線池。create_pool(size) 建立並回傳連線池，建立失敗時拋出例外。
+    """
+
+    def __init__(self, create_pool, size=10, acquire_timeout=5.0, max_waiters=32,
+                 recycle_seconds=1800, init_backoff_max=60.0):
+        self.create_pool = create_pool
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.max_waiters = max_waiters
+        self.recycle_seconds = recycle_seconds
+        self.init_backoff_max = init_backoff_max
+        self.pool = None
+        self._init_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # 名額數與連線池大小相同，取得名額後向 mysql-connector 取連線必定成功
+        self._slots = threading.BoundedSemaphore(size)
+        self._next_attempt = 0.0
+        self._backoff = 1.0
+        # connection_id → 建立連線的時間 (time.monotonic())
+        self._connected_at = {}
+        self._acquire_ms = deque(maxlen=1000)
+        self.waiters = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.recycled = 0
+        self.init_failures = 0
+        self.last_error = None
+
+    def init(self):
+        """建立連線池，失敗時記錄錯誤、排定下一次可重試的時間並拋出例外。"""
+        try:
+            self.pool = self.create_pool(self.size)
+        except Exception as e:
+            self.init_failures += 1
+            self.last_error = type(e).__name__
+            self._next_attempt = time.monotonic() + self._backoff
+            self._backoff = min(self._backoff * 2, self.init_backoff_max)
+            raise
+        self._backoff = 1.0
+        self.last_error = None
+        return self.pool
+
+    def warm_up(self):
+        """
+        建立連線池 (服務啟動後在背景執行緒中呼叫)。與請求共用同一個鎖，不會重複建立；
+        失敗時拋出例外，之後的請求會以退避間隔重試。
+        """
+        with self._init_lock:
+            if self.pool is None:
+                self.init()
+        return self.pool
+
+    def _ensure(self):
+        if self.pool is not None:
+            return self.pool
+        retry_after = self._next_attempt - time.monotonic()
+        if retry_after > 0:
+            raise HTTPException(status_code=503, detail="資料庫暫時無法連線，請稍後再試",
+                                headers={"Retry-After": str(max(1, round(retry_after)))})
+        with self._init_lock:
+            if self.pool is None:
+                try:
+                    self.init()
+                    logger.info("資料庫連線池已重新建立")
+                except Exception as e:
+                    logger.error("資料庫連線池建立失敗", error=repr(e), retry_after=self._backoff)
+                    raise HTTPException(status_code=503, detail="資料庫暫時無法連線，請稍後再試",
+                                        headers={"Retry-After": str(round(self._backoff))})
+        return self.pool
+
+    def get_connection(self):
+        """取得連線，用完須呼叫 close() 歸還。等待逾時或等待的請求過多時拋出 503。"""
+        pool = self._ensure()
+        with self._lock:
+            if self.waiters >= self.max_waiters:
+                self.rejected += 1
+                raise HTTPException(status_code=503, detail="資料庫忙碌中，請稍後再試", headers={"Retry-After": "1"})
+            self.waiters += 1
+        started = time.perf_counter()
+        try:
+            acquired = self._slots.acquire(timeout=self.acquire_timeout)
+        finally:
+            with self._lock:
+                self.waiters -= 1
+        if not acquired:
+            with self._lock:
+                self.timeouts += 1
+            raise HTTPException(status_code=503, detail="資料庫忙碌中，請稍後再試", headers={"Retry-After": "1"})
+
+        try:
+            conn = pool.get_connection()
+            self._recycle_if_old(conn)
+        except Exception as e:
+            self._slots.release()
+            logger.error("從連線池取得連線失敗", error=repr(e))
+            raise HTTPException(status_code=500, detail="無法從資料庫連線池取得連線。")
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.acquired += 1
+            self.in_use += 1
+            self._acquire_ms.append(elapsed * 1000)
+        metrics.db_pool_acquire_seconds.observe(elapsed)
+        return PooledConnection(self, conn)
+
+    def _recycle_if_old(self, conn):
+        now = time.monotonic()
+        # 中斷後由 mysql-connector 自動重新連線的舊 connection_id 不會再出現，累積過多時清除重新計時
+        if len(self._connected_at) > self.size * 4:
+            self._connected_at.clear()
+        connected_at = self._connected_at.setdefault(conn.connection_id, now)
+        if now - connected_at > self.recycle_seconds:
+            del self._connected_at[conn.connection_id]
+            conn.reconnect(attempts=1, delay=0)
+            self._connected_at[conn.connection_id] = now
+            self.recycled += 1
+
+    def _release(self, conn):
+        try:
+            conn.close()
+        except Exception as e:
+            logger.error("歸還資料庫連線失敗", error=repr(e))
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def connection_samples(self):
+        """GET /metrics 的 db_pool_connections (依狀態分類的連線數)。"""
+        return [(("in_use",), self.in_use), (("free",), self.size - self.in_use), (("waiting",), self.waiters)]
+
+    def failure_samples(self):
+        """GET /metrics 的 db_pool_acquire_failures_total (依原因分類)。"""
+        return [(("timeout",), self.timeouts), (("rejected",), self.rejected), (("init",), self.init_failures)]
+
+    def register_metrics(self):
+        metrics.register_collector(
+            "db_pool_connections", "連線池中依狀態分類的連線數", "gauge", ("state",), self.connection_samples
+        )
+        metrics.register_collector(
+            "db_pool_acquire_failures_total", "無法取得連線的次數", "counter", ("reason",), self.failure_samples
+        )
+
+    def stats(self):
+        """回傳使用中、等待中的連線數與取得連線的延遲 (最近 1000 次) 等統計數據。"""
+        with self._lock:
+            latencies = sorted(self._acquire_ms)
+        return {
+            "initialized": self.pool is not None,
+            "size": self.size,
+            "in_use": self.in_use,
+            "waiters": self.waiters,
+            "max_waiters": self.max_waiters,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "recycled": self.recycled,
+            "init_failures": self.init_failures,
+            "last_error": self.last_error,
+            "acquire_p50_ms": percentile(latencies, 0.5),
+            "acquire_p99_ms": percentile(latencies, 0.99),
+            "acquire_max_ms": percentile(latencies, 1.0),
+        }
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+
+import log
+
+logger = log.get_logger(__name__)
+
+# 機器 (電表) 登錄表
+# 查詢服務 (jlm_cloudrun_login/devices.py) 負責建立 devices 資料表與新增機器 (POST /api/devices)；
+# 本服務在記憶體中保留一份，驗證上傳的 table_name 時不需查資料庫。
+# 每 DEVICE_REGISTRY_REFRESH_SECONDS 秒重新載入一次；遇到未登錄的名稱時 (例如剛新增的電表第一次上傳)
+# 距上次載入超過 MISS_REFRESH_SECONDS 秒也會重新載入，新電表不必重新部署即可上傳。
+# 尚未建立 devices 資料表時使用 DEFAULT_DEVICES，行為與原本相同。
+
+# 尚未建立 devices 資料表時的機器列表 (即原本的 VALID_TABLES)
+DEFAULT_DEVICES = [
+    '120型',
+    'sensor_data1',
+    'sensor_data2',
+    '冰水機',
+    '空壓機',
+    '破碎機(220V)',
+    '雕刻機',
+    '攪拌機A'
+]
+
+DEVICE_REGISTRY_REFRESH_SECONDS = int(os.environ.get("DEVICE_REGISTRY_REFRESH_SECONDS", "60"))
+
+# 查不到機器名稱時，距上次載入超過此秒數才重新載入 (不合法的名稱不會讓每個請求都查資料庫)
+MISS_REFRESH_SECONDS = 5
+
+
+class DeviceRegistry:
+    """
+    機器名稱 → 機器屬性 (device_id、name、active)。
+    重新載入時整份替換，讀取端不需加鎖；同時只有一個執行緒在重新載入，其他執行緒沿用目前的內容。
+    """
+
+    def __init__(self, defaults, refresh_seconds=60, miss_refresh_seconds=MISS_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.miss_refresh_seconds = miss_refresh_seconds
+        self.source = "default"
+        self.loaded_at = 0.0
+        self._connect = None
+        self._lock = threading.Lock()
+        self._set([{"device_id": None, "name": name, "active": True} for name in defaults])
+
+    def _set(self, devices):
+        self._devices = {device["name"]: device for device in devices}
+        # 二進位上傳 (POST /api/upload_packed) 以 device_id 指定機器；DEFAULT_DEVICES 沒有 device_id，不可猜測
+        self._by_id = {device["device_id"]: device for device in devices if device["device_id"] is not None}
+
+    def start(self, connect):
+        """
+        connect 為取得資料庫連線的函式。啟動時只記下 connect，不查詢資料庫：
+        由 warm_up 載入，或 (STARTUP_WARM_UP=off 時) 由第一次 resolve 載入。
+        """
+        self._connect = connect
+
+    def get(self, name):
+        return self._devices.get(name)
+
+    def refresh(self, cursor):
+        """由 devices 資料表重新載入；資料表不存在或沒有任何機器時保留 DEFAULT_DEVICES。"""
+        cursor.execute(
+            "SELECT table_name FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = 'devices'"
+        )
+        if not cursor.fetchall():
+            return
+        cursor.execute("SELECT device_id, name, active FROM devices ORDER BY device_id")
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        self._set([{"device_id": device_id, "name": name, "active": bool(active)} for device_id, name, active in rows])
+        if self.source != "devices":
+            logger.info("機器登錄表已由 devices 資料表載入", devices=len(rows))
+        self.source = "devices"
+
+    def reload(self):
+        if self._connect is None or not self._lock.acquire(blocking=False):
+            return
+        conn = None
+        cursor = None
+        try:
+            conn = self._connect()
+            cursor = conn.cursor()
+            self.refresh(cursor)
+        except Exception as e:
+            logger.error("重新載入機器登錄表失敗", error=repr(e))
+        finally:
+            self.loaded_at = time.monotonic()
+            if cursor:
+                cursor.close()
+            if conn:
+                conn.close()
+            self._lock.release()
+
+    def resolve(self, name):
+        """
+        回傳機器屬性，未登錄時回傳 None。
+        登錄表超過 refresh_seconds 秒時先重新載入；名稱未登錄時距上次載入超過 miss_refresh_seconds 秒也重新載入一次。
+        """
+        if time.monotonic() - self.loaded_at >= self.refresh_seconds:
+            self.reload()
+        device = self._devices.get(name)
+        if device is None and time.monotonic() - self.loaded_at >= self.miss_refresh_seconds:
+            self.reload()
+            device = self._devices.get(name)
+        return device
+
+    def has_device_ids(self):
+        """登錄表是否已由 devices 資料表載入 (才有 device_id)；尚未載入時 (有間隔地) 先載入一次。"""
+        if self.source != "devices" and time.monotonic() - self.loaded_at >= self.miss_refresh_seconds:
+            self.reload()
+        return self.source == "devices"
+
+    def resolve_id(self, device_id):
+        """與 resolve 相同，但以 device_id 查詢 (二進位上傳)。"""
+        if time.monotonic() - self.loaded_at >= self.refresh_seconds:
+            self.reload()
+        device = self._by_id.get(device_id)
+        if device is None and time.monotonic() - self.loaded_at >= self.miss_refresh_seconds:
+            self.reload()
+            device = self._by_id.get(device_id)
+        return device
+
+    def accepts_uploads(self, name):
+        """上傳資料的機器必須已登錄且啟用中。"""
+        device = self.resolve(name)
+        return device is not None and device["active"]
+
+    def stats(self):
+        return {
+            "source": self.source,
+            "devices": len(self._devices),
+            "active": sum(1 for device in self._devices.values() if device["active"]),
+        }
+
+
+registry = DeviceRegistry(DEFAULT_DEVICES, refresh_seconds=DEVICE_REGISTRY_REFRESH_SECONDS)
@@ -0,0 +1,222 @@
+import threading
+import time
+from collections import deque
+
+import log
+import metrics
+
+logger = log.get_logger(__name__)
+
+class IngestBuffer:
+    """
+    ESP32 上傳資料的寫入緩衝區 (write-behind)。
+
+    上傳請求只需把資料放進記憶體佇列即可回應，由背景執行緒以群組提交 (group commit)
+    的方式寫入資料庫：佇列累積到 flush_rows 筆，或距離上次寫入超過 flush_interval_ms
+    毫秒時，就將目前所有資料交給 flush_fn 一次寫入。
+    佇列有上限 max_rows，已滿時 put() 回傳 False，由呼叫端回應 429 讓裝置稍後重送。
+
+    佇列中的資料為 (table_name, row)，flush_fn 接收 {table_name: [row, ...]}。
+    一次寫入所有資料表失敗時，改為每張資料表各自寫入，一張資料表的問題 (例如資料表不存在) 不影響其他資料表。
+    transient_errors (資料庫無法連線、連線池忙碌) 造成的失敗只放回佇列重試，不計入次數；
+    其他錯誤每次計入一次，同一筆資料失敗 max_attempts 次後逐筆重試一次，仍失敗者寫入 dead-letter 日誌並移出佇列，
+    不會讓一筆有問題的資料卡住之後所有的寫入。
+    每筆資料可附帶去重複的 key：寫入成功後才以 on_commit(keys) 通知，移出佇列 (dead-letter 或佇列已滿而捨棄) 時
+    以 on_discard(keys) 通知，裝置之後重送時不會被誤判為重複。
+    """
+
+    def __init__(self, flush_fn, max_rows=10000, flush_rows=200, flush_interval_ms=1000, max_attempts=5,
+                 transient_errors=(), on_commit=None, on_discard=None):
+        self._flush_fn = flush_fn
+        self.max_rows = max_rows
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_attempts = max_attempts
+        self.transient_errors = transient_errors
+        self._on_commit = on_commit
+        self._on_discard = on_discard
+
+        self._rows = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # 確保同一時間只有一個 flush 在執行 (背景執行緒與關機時的最後一次 flush)
+        self._flush_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+
+        # 統計數據
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped_rows = 0
+        self.dead_letter_rows = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def put(self, row, key=None):
+        """將一筆資料 (table_name, row) 放入佇列，key 為去重複的 key (可為 None)。佇列已滿時回傳 False。"""
+        with self._lock:
+            if len(self._rows) >= self.max_rows:
+                self.rejected += 1
+                return False
+            # 佇列中的每一筆為 (資料, key, 已失敗的次數)
+            self._rows.append((row, key, 0))
+            self.enqueued += 1
+            if len(self._rows) >= self.flush_rows:
+                self._wakeup.notify()
+        return True
+
+    def start(self):
+        """啟動背景寫入執行緒。"""
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="ingest-buffer-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """停止背景執行緒，並將佇列中剩餘的資料全部寫入。"""
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait_for(
+                    lambda: self._stopping or len(self._rows) >= self.flush_rows,
+                    timeout=self.flush_interval
+                )
+                if self._stopping:
+                    return
+            self.flush()
+
+    def flush(self):
+        """將目前佇列中的資料交給 flush_fn 寫入，回傳寫入筆數。"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._rows:
+                    return 0
+                batch = list(self._rows)
+                self._rows.clear()
+
+            start = time.perf_counter()
+            groups = {}
+            for entry in batch:
+                groups.setdefault(entry[0][0], []).append(entry)
+            error = self._write(batch)
+            if error is None:
+                written = batch
+            else:
+                written = []
+                if len(groups) == 1 or isinstance(error, self.transient_errors):
+                    # 資料庫無法連線時各資料表分開寫入也一樣失敗
+                    failed = [(batch, error)]
+                else:
+                    # 每張資料表各自寫入，只重試失敗的資料表
+                    failed = []
+                    for entries in groups.values():
+                        table_error = self._write(entries)
+                        if table_error is None:
+                            written.extend(entries)
+                        else:
+                            failed.append((entries, table_error))
+                self.failed_flushes += 1
+                for entries, table_error in failed:
+                    self._retry(entries, table_error)
+
+            if not written:
+                return 0
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            metrics.stage_seconds.observe(elapsed_ms / 1000, "ingest_flush")
+            self.flushes += 1
+            self.flushed_rows += len(written)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+            self._notify(self._on_commit, written)
+            return len(written)
+
+    def _write(self, entries):
+        """以一次 flush_fn 寫入，成功時回傳 None，失敗時回傳例外。"""
+        rows_by_table = {}
+        for (table_name, row), key, attempts in entries:
+            rows_by_table.setdefault(table_name, []).append(row)
+        try:
+            self._flush_fn(rows_by_table)
+        except Exception as e:
+            return e
+        return None
+
+    def _retry(self, entries, error):
+        """寫入失敗的資料放回佇列前端，下次再重試；失敗次數已達上限者逐筆重試，仍失敗者移至 dead-letter。"""
+        if isinstance(error, self.transient_errors):
+            requeue = entries
+        else:
+            requeue = []
+            for row, key, attempts in entries:
+                if attempts + 1 >= self.max_attempts:
+                    self._isolate((row, key, attempts + 1), error)
+                else:
+                    requeue.append((row, key, attempts + 1))
+        if requeue:
+            tables = sorted({table_name for (table_name, row), key, attempts in requeue})
+            logger.error("緩衝區寫入資料庫失敗", tables=tables, rows=len(requeue), error=repr(error))
+        with self._lock:
+            # 放不下的部分只能捨棄
+            room = max(self.max_rows - len(self._rows), 0)
+            kept = requeue[len(requeue) - room:] if room < len(requeue) else requeue
+            dropped = requeue[:len(requeue) - len(kept)]
+            self.dropped_rows += len(dropped)
+            self._rows.extendleft(reversed(kept))
+        self._notify(self._on_discard, dropped)
+
+    def _isolate(self, entry, error):
+        """單獨寫入一筆失敗次數已達上限的資料，成功則完成，仍失敗則移至 dead-letter。"""
+        single_error = self._write([entry])
+        if single_error is None:
+            self.flushed_rows += 1
+            self._notify(self._on_commit, [entry])
+            return
+        (table_name, row), key, attempts = entry
+        self.dead_letter_rows += 1
+        # dead-letter：完整資料寫入日誌 (Cloud Logging)，確認原因後可手動補寫
+        logger.error(
+            "資料寫入失敗次數過多，已移至 dead-letter", table=table_name, row=row, key=key,
+            attempts=attempts, error=repr(single_error or error)
+        )
+        self._notify(self._on_discard, [entry])
+
+    @staticmethod
+    def _notify(callback, entries):
+        if callback is None:
+            return
+        keys = [key for row, key, attempts in entries if key is not None]
+        if keys:
+            callback(keys)
+
+    def stats(self):
+        """回傳佇列深度與寫入延遲等統計數據。"""
+        with self._lock:
+            depth = len(self._rows)
+        return {
+            "queue_depth": depth,
+            "capacity": self.max_rows,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "flushed_rows": self.flushed_rows,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "dropped_rows": self.dropped_rows,
+            "dead_letter_rows": self.dead_letter_rows,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self._total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
@@ -0,0 +1,176 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import log
+import storage
+
+logger = log.get_logger(__name__)
+
+# 上傳資料的驗證、去重複與電表歸零偵測
+# 查詢服務 (jlm_cloudrun_login/ingest_guard.py) 負責建立 counter_offsets 資料表、回補歷史資料與查詢；
+# 本服務在寫入原始資料的同一個交易中記錄新發生的歸零。兩邊的偵測方式必須一致。
+#
+# 啟用方式：先執行查詢服務的 `python migrations.py apply` 與 `python ingest_guard.py backfill`，
+# 再設定環境變數 COUNTER_OFFSETS_ENABLED=true。
+COUNTER_OFFSETS_ENABLED = os.environ.get("COUNTER_OFFSETS_ENABLED", "false").lower() == "true"
+
+# 'total_watt_hours' 比前一筆小超過此值時視為電表歸零 (更換電表、斷電重置或網頁指令 /reset)
+COUNTER_RESET_TOLERANCE = float(os.environ.get("COUNTER_RESET_TOLERANCE", "0.001"))
+
+# 韌體 RS485_data() 讀取失敗時回傳的數值
+FIRMWARE_READ_FAILURE = 9999.99
+
+def validate_reading(reading):
+    """檢查一筆上傳資料，不合理時回傳錯誤訊息，否則回傳 None。"""
+    values = {
+        "voltage": reading.voltage,
+        "current": reading.current,
+        "frequency": reading.frequency,
+        "pf": reading.pf,
+        "watt": reading.watt,
+        "total_watt_hours": reading.total_watt_hours,
+    }
+    for name, value in values.items():
+        if not math.isfinite(value):
+            return f"{name} is not a finite number"
+        # 讀取失敗的數值若寫入，之後的正常讀數會被誤判為電表歸零
+        if abs(value - FIRMWARE_READ_FAILURE) < 0.001:
+            return f"{name} is the firmware read-failure value {FIRMWARE_READ_FAILURE}"
+    if reading.total_watt_hours < 0:
+        return "total_watt_hours must not be negative"
+    return None
+
+def idempotency_key(header_key, device_id, seq):
+    """
+    取得一筆上傳資料的去重複 key：優先使用 Idempotency-Key 標頭，其次為 (device_id, seq)；
+    兩者皆無時回傳 None (不去重複)。
+    """
+    if header_key:
+        return ("key", header_key)
+    if device_id is not None and seq is not None:
+        return ("seq", device_id, seq)
+    return None
+
+
+class DedupWindow:
+    """
+    最近看過的去重複 key (每個 instance 各自一份)。
+
+    ESP32 上傳失敗後會以相同的 seq 重送，若伺服器其實已寫入，重送的資料就會重複。
+    key 保留 ttl_seconds 秒，且最多 max_keys 個 (超過時淘汰最舊的)，記憶體用量有上限。
+    寫入失敗時呼叫 forget()，讓裝置的重送不會被誤判為重複。
+    經由寫入緩衝區寫入的資料以 reserve() 標記為處理中，寫入成功後才以 commit() 記錄到時間窗。
+    """
+
+    def __init__(self, max_keys=50000, ttl_seconds=600):
+        self.max_keys = max_keys
+        self.ttl_seconds = ttl_seconds
+        self._keys = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def _expire(self, now):
+        # 保留時間固定，插入順序即到期順序，只需從最舊的開始清除
+        while self._keys and next(iter(self._keys.values())) <= now:
+            self._keys.popitem(last=False)
+
+    def _record(self, key, now):
+        self._keys[key] = now + self.ttl_seconds
+        while len(self._keys) > self.max_keys:
+            self._keys.popitem(last=False)
+
+    def seen(self, key):
+        """key 仍在時間窗內時回傳 True (重複)；否則記錄 key 並回傳 False。"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._keys or key in self._pending:
+                self.duplicates += 1
+                return True
+            self._record(key, now)
+            return False
+
+    def reserve(self, key):
+        """
+        與 seen() 相同，但 key 只標記為處理中 (仍在寫入緩衝區的佇列中)，寫入成功後以 commit() 記錄到時間窗；
+        資料被捨棄時以 forget() 移除，裝置之後的重送不會被誤判為重複。
+        """
+        with self._lock:
+            self._expire(time.monotonic())
+            if key in self._keys or key in self._pending:
+                self.duplicates += 1
+                return True
+            self._pending.add(key)
+            return False
+
+    def commit(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                self._pending.discard(key)
+                self._record(key, now)
+
+    def forget(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+            self._pending.discard(key)
+
+    def forget_all(self, keys):
+        for key in keys:
+            self.forget(key)
+
+    def stats(self):
+        return {
+            "keys": len(self._keys), "pending": len(self._pending), "max_keys": self.max_keys,
+            "duplicates": self.duplicates,
+        }
+
+# --- 電表歸零偵測 ---
+def find_resets(table_name, previous, rows):
+    """
+    依時間順序比較相鄰兩筆 'total_watt_hours'，回傳歸零紀錄
+    (table_name, reset_ts, previous_ts, previous_total_watt_hours, reset_total_watt_hours, offset_watt_hours)。
+    previous 為新資料之前資料庫中的最後一筆 (timestamp, total_watt_hours)，沒有時為 None。
+    電表歸零後由 0 重新累計，offset 即為歸零前的最後讀數。
+    """
+    resets = []
+    for voltage, current, frequency, pf, watt, total_watt_hours, timestamp in sorted(rows, key=lambda row: row[6]):
+        if previous is not None and total_watt_hours < previous[1] - COUNTER_RESET_TOLERANCE:
+            resets.append((table_name, timestamp, previous[0], previous[1], total_watt_hours, previous[1]))
+        previous = (timestamp, total_watt_hours)
+    return resets
+
+# 同一次歸零可能由多個 instance 各自偵測到，以主鍵 (table_name, reset_ts) 忽略重複
+INSERT_QUERY = """
+    INSERT IGNORE INTO counter_offsets
+    (table_name, reset_ts, previous_ts, previous_total_watt_hours, reset_total_watt_hours, offset_watt_hours)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+def record_resets(cursor, rows_by_table):
+    """
+    在寫入原始資料的同一個交易中偵測並記錄歸零，回傳歸零紀錄。
+    每張資料表以 (timestamp, total_watt_hours) 索引查一次新資料之前的最後一筆。
+    """
+    resets = []
+    for table_name, rows in rows_by_table.items():
+        first_ts = min(row[6] for row in rows)
+        cursor.execute(
+            f"SELECT timestamp, total_watt_hours FROM {storage.table_ref(table_name)} "
+            "WHERE timestamp < %s ORDER BY timestamp DESC LIMIT 1",
+            (first_ts,)
+        )
+        previous = cursor.fetchone()
+        resets.extend(find_resets(table_name, tuple(previous) if previous else None, rows))
+    if resets:
+        cursor.executemany(INSERT_QUERY, resets)
+        for table_name, reset_ts, previous_ts, previous_total, reset_total, offset in resets:
+            logger.warning(
+                "偵測到電表歸零", table=table_name, previous_ts=previous_ts, previous_total=previous_total,
+                reset_ts=reset_ts, reset_total=reset_total
+            )
+    return resets
@@ -1,24 +1,37 @@
 import os
+import threading
 import mysql.connector
-from fastapi import FastAPI, HTTPException
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from fastapi import Body, FastAPI, Header, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
 from mysql.connector import pooling
 from pydantic import BaseModel
+from ingest_buffer import IngestBuffer
+import rollups
+import boundaries
+import ingest_guard
+import db_pool
+import storage
+import devices
+import log
+import metrics
+import startup
+import packed
+
+logger = log.get_logger(__name__)
 
 # --- 1. 保留 FastAPI 應用程式實例 ---
 app = FastAPI()
 
-# --- 2. 保留合法的資料表名稱列表 (用於驗證) ---
-VALID_TABLES = [
-    '120型',
-    'sensor_data1',
-    'sensor_data2',
-    '冰水機',
-    '空壓機',
-    '破碎機(220V)',
-    '雕刻機',
-    '攪拌機A'
-]
+# --- 2. 合法的資料表名稱由機器登錄表 (devices.py) 驗證 ---
+
+# 台灣時區 (UTC+8，無日光節約時間)，資料表的 timestamp 欄位一律存台灣時間
+TAIPEI_TZ = timezone(timedelta(hours=8))
+
+# 批次上傳的筆數上限，以及裝置時間可超前伺服器的容許範圍
+MAX_BATCH_ROWS = 1000
+MAX_CLOCK_SKEW = timedelta(minutes=5)
 
 # --- 3. 保留跨網域設定 ---
 # 雖然只供 ESP32 使用，但保留 CORS 以便未來可能的 web-based 測試
@@ -32,39 +45,57 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- 4. 保留資料庫連線池 ---
-try:
+# 各路由的回應時間 (GET /metrics)
+app.add_middleware(metrics.MetricsMiddleware)
+
+# 記錄第一個請求的時間 (啟動時間見 GET /api/startup)
+app.add_middleware(startup.FirstRequestMiddleware)
+
+# --- 4. 資料庫連線池 (由 db_pool.PoolManager 管理，設定見 db_pool.py) ---
+def create_db_connection_pool(pool_size):
     db_user = os.environ.get("DB_USER")
     db_password = os.environ.get("DB_PASSWORD")
     db_name = os.environ.get("DB_NAME")
     db_connection_name = os.environ.get("DB_CONNECTION_NAME")
-    unix_socket_path = f"/cloudsql/{db_connection_name}"
+    # 設定 DB_HOST 時改以 TCP 連線 (本機的 MySQL，例如 benchmarks/ 的負載測試)，否則經由 Cloud SQL 的 unix socket
+    db_host = os.environ.get("DB_HOST")
 
-    if not all([db_user, db_password, db_name, db_connection_name]):
+    if not all([db_user, db_password, db_name, db_connection_name or db_host]):
         raise ValueError("Missing one or more database environment variables.")
+    if db_host:
+        address = {"host": db_host, "port": int(os.environ.get("DB_PORT", "3306"))}
+    else:
+        address = {"unix_socket": f"/cloudsql/{db_connection_name}"}
 
-    db_connection_pool = pooling.MySQLConnectionPool(
+    return pooling.MySQLConnectionPool(
         pool_name="db_pool",
-        pool_size=10,
+        pool_size=pool_size,
         user=db_user,
         password=db_password,
         database=db_name,
-        unix_socket=unix_socket_path
+        **address
     )
-    print("資料庫連線池已成功建立。")
-except Exception as e:
-    print(f"資料庫連線池建立失敗: {e}")
-    db_connection_pool = None
 
-def get_db_connection_from_pool():
-    """從連線池中取得一個連線."""
-    if db_connection_pool is None:
-        raise HTTPException(status_code=500, detail="資料庫連線池未初始化。")
+# mysql-connector 建立連線池時會一次開啟所有連線，因此不在載入程式時建立，
+# 改由 startup 事件在背景執行緒中建立 (STARTUP_WARM_UP，見 startup.py)，服務不必等待即可開始接受請求；
+# 早於背景工作的請求會等待同一個連線池建立
+db_pool_manager = db_pool.PoolManager(create_db_connection_pool, **db_pool.config_from_env())
+db_pool_manager.register_metrics()
+
+def warm_up():
+    """建立連線池並載入機器登錄表。"""
     try:
-        return db_connection_pool.get_connection()
+        db_pool_manager.warm_up()
+        startup.mark("pool_ready")
+        logger.info("資料庫連線池已成功建立")
     except Exception as e:
-        print(f"從連線池取得連線失敗: {e}")
-        raise HTTPException(status_code=500, detail="無法從資料庫連線池取得連線。")
+        # 之後的請求會以退避間隔重新建立
+        logger.error("資料庫連線池建立失敗", error=repr(e))
+    devices.registry.reload()
+
+def get_db_connection_from_pool():
+    """從連線池中取得一個連線，用完須呼叫 close() 歸還。"""
+    return db_pool_manager.get_connection()
 
 # --- 5. 保留 ESP32 上傳資料的數據模型 ---
 class SensorData(BaseModel):
@@ -75,51 +106,362 @@ class SensorData(BaseModel):
     pf: float
     watt: float
     total_watt_hours: float
+    # 去重複用：裝置識別碼與每次上傳遞增的序號，重送時沿用相同的序號
+    device_id: Optional[str] = None
+    seq: Optional[int] = None
 
-# --- 6. 保留唯一需要的 API 路由：ESP32 上傳資料 ---
-@app.post("/api/upload_data")
-def upload_sensor_data(data: SensorData):
+class SensorReading(SensorData):
+    # 裝置端的量測時間；未提供時以伺服器接收時間為準
+    timestamp: Optional[datetime] = None
+
+class SensorBatch(BaseModel):
+    readings: List[SensorReading]
+
+def to_taipei_naive(ts: datetime) -> datetime:
+    """將時間轉為不含時區資訊的台灣時間，以符合資料表的 timestamp 欄位。未帶時區者視為台灣時間。"""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(TAIPEI_TZ)
+    return ts.replace(tzinfo=None, microsecond=0)
+
+def insert_readings(cursor, table_name, rows):
     """
-    接收 ESP32 上傳的感測器資料，並將其寫入指定的資料表。
+    以單一 executemany 將多筆資料寫入同一張資料表。
+    rows 為 (voltage, current, frequency, pf, watt, total_watt_hours, timestamp) 的序列，
+    mysql-connector 會將其改寫為一句多列 INSERT。
+    """
+    query = f"""
+        INSERT INTO `{table_name}`
+        (voltage, current, frequency, pf, watt, total_watt_hours, timestamp)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """
+    cursor.executemany(query, rows)
+
+def write_readings(rows_by_table):
+    """
+    將依資料表分組的多筆資料與其彙總資料、邊界讀數寫入資料庫，所有資料表在同一個交易中 commit。
+    啟用 COUNTER_OFFSETS_ENABLED 時，同一個交易中也記錄新發生的電表歸零。
+    依 STORAGE_LAYOUT 寫入機器資料表、readings 或兩者。
     """
-    if data.table_name not in VALID_TABLES:
-        raise HTTPException(status_code=400, detail=f"Invalid table name: {data.table_name}")
-    
     conn = None
     cursor = None
     try:
         conn = get_db_connection_from_pool()
         cursor = conn.cursor()
-        
-        query = f"""
-            INSERT INTO `{data.table_name}` 
-            (voltage, current, frequency, pf, watt, total_watt_hours, timestamp)
-            VALUES (%s, %s, %s, %s, %s, %s, CONVERT_TZ(NOW(),'UTC','Asia/Taipei'))
-        """
-        
-        values = (
-            data.voltage, 
-            data.current, 
-            data.frequency, 
-            data.pf, 
-            data.watt, 
-            data.total_watt_hours
-        )
-        
-        cursor.execute(query, values)
+        if ingest_guard.COUNTER_OFFSETS_ENABLED:
+            ingest_guard.record_resets(cursor, rows_by_table)
+        if storage.writes_per_table():
+            for table_name, rows in rows_by_table.items():
+                insert_readings(cursor, table_name, rows)
+        if storage.writes_unified():
+            storage.insert_unified(cursor, rows_by_table)
+        if rollups.ROLLUPS_ENABLED:
+            rollups.upsert_rollups(cursor, rows_by_table)
+        if boundaries.BOUNDARY_INDEX_ENABLED:
+            boundaries.upsert_segments(cursor, rows_by_table)
         conn.commit()
-        
-        return {"message": f"Data successfully inserted into {data.table_name}"}
-        
-    except Exception as e:
-        print(f"寫入資料庫時發生錯誤: {e}")
-        raise HTTPException(status_code=500, detail="寫入資料庫失敗")
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
     finally:
         if cursor:
             cursor.close()
-        if conn and conn.is_connected():
+        if conn:
             conn.close()
 
+# --- 5.1 寫入緩衝區：上傳請求立即回應，由背景執行緒群組提交 ---
+# 預設關閉：回應 202 時資料尚未寫入，Cloud Run 預設的 CPU 只在處理請求時配置，背景執行緒在請求之間會被限速，
+# 已回應的資料可能很久才寫入 (韌體視 202 為成功，不會重送)；須搭配 --no-cpu-throttling 才啟用
+INGEST_BUFFER_ENABLED = os.environ.get("INGEST_BUFFER_ENABLED", "false").lower() == "true"
+ingest_buffer = IngestBuffer(
+    flush_fn=write_readings,
+    max_rows=int(os.environ.get("INGEST_BUFFER_MAX_ROWS", "10000")),
+    flush_rows=int(os.environ.get("INGEST_FLUSH_ROWS", "200")),
+    flush_interval_ms=int(os.environ.get("INGEST_FLUSH_INTERVAL_MS", "1000")),
+    # 同一筆資料寫入失敗超過此次數 (資料庫無法連線的情況不計) 即移至 dead-letter 日誌
+    max_attempts=int(os.environ.get("INGEST_MAX_ATTEMPTS", "5")),
+    transient_errors=(
+        HTTPException,
+        mysql.connector.errors.InterfaceError,
+        mysql.connector.errors.OperationalError,
+        mysql.connector.errors.PoolError,
+    ),
+    # 寫入成功後才記錄去重複的 key，被捨棄的資料重送時不會被誤判為重複
+    on_commit=lambda keys: dedup_window.commit(keys),
+    on_discard=lambda keys: dedup_window.forget_all(keys)
+)
+
+# --- 5.2 去重複時間窗：ESP32 以相同的 seq 或 Idempotency-Key 重送時只寫入一次 ---
+dedup_window = ingest_guard.DedupWindow(
+    max_keys=int(os.environ.get("INGEST_DEDUP_MAX_KEYS", "50000")),
+    ttl_seconds=int(os.environ.get("INGEST_DEDUP_WINDOW_SECONDS", "600"))
+)
+
+# 寫入緩衝區的狀態 (GET /metrics)
+def ingest_queue_samples():
+    return [((), ingest_buffer.stats()["queue_depth"])]
+
+def ingest_row_samples():
+    stats = ingest_buffer.stats()
+    return [
+        (("enqueued",), stats["enqueued"]),
+        (("rejected",), stats["rejected"]),
+        (("flushed",), stats["flushed_rows"]),
+        (("dropped",), stats["dropped_rows"]),
+        (("dead_letter",), stats["dead_letter_rows"]),
+    ]
+
+metrics.register_collector("ingest_buffer_queue_rows", "寫入緩衝區中等待寫入的筆數", "gauge", (), ingest_queue_samples)
+metrics.register_collector("ingest_buffer_rows_total", "寫入緩衝區依結果分類的筆數", "counter", ("result",), ingest_row_samples)
+
+@app.on_event("startup")
+def start_ingest_buffer():
+    # off 時連線池與機器登錄表都延後到第一個需要資料庫的請求才建立、載入
+    devices.registry.start(get_db_connection_from_pool)
+    if startup.STARTUP_WARM_UP == "blocking":
+        warm_up()
+    elif startup.STARTUP_WARM_UP == "background":
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    if INGEST_BUFFER_ENABLED:
+        ingest_buffer.start()
+    startup.mark("ready")
+
+@app.on_event("shutdown")
+def stop_ingest_buffer():
+    # Cloud Run 關機前會送出 SIGTERM，此時將緩衝區內剩餘的資料全部寫入
+    if INGEST_BUFFER_ENABLED:
+        ingest_buffer.stop()
+
+# --- 6. 保留唯一需要的 API 路由：ESP32 上傳資料 ---
+@app.post("/api/upload_data")
+def upload_sensor_data(data: SensorData, response: Response, idempotency_key: Optional[str] = Header(None)):
+    """
+    接收 ESP32 上傳的感測器資料，並將其寫入指定的資料表。
+    啟用寫入緩衝區時，資料放入佇列後即回應 202，由背景執行緒批次寫入。
+    帶有 Idempotency-Key 標頭或 (device_id, seq) 的重送資料只寫入一次，重複者回應 200 與 duplicate: true。
+    """
+    if not devices.registry.accepts_uploads(data.table_name):
+        raise HTTPException(status_code=400, detail=f"Invalid table name: {data.table_name}")
+    error = ingest_guard.validate_reading(data)
+    if error:
+        raise HTTPException(status_code=422, detail=f"資料不合理: {error}")
+
+    key = ingest_guard.idempotency_key(idempotency_key, data.device_id, data.seq)
+    # 放入寫入緩衝區的資料在寫入成功後才記錄 key (處理中的 key 同樣視為重複)
+    if key is not None and (dedup_window.reserve(key) if INGEST_BUFFER_ENABLED else dedup_window.seen(key)):
+        return {"message": f"Duplicate data ignored for {data.table_name}", "duplicate": True}
+
+    # 在接收當下記錄時間，避免資料延後寫入造成時間戳記偏移
+    row = (
+        data.voltage,
+        data.current,
+        data.frequency,
+        data.pf,
+        data.watt,
+        data.total_watt_hours,
+        to_taipei_naive(datetime.now(TAIPEI_TZ))
+    )
+
+    if INGEST_BUFFER_ENABLED:
+        if not ingest_buffer.put((data.table_name, row), key):
+            if key is not None:
+                dedup_window.forget(key)
+            raise HTTPException(status_code=429, detail="寫入佇列已滿，請稍後再試", headers={"Retry-After": "5"})
+        response.status_code = 202
+        return {"message": f"Data queued for {data.table_name}"}
+    
+    try:
+        write_readings({data.table_name: [row]})
+        return {"message": f"Data successfully inserted into {data.table_name}"}
+    except HTTPException as e:
+        if key is not None:
+            dedup_window.forget(key)
+        raise e
+    except Exception as e:
+        if key is not None:
+            dedup_window.forget(key)
+        logger.error("寫入資料庫時發生錯誤", table=data.table_name, error=repr(e))
+        raise HTTPException(status_code=500, detail="寫入資料庫失敗")
+
+# --- 7. ESP32 批次上傳：深度睡眠醒來後一次送出累積的多筆資料 ---
+@app.post("/api/upload_batch")
+def upload_sensor_batch(batch: SensorBatch, idempotency_key: Optional[str] = Header(None)):
+    """
+    接收多筆感測器資料 (可跨多張資料表)，依資料表分組後各以一次 executemany 寫入，
+    並在同一個交易中 commit。回傳每一筆資料是否被接受。
+    重送的資料 (整批相同的 Idempotency-Key，或相同的 device_id 與 seq) 視為已接受但不再寫入，標示 duplicate: true。
+    """
+    if not batch.readings:
+        raise HTTPException(status_code=400, detail="readings 不可為空")
+    if len(batch.readings) > MAX_BATCH_ROWS:
+        raise HTTPException(status_code=413, detail=f"單次批次最多 {MAX_BATCH_ROWS} 筆資料")
+
+    received_at = to_taipei_naive(datetime.now(TAIPEI_TZ))
+    latest_allowed = received_at + MAX_CLOCK_SKEW
+    results = []
+    rows_by_table = {}
+    keys = []
+
+    for index, reading in enumerate(batch.readings):
+        if not devices.registry.accepts_uploads(reading.table_name):
+            results.append({"index": index, "accepted": False, "error": f"Invalid table name: {reading.table_name}"})
+            continue
+        timestamp = to_taipei_naive(reading.timestamp) if reading.timestamp else received_at
+        if timestamp > latest_allowed:
+            results.append({"index": index, "accepted": False, "error": "timestamp is in the future"})
+            continue
+        error = ingest_guard.validate_reading(reading)
+        if error:
+            results.append({"index": index, "accepted": False, "error": error})
+            continue
+        key = ingest_guard.idempotency_key(
+            f"{idempotency_key}:{index}" if idempotency_key else None, reading.device_id, reading.seq
+        )
+        if key is not None:
+            if dedup_window.seen(key):
+                results.append({"index": index, "accepted": True, "duplicate": True})
+                continue
+            keys.append(key)
+        rows_by_table.setdefault(reading.table_name, []).append((
+            reading.voltage,
+            reading.current,
+            reading.frequency,
+            reading.pf,
+            reading.watt,
+            reading.total_watt_hours,
+            timestamp
+        ))
+        results.append({"index": index, "accepted": True})
+
+    if rows_by_table:
+        try:
+            write_readings(rows_by_table)
+        except Exception as e:
+            # 寫入失敗時裝置會整批重送，這批的 key 不可留在時間窗中
+            for key in keys:
+                dedup_window.forget(key)
+            if isinstance(e, HTTPException):
+                raise e
+            logger.error("批次寫入資料庫時發生錯誤", rows=len(results), error=repr(e))
+            raise HTTPException(status_code=500, detail="批次寫入資料庫失敗")
+
+    accepted = sum(1 for result in results if result["accepted"])
+    return {
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+        "duplicates": sum(1 for result in results if result.get("duplicate")),
+        "results": results
+    }
+
+# --- 7.1 二進位批次上傳：固定格式的 frame (格式見 packed.py)，傳輸量與解析成本都比 JSON 小 ---
+@app.post("/api/upload_packed")
+def upload_packed_readings(body: bytes = Body(..., media_type=packed.CONTENT_TYPE)):
+    """
+    接收 packed.py 格式的 frame (Content-Type: application/octet-stream)，驗證與寫入方式與 /api/upload_batch 相同。
+    以 (MAC, seq) 去重複，與 JSON 上傳的 (device_id, seq) 相同。
+    為了讓回應也保持精簡，只列出未被接受的紀錄 (errors)。
+    """
+    try:
+        mac, records = packed.decode(body, MAX_BATCH_ROWS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"frame 格式錯誤: {e}")
+    # device_id 只能以 devices 資料表對應，不可依預設列表的順序猜測 (寫錯資料表也不會有任何錯誤)
+    if not devices.registry.has_device_ids():
+        raise HTTPException(
+            status_code=503, detail="機器登錄表尚未由 devices 資料表載入，無法以 device_id 對應機器",
+            headers={"Retry-After": "60"}
+        )
+
+    received_at = to_taipei_naive(datetime.now(TAIPEI_TZ))
+    latest_allowed = received_at + MAX_CLOCK_SKEW
+    errors = []
+    rows_by_table = {}
+    keys = []
+    count = 0
+    duplicates = 0
+
+    for index, record in enumerate(records):
+        count += 1
+        device = devices.registry.resolve_id(record.device_id)
+        if device is None or not device["active"]:
+            errors.append({"index": index, "error": f"Invalid device_id: {record.device_id}"})
+            continue
+        # timestamp 為 UTC epoch 秒，0 表示以伺服器接收時間為準
+        timestamp = (
+            to_taipei_naive(datetime.fromtimestamp(record.timestamp, TAIPEI_TZ)) if record.timestamp else received_at
+        )
+        if timestamp > latest_allowed:
+            errors.append({"index": index, "error": "timestamp is in the future"})
+            continue
+        error = ingest_guard.validate_reading(record)
+        if error:
+            errors.append({"index": index, "error": error})
+            continue
+        key = ingest_guard.idempotency_key(None, mac, record.seq)
+        if dedup_window.seen(key):
+            duplicates += 1
+            continue
+        keys.append(key)
+        rows_by_table.setdefault(device["name"], []).append((
+            record.voltage,
+            record.current,
+            record.frequency,
+            record.pf,
+            record.watt,
+            record.total_watt_hours,
+            timestamp
+        ))
+
+    if rows_by_table:
+        try:
+            write_readings(rows_by_table)
+        except Exception as e:
+            # 寫入失敗時裝置會整個 frame 重送，這些 key 不可留在時間窗中
+            for key in keys:
+                dedup_window.forget(key)
+            if isinstance(e, HTTPException):
+                raise e
+            logger.error("二進位批次寫入資料庫時發生錯誤", rows=count, error=repr(e))
+            raise HTTPException(status_code=500, detail="批次寫入資料庫失敗")
+
+    return {
+        "accepted": count - len(errors),
+        "rejected": len(errors),
+        "duplicates": duplicates,
+        "errors": errors
+    }
+
+# --- 8. 寫入緩衝區的監控數據 ---
+@app.get("/api/ingest/stats")
+def get_ingest_stats():
+    """回傳寫入佇列深度、群組提交次數與寫入延遲等統計數據，以及去重複時間窗與機器登錄表的狀態。"""
+    return {
+        "enabled": INGEST_BUFFER_ENABLED,
+        **ingest_buffer.stats(),
+        "dedup": dedup_window.stats(),
+        "devices": devices.registry.stats()
+    }
+
+# --- 9. 資料庫連線池的監控數據與啟動時間 ---
+@app.get("/api/db/stats")
+def get_db_stats():
+    """回傳連線池使用中、等待中的連線數、逾時次數與取得連線的延遲。"""
+    return db_pool_manager.stats()
+
+@app.get("/api/startup")
+def get_startup_report():
+    """回傳由程序啟動到各啟動階段完成的秒數 (不查詢資料庫，可作為啟動探測)。"""
+    return startup.report()
+
+# --- 10. Prometheus 格式的效能指標 ---
+@app.get("/metrics")
+def get_metrics():
+    """各路由的回應時間、取得連線的等待時間、各 SQL 的執行時間、連線池與寫入緩衝區的狀態 (以 worker 標籤區分)。"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# 程式載入完成
+startup.mark("imports")
+
 # --- 已移除的功能 ---
 # - get_tables
 # - get_total_daily_kwh
@@ -0,0 +1,216 @@
+import functools
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Prometheus 格式的效能指標 (GET /metrics)
+# 記錄各路由的回應時間、取得資料庫連線的等待時間與每個 SQL 的執行時間 (依操作與資料表分類)，
+# 用來判斷慢的是連線池等待、MySQL 本身還是 Python 端的格式化。
+# 兩個服務使用相同的 metrics.py。指標存在各 worker process 的記憶體中，所有數列都帶有 worker (pid) 標籤，
+# 以 sum() 彙總即可得到整個服務的數值。METRICS_ENABLED=false 時不記錄任何數據。
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+
+# 以秒為單位的 histogram 區間
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+_collectors = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    # 在 render() 時才取 pid：gunicorn 以 --preload 啟動時模組在 fork 前就已載入
+    pairs.append(f'worker="{os.getpid()}"')
+    return "{" + ",".join(pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels → [各區間的次數..., 總和, 次數]
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, seconds, *labels):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    values[index] += 1
+                    break
+            values[-2] += seconds
+            values[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(values)) for labels, values in self._values.items())
+        names = self.labelnames + ("le",)
+        for labels, values in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values[:len(self.buckets)] + [None]):
+                cumulative = values[-1] if count is None else cumulative + count
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (_format_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(values[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {values[-1]}")
+        return lines
+
+
+def register_collector(name, help_text, metric_type, labelnames, collect):
+    """
+    登錄讀取 /metrics 時才計算的指標 (例如連線池的使用中連線數)。
+    collect() 回傳 [(標籤值 tuple, 數值)]。
+    """
+    _collectors.append((name, help_text, metric_type, labelnames, collect))
+
+def render():
+    """回傳 Prometheus text format (0.0.4) 的所有指標。"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, help_text, metric_type, labelnames, collect in _collectors:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        try:
+            samples = collect()
+        except Exception:
+            continue
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# --- 共用的指標 ---
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "HTTP 請求的處理時間 (含回應內容傳送)", ("method", "route", "status")
+)
+db_pool_acquire_seconds = Histogram("db_pool_acquire_seconds", "由連線池取得連線的等待時間")
+db_query_seconds = Histogram("db_query_duration_seconds", "單一 SQL 的執行時間", ("operation", "table"))
+db_query_errors = Counter("db_query_errors_total", "執行失敗的 SQL", ("operation", "table"))
+stage_seconds = Histogram("app_stage_duration_seconds", "請求中 Python 端各階段的處理時間", ("stage",))
+
+@contextmanager
+def timed(histogram, *labels):
+    """以 with 區塊計時並記錄到 histogram。"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, *labels)
+
+# --- SQL 分類 ---
+_OPERATION = re.compile(r"[\s(]*(\w+)")
+_TABLE = re.compile(
+    r"\b(?:FROM|INTO|UPDATE|JOIN|AS)\s+`([^`]+)`"
+    r"|\b(?:FROM|INTO|UPDATE|JOIN|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+(\w+)",
+    re.IGNORECASE
+)
+
+@functools.lru_cache(maxsize=1024)
+def query_labels(query):
+    """
+    由 SQL 取得 (操作, 資料表) 標籤。機器資料表一律以 ` 括住，優先採用；
+    合併多台機器的查詢 (UNION ALL) 標為 multiple，找不到資料表時為 -。
+    """
+    match = _OPERATION.match(query)
+    operation = match.group(1).upper() if match else "-"
+    quoted = []
+    bare = []
+    for quoted_name, bare_name in _TABLE.findall(query):
+        if quoted_name and quoted_name not in quoted:
+            quoted.append(quoted_name)
+        elif bare_name and bare_name.upper() != "SELECT" and bare_name not in bare:
+            bare.append(bare_name)
+    if len(quoted) > 1:
+        return operation, "multiple"
+    if quoted:
+        return operation, quoted[0]
+    return operation, bare[0] if bare else "-"
+
+# 批次 INSERT 展開後的 SQL 可能很長，只取開頭分類 (資料表名稱都在開頭附近)
+QUERY_LABEL_PREFIX = 1024
+
+def observe_query(query, seconds, failed=False):
+    if not METRICS_ENABLED:
+        return
+    if not isinstance(query, str):
+        query = query.decode("utf-8", "replace") if isinstance(query, bytes) else str(query)
+    labels = query_labels(query[:QUERY_LABEL_PREFIX])
+    db_query_seconds.observe(seconds, *labels)
+    if failed:
+        db_query_errors.inc(*labels)
+
+# --- 各路由的回應時間 ---
+class MetricsMiddleware:
+    """
+    ASGI middleware：記錄每個請求由進入到回應內容傳送完畢的時間。
+    路由以 FastAPI 的路徑樣板 (例如 /api/get_watt_hours/{shift_type}/{table_name}) 分類，不會因參數產生大量數列。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "other"
+            http_request_seconds.observe(time.perf_counter() - started, scope["method"], route_path, str(status[0]))
@@ -0,0 +1,70 @@
+import struct
+from collections import namedtuple
+
+# 二進位上傳格式 (POST /api/upload_packed)
+# JSON 上傳每筆都重複機器名稱與六個欄位名稱 (約 200 bytes)，此格式每筆固定 34 bytes，
+# 電池供電的電表可減少傳輸量，伺服器也不必解析 JSON 與建立 pydantic 模型。
+#
+# 一個 frame = 標頭 + count 筆紀錄，全部為 little-endian (與 ESP32 相同)，不含填充位元組：
+#   標頭 (14 bytes)  "<4sBB6sH"   magic b"JLMP"、version (1)、flags (保留，須為 0)、
+#                                  上傳的 ESP32 的 MAC (6 bytes)、紀錄筆數 count
+#   紀錄 (34 bytes)  "<HIIffffff" device_id (devices 資料表的編號，見 GET /api/devices)、
+#                                  seq (每筆遞增，重送時沿用)、timestamp (UTC epoch 秒，0 表示以伺服器接收時間為準)、
+#                                  voltage、current、frequency、pf、watt、total_watt_hours (float32)
+# float32 與韌體的 float 相同 (JSON 上傳的數值也是由 float 轉出)。
+# 去重複的 key 為 (MAC, seq)，與 JSON 上傳的 device_id (WiFi.macAddress()) 與 seq 相同，兩種格式重送時可互相辨識。
+# 兩個服務使用相同的 packed.py。
+
+MAGIC = b"JLMP"
+VERSION = 1
+HEADER = struct.Struct("<4sBB6sH")
+RECORD = struct.Struct("<HIIffffff")
+
+CONTENT_TYPE = "application/octet-stream"
+
+PackedReading = namedtuple(
+    "PackedReading",
+    ["device_id", "seq", "timestamp", "voltage", "current", "frequency", "pf", "watt", "total_watt_hours"],
+)
+
+
+def format_mac(mac):
+    """6 bytes → 與 WiFi.macAddress() 相同的字串 (例如 24:6F:28:AB:CD:EF)。"""
+    return ":".join(f"{byte:02X}" for byte in mac)
+
+
+def decode(body, max_records):
+    """
+    解析一個 frame，回傳 (MAC 字串, PackedReading 的 iterator)。
+    紀錄以 memoryview 直接由請求內容解析，不複製資料；格式不符時拋出 ValueError。
+    """
+    if len(body) < HEADER.size:
+        raise ValueError("frame 長度不足")
+    magic, version, flags, mac, count = HEADER.unpack_from(body)
+    if magic != MAGIC:
+        raise ValueError("frame 的 magic 不符")
+    if version != VERSION or flags != 0:
+        raise ValueError(f"不支援的 frame 版本 {version} (flags {flags})")
+    if count == 0:
+        raise ValueError("frame 沒有任何紀錄")
+    if count > max_records:
+        raise ValueError(f"單一 frame 最多 {max_records} 筆紀錄")
+    if len(body) != HEADER.size + count * RECORD.size:
+        raise ValueError(f"frame 長度 {len(body)} 與紀錄筆數 {count} 不符")
+    records = memoryview(body)[HEADER.size:]
+    return format_mac(mac), map(PackedReading._make, RECORD.iter_unpack(records))
+
+
+def encode(mac, readings):
+    """
+    將多筆讀數編碼為一個 frame (韌體的參考實作，供 benchmarks 與測試使用)。
+    mac 為 6 bytes 或 "AA:BB:..." 字串；readings 為 PackedReading 或相同順序的 tuple。
+    """
+    if isinstance(mac, str):
+        mac = bytes(int(part, 16) for part in mac.split(":"))
+    readings = list(readings)
+    frame = bytearray(HEADER.size + len(readings) * RECORD.size)
+    HEADER.pack_into(frame, 0, MAGIC, VERSION, 0, mac, len(readings))
+    for index, reading in enumerate(readings):
+        RECORD.pack_into(frame, HEADER.size + index * RECORD.size, *reading)
+    return bytes(frame)
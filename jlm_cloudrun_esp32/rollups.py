@@ -0,0 +1,69 @@
+import os
+
+# 預先彙總的 分/時/日 統計資料表 (rollup) 的寫入端
+# 查詢服務 (jlm_cloudrun_login/rollups.py) 負責建立資料表、回補歷史資料與查詢；
+# 本服務在寫入原始資料的同一個交易中累加更新彙總資料。兩邊的彙總方式必須一致。
+ROLLUPS_ENABLED = os.environ.get("ROLLUPS_ENABLED", "false").lower() == "true"
+
+RESOLUTIONS = ("minute", "hour", "day")
+
+def bucket_start(ts, resolution):
+    """取得時間所屬區間的起點。"""
+    if resolution == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if resolution == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def aggregate_readings(rows_by_table):
+    """
+    將即將寫入的原始資料依 (資料表, 解析度, 區間) 彙總。
+    rows 為 (voltage, current, frequency, pf, watt, total_watt_hours, timestamp) 的序列。
+    """
+    buckets = {resolution: {} for resolution in RESOLUTIONS}
+    for table_name, rows in rows_by_table.items():
+        for voltage, current, frequency, pf, watt, total_watt_hours, timestamp in rows:
+            for resolution in RESOLUTIONS:
+                key = (table_name, bucket_start(timestamp, resolution))
+                bucket = buckets[resolution].get(key)
+                if bucket is None:
+                    buckets[resolution][key] = [1, watt, watt, watt, pf, timestamp, total_watt_hours, timestamp, total_watt_hours]
+                    continue
+                bucket[0] += 1
+                bucket[1] = min(bucket[1], watt)
+                bucket[2] = max(bucket[2], watt)
+                bucket[3] += watt
+                bucket[4] += pf
+                if timestamp < bucket[5]:
+                    bucket[5], bucket[6] = timestamp, total_watt_hours
+                if timestamp >= bucket[7]:
+                    bucket[7], bucket[8] = timestamp, total_watt_hours
+    return {
+        resolution: [(table_name, start, *values) for (table_name, start), values in items.items()]
+        for resolution, items in buckets.items()
+    }
+
+def upsert_query(resolution):
+    # MySQL 依序套用 UPDATE 子句，first/last 的值必須在對應時間欄位更新前先比較
+    return f"""
+        INSERT INTO `rollup_{resolution}`
+        (table_name, bucket_start, sample_count, min_watt, max_watt, sum_watt, sum_pf,
+         first_ts, first_total_watt_hours, last_ts, last_total_watt_hours)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            first_total_watt_hours = IF(VALUES(first_ts) < first_ts, VALUES(first_total_watt_hours), first_total_watt_hours),
+            first_ts = LEAST(first_ts, VALUES(first_ts)),
+            last_total_watt_hours = IF(VALUES(last_ts) >= last_ts, VALUES(last_total_watt_hours), last_total_watt_hours),
+            last_ts = GREATEST(last_ts, VALUES(last_ts)),
+            min_watt = LEAST(min_watt, VALUES(min_watt)),
+            max_watt = GREATEST(max_watt, VALUES(max_watt)),
+            sum_watt = sum_watt + VALUES(sum_watt),
+            sum_pf = sum_pf + VALUES(sum_pf),
+            sample_count = sample_count + VALUES(sample_count)
+    """
+
+def upsert_rollups(cursor, rows_by_table):
+    """在寫入原始資料的同一個交易中，累加更新各解析度的彙總資料。"""
+    for resolution, rows in aggregate_readings(rows_by_table).items():
+        if rows:
+            cursor.executemany(upsert_query(resolution), rows)
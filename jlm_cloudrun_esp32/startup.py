@@ -0,0 +1,68 @@
+import importlib
+import os
+import time
+
+import log
+import metrics
+
+logger = log.get_logger(__name__)
+
+# 啟動時間紀錄
+# 記錄容器開始執行到各階段完成的秒數：imports (載入程式)、ready (開始接受請求)、first_request (第一個請求)、
+# pool_ready (背景建立連線池完成)，GET /api/startup 與 /metrics 的 startup_phase_seconds 查看，第一個請求時輸出一筆日誌。
+# start.sh 以 STARTUP_BEGIN 傳入容器開始執行的時間 (epoch 秒)，並以 STARTUP_PROXY_READY 傳入 Cloud SQL Proxy 就緒的時間；
+# 未設定時以載入此模組的時間為起點。
+# 以 gunicorn --preload 啟動時 imports 在主程序中完成，各 worker 繼承相同的數值。
+# 兩個服務使用相同的 startup.py。
+
+BEGAN_AT = float(os.environ.get("STARTUP_BEGIN") or time.time())
+
+# 開始接受請求後才在背景完成的工作：background (預設)、blocking (於 startup 事件中完成後才接受請求，即原本的行為)、
+# off (完全延後到第一個需要資料庫的請求)
+STARTUP_WARM_UP = os.environ.get("STARTUP_WARM_UP", "background").lower()
+
+_phases = {}
+if os.environ.get("STARTUP_PROXY_READY"):
+    _phases["proxy_ready"] = round(float(os.environ["STARTUP_PROXY_READY"]) - BEGAN_AT, 3)
+
+
+def mark(phase):
+    """記錄階段完成的時間 (同一階段只記錄第一次)。"""
+    if phase not in _phases:
+        _phases[phase] = round(time.time() - BEGAN_AT, 3)
+
+
+def report():
+    return {"worker": os.getpid(), "warm_up": STARTUP_WARM_UP, "phases_s": dict(_phases)}
+
+
+def warm_imports(module_names):
+    """在背景執行緒中預先載入延後載入的模組，第一個用到的請求不必等待。"""
+    started = time.perf_counter()
+    for name in module_names:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning("預先載入模組失敗", module=name, error=repr(e))
+    logger.debug("已預先載入模組", modules=list(module_names), elapsed_ms=round((time.perf_counter() - started) * 1000, 2))
+
+
+class FirstRequestMiddleware:
+    """ASGI middleware：記錄第一個請求的時間並輸出啟動時間日誌，之後直接轉交。"""
+
+    def __init__(self, app):
+        self.app = app
+        self.seen = False
+
+    async def __call__(self, scope, receive, send):
+        if not self.seen and scope["type"] == "http":
+            self.seen = True
+            mark("first_request")
+            logger.info("啟動時間", **report())
+        await self.app(scope, receive, send)
+
+
+metrics.register_collector(
+    "startup_phase_seconds", "容器開始執行到各啟動階段完成的秒數", "gauge", ("phase",),
+    lambda: [((phase,), seconds) for phase, seconds in _phases.items()],
+)
@@ -0,0 +1,57 @@
+import os
+
+import devices
+
+# 電表資料儲存方式 (STORAGE_LAYOUT) 的寫入端
+# 查詢服務 (jlm_cloudrun_login/storage.py) 負責建立 devices / readings 資料表、回補與分區維護；
+# 兩個服務必須設定相同的 STORAGE_LAYOUT：
+#   per_table (預設)：寫入各機器的資料表
+#   dual：同時寫入各機器的資料表與 readings (遷移期間)
+#   unified：只寫入 readings
+STORAGE_LAYOUT = os.environ.get("STORAGE_LAYOUT", "per_table").lower()
+
+def reads_unified():
+    return STORAGE_LAYOUT == "unified"
+
+def writes_unified():
+    return STORAGE_LAYOUT in ("dual", "unified")
+
+def writes_per_table():
+    return STORAGE_LAYOUT in ("per_table", "dual")
+
+def device_id(table_name):
+    """機器的 device_id，由機器登錄表 (devices.registry) 取得。"""
+    device = devices.registry.get(table_name)
+    if device is None or device["device_id"] is None:
+        raise ValueError(f"裝置尚未登錄到 devices 資料表: {table_name}")
+    return device["device_id"]
+
+def table_ref(table_name):
+    """讀取電表資料時的 FROM 子句：unified 時為 readings 中單一機器的資料，欄位名稱與機器資料表相同。"""
+    if not reads_unified():
+        return f"`{table_name}`"
+    return (
+        "(SELECT ts AS timestamp, voltage, current, frequency, pf, watt, total_watt_hours "
+        f"FROM readings WHERE device_id = {int(device_id(table_name))}) AS `{table_name}`"
+    )
+
+UNIFIED_INSERT_QUERY = """
+    INSERT INTO readings (device_id, ts, voltage, current, frequency, pf, watt, total_watt_hours)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        voltage = VALUES(voltage), current = VALUES(current), frequency = VALUES(frequency),
+        pf = VALUES(pf), watt = VALUES(watt), total_watt_hours = VALUES(total_watt_hours)
+"""
+
+def insert_unified(cursor, rows_by_table):
+    """
+    將 (voltage, current, frequency, pf, watt, total_watt_hours, timestamp) 寫入 readings。
+    同一台機器同一秒的資料以主鍵合併，保留最後寫入的一筆。
+    """
+    rows = [
+        (device_id(table_name), timestamp, voltage, current, frequency, pf, watt, total_watt_hours)
+        for table_name, table_rows in rows_by_table.items()
+        for voltage, current, frequency, pf, watt, total_watt_hours, timestamp in table_rows
+    ]
+    if rows:
+        cursor.executemany(UNIFIED_INSERT_QUERY, rows)
@@ -0,0 +1,112 @@
+import hashlib
+import importlib.util
+import threading
+import time
+from collections import OrderedDict
+
+import log
+
+logger = log.get_logger(__name__)
+
+# 認證相關的快取
+# 儀表板每次重新整理會同時呼叫多個需要認證的路由，每個請求都帶著同一個 JWT；
+# 驗證過的 token 以其 sha256 為 key 快取解碼後的內容，不必每次重新驗證簽章。
+
+def make_decoder(backend, secret_key, algorithm):
+    """
+    回傳 decode(token) 函式：驗證簽章與 exp，成功時回傳 claims，token 無效或過期時回傳 None。
+    backend 為 jose (python-jose，原本的實作) 或 pyjwt (PyJWT)，兩者速度可用 benchmarks/bench_auth.py 比較；
+    指定 pyjwt 但未安裝時改用 jose。兩者都在第一次解碼時才載入，不拖慢服務啟動。
+    """
+    if backend == "pyjwt":
+        if importlib.util.find_spec("jwt") is None:
+            logger.warning("未安裝 PyJWT，JWT 驗證改用 python-jose")
+        else:
+            def decode_pyjwt(token):
+                import jwt as pyjwt
+
+                try:
+                    return pyjwt.decode(token, secret_key, algorithms=[algorithm])
+                except pyjwt.PyJWTError:
+                    return None
+            return decode_pyjwt
+
+    def decode_jose(token):
+        from jose import JWTError, jwt
+
+        try:
+            return jwt.decode(token, secret_key, algorithms=[algorithm])
+        except JWTError:
+            return None
+    return decode_jose
+
+
+class TokenCache:
+    """
+    已驗證 JWT 的快取 (LRU，最多 max_entries 筆)。
+    快取期限為 max_ttl_seconds 與 token 的 exp 兩者中較早者，過期的 token 不會因快取而繼續有效。
+    """
+
+    def __init__(self, max_entries=10000, max_ttl_seconds=300):
+        self.max_entries = max_entries
+        self.max_ttl_seconds = max_ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token):
+        """取得快取的 claims，沒有或已過期時回傳 None。"""
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            claims, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return claims
+
+    def put(self, token, claims):
+        expires_at = time.time() + self.max_ttl_seconds
+        exp = claims.get("exp")
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, exp)
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (claims, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class ProfileCache:
+    """每位使用者基本資料 (/api/users/me) 的短期快取，ttl_seconds 內不重複查詢 employees。"""
+
+    def __init__(self, ttl_seconds=60, max_entries=10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] <= time.monotonic():
+                return None
+            return entry[0]
+
+    def put(self, user_id, profile):
+        with self._lock:
+            self._entries[user_id] = (profile, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
@@ -0,0 +1,191 @@
+import argparse
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pytz
+
+import devices
+import repository
+import storage
+
+# 每日邊界時刻的用電讀數索引 (energy_segments)
+# 一天依邊界時刻切成數個區段，每個區段一列，記錄區段內第一筆與最後一筆 'total_watt_hours'。
+# 班別與每日用電量的起訖時間都落在邊界上，因此「某時刻 (含) 之後的第一筆」與
+# 「某時刻 (含) 之前的最後一筆」都能以主鍵 (table_name, segment_start) 直接查到，
+# 不必在原始資料表中排序掃描。
+#
+# 啟用方式：先執行 `python migrations.py apply` (建立資料表與索引) 與
+# `python boundaries.py backfill` 補齊歷史資料，再設定環境變數 BOUNDARY_INDEX_ENABLED=true。
+BOUNDARY_INDEX_ENABLED = os.environ.get("BOUNDARY_INDEX_ENABLED", "false").lower() == "true"
+
+# 邊界時刻 (台灣時間)：00:00 日界、05:00 夜班結束、08:00 日班開始、17:00 日班結束、19:00 夜班開始，
+# 與 get_shift_watt_hours 的班別一致
+BOUNDARY_HOURS = (0, 5, 8, 17, 19)
+
+SEGMENT_COLUMNS = "(table_name, segment_start, first_ts, first_total_watt_hours, last_ts, last_total_watt_hours)"
+
+def segment_start(ts):
+    """取得時間所屬區段的起點，即不晚於該時間的最後一個邊界時刻。"""
+    hour = max(boundary for boundary in BOUNDARY_HOURS if boundary <= ts.hour)
+    return ts.replace(hour=hour, minute=0, second=0, microsecond=0)
+
+def is_boundary(ts):
+    """時間是否恰好落在邊界時刻上。"""
+    return ts.hour in BOUNDARY_HOURS and ts.minute == 0 and ts.second == 0 and ts.microsecond == 0
+
+def aggregate_segments(rows_by_table):
+    """
+    將即將寫入的原始資料依 (資料表, 區段) 彙總出第一筆與最後一筆讀數。
+    rows 為 (voltage, current, frequency, pf, watt, total_watt_hours, timestamp) 的序列，
+    回傳對應 SEGMENT_COLUMNS 的 tuple 列表。
+    """
+    segments = {}
+    for table_name, rows in rows_by_table.items():
+        for voltage, current, frequency, pf, watt, total_watt_hours, timestamp in rows:
+            key = (table_name, segment_start(timestamp))
+            segment = segments.get(key)
+            if segment is None:
+                segments[key] = [timestamp, total_watt_hours, timestamp, total_watt_hours]
+                continue
+            if timestamp < segment[0]:
+                segment[0], segment[1] = timestamp, total_watt_hours
+            if timestamp >= segment[2]:
+                segment[2], segment[3] = timestamp, total_watt_hours
+    return [(table_name, start, *values) for (table_name, start), values in segments.items()]
+
+# MySQL 依序套用 UPDATE 子句，first/last 的值必須在對應時間欄位更新前先比較
+UPSERT_QUERY = f"""
+    INSERT INTO energy_segments {SEGMENT_COLUMNS}
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        first_total_watt_hours = IF(VALUES(first_ts) < first_ts, VALUES(first_total_watt_hours), first_total_watt_hours),
+        first_ts = LEAST(first_ts, VALUES(first_ts)),
+        last_total_watt_hours = IF(VALUES(last_ts) >= last_ts, VALUES(last_total_watt_hours), last_total_watt_hours),
+        last_ts = GREATEST(last_ts, VALUES(last_ts))
+"""
+
+async def upsert_segments(cursor, rows_by_table):
+    """在寫入原始資料的同一個交易中更新各區段的第一筆與最後一筆讀數。"""
+    rows = aggregate_segments(rows_by_table)
+    if rows:
+        await cursor.executemany(UPSERT_QUERY, rows)
+
+# --- 查詢 (時間參數須為邊界時刻，格式為 '%Y-%m-%d %H:%M:%S') ---
+def first_total_watt_hours_query(table_name, boundary_str):
+    """
+    邊界時刻 (含) 之後的第一筆 'total_watt_hours'，回傳 (query, args)。
+    該時刻起第一個有資料的區段，其第一筆即為答案；通常就是 segment_start 等於該時刻的那一列。
+    """
+    query = """
+        SELECT first_total_watt_hours AS total_watt_hours FROM energy_segments
+        WHERE table_name = %s AND segment_start >= %s ORDER BY segment_start ASC LIMIT 1
+    """
+    return query, (table_name, boundary_str)
+
+def last_total_watt_hours_query(table_name, boundary_str):
+    """
+    邊界時刻 (含) 之前的最後一筆 'total_watt_hours'，回傳 (query, args)。
+    通常為前一個有資料區段的最後一筆；若恰好有一筆資料落在邊界時刻上，則為該筆。
+    """
+    query = """
+        SELECT total_watt_hours FROM (
+            (SELECT last_ts AS ts, last_total_watt_hours AS total_watt_hours FROM energy_segments
+             WHERE table_name = %s AND segment_start < %s ORDER BY segment_start DESC LIMIT 1)
+            UNION ALL
+            (SELECT first_ts, first_total_watt_hours FROM energy_segments
+             WHERE table_name = %s AND segment_start = %s AND first_ts = %s)
+        ) AS candidates
+        ORDER BY ts DESC LIMIT 1
+    """
+    return query, (table_name, boundary_str, table_name, boundary_str, boundary_str)
+
+async def first_total_watt_hours_at_or_after(conn, table_name, boundary_str):
+    """取得邊界時刻 (含) 之後的第一筆 'total_watt_hours'，沒有資料時回傳 None。"""
+    row = await repository.fetch_one(conn, *first_total_watt_hours_query(table_name, boundary_str))
+    return row['total_watt_hours'] if row else None
+
+async def last_total_watt_hours_at_or_before(conn, table_name, boundary_str):
+    """取得邊界時刻 (含) 之前的最後一筆 'total_watt_hours'，沒有資料時回傳 None。"""
+    row = await repository.fetch_one(conn, *last_total_watt_hours_query(table_name, boundary_str))
+    return row['total_watt_hours'] if row else None
+
+# --- 建立資料表與回補歷史資料 ---
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS energy_segments (
+        table_name VARCHAR(64) NOT NULL,
+        segment_start DATETIME NOT NULL,
+        first_ts DATETIME NOT NULL,
+        first_total_watt_hours DOUBLE,
+        last_ts DATETIME NOT NULL,
+        last_total_watt_hours DOUBLE,
+        PRIMARY KEY (table_name, segment_start)
+    )
+"""
+
+def backfill_query(table_name):
+    """回補一段時間的 SQL：依邊界時刻分組，GROUP_CONCAT 依時間排序後取第一個元素即為第一筆 (或最後一筆)。"""
+    hour_case = " ".join(
+        f"WHEN HOUR(timestamp) >= {boundary} THEN {boundary}" for boundary in sorted(BOUNDARY_HOURS, reverse=True)
+    )
+    return f"""
+        INSERT INTO energy_segments {SEGMENT_COLUMNS}
+        SELECT %s, DATE_ADD(DATE(timestamp), INTERVAL (CASE {hour_case} END) HOUR) AS segment,
+               MIN(timestamp), SUBSTRING_INDEX(GROUP_CONCAT(total_watt_hours ORDER BY timestamp ASC), ',', 1) + 0,
+               MAX(timestamp), SUBSTRING_INDEX(GROUP_CONCAT(total_watt_hours ORDER BY timestamp DESC), ',', 1) + 0
+        FROM {storage.table_ref(table_name)}
+        WHERE timestamp >= %s AND timestamp < %s
+        GROUP BY segment
+        ON DUPLICATE KEY UPDATE
+            first_ts = VALUES(first_ts),
+            first_total_watt_hours = VALUES(first_total_watt_hours),
+            last_ts = VALUES(last_ts),
+            last_total_watt_hours = VALUES(last_total_watt_hours)
+    """
+
+async def create_schema(conn):
+    async with conn.cursor() as cursor:
+        await cursor.execute(CREATE_TABLE)
+
+async def backfill_table(conn, table_name, since=None, until=None):
+    """以一天為單位回補指定資料表的區段資料，每天一個交易。"""
+    if since is None:
+        row = await repository.fetch_one(conn, f"SELECT MIN(timestamp) AS first_ts FROM {storage.table_ref(table_name)}")
+        if not row or row['first_ts'] is None:
+            print(f"資料表 '{table_name}' 沒有資料，略過。")
+            return
+        since = row['first_ts']
+    day = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    until = until or datetime.now(pytz.timezone('Asia/Taipei')).replace(tzinfo=None)
+    query = backfill_query(table_name)
+    while day < until:
+        next_day = day + timedelta(days=1)
+        async with repository.transaction(conn) as cursor:
+            await cursor.execute(query, (table_name, day.strftime('%Y-%m-%d %H:%M:%S'), next_day.strftime('%Y-%m-%d %H:%M:%S')))
+        print(f"已回補 '{table_name}' {day:%Y-%m-%d}")
+        day = next_day
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="建立邊界讀數索引並回補歷史資料")
+    parser.add_argument("command", choices=["create-schema", "backfill"])
+    parser.add_argument("--tables", nargs="*", default=None, help="要回補的資料表 (預設為全部)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="回補起始日期 (預設為資料表第一筆資料)")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="回補結束日期 (預設為現在)")
+    args = parser.parse_args(argv)
+
+    await repository.init_pool()
+    try:
+        async with repository.connection() as conn:
+            if args.command == "create-schema":
+                await create_schema(conn)
+                print("energy_segments 資料表已建立。")
+                return
+            for table_name in args.tables or devices.registry.names():
+                if table_name not in devices.registry:
+                    raise SystemExit(f"Invalid table name: {table_name}")
+                await backfill_table(conn, table_name, args.since, args.until)
+    finally:
+        await repository.close_pool()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+import numpy as np
+
+import downsample
+
+# 圖表資料的格式化
+# format_rows：逐列處理 dict (原本的作法)，回傳 [{timestamp, watt, total_watt_hours, pf}, ...]
+# format_columns：以 NumPy 陣列一次處理整欄，回傳 {timestamp: [...], watt: [...], ...}，
+#                 省去每列建立 dict、strftime 與 round 的負擔，適合大範圍查詢
+# format_chunk：串流用，逐批格式化 server-side cursor 取回的 tuple
+
+COLUMNS = ("timestamp", "watt", "total_watt_hours", "pf")
+
+def format_rows(rows, max_points=None, bucket="lttb"):
+    """
+    rows 為依時間排序的 dict (timestamp、watt、total_watt_hours、pf)；
+    彙總資料另含 first_total_watt_hours，作為累積用電的基準值。
+    """
+    formatted_data = []
+    if not rows:
+        return formatted_data
+
+    # 彙總資料的基準值為第一個區間內的第一筆，而不是該區間的最後一筆
+    initial_watt_hours = rows[0].get('first_total_watt_hours', rows[0]['total_watt_hours'])
+    if initial_watt_hours is None:
+        initial_watt_hours = 0.0
+
+    # 先以完整資料計算相對於基準值的累積用電，再降採樣，確保累積值不受影響
+    points = []
+    for row in rows:
+        cumulative_watt_hours = 0.0
+        if initial_watt_hours is not None and row['total_watt_hours'] is not None:
+            cumulative_watt_hours = row['total_watt_hours'] - initial_watt_hours
+        points.append((row['timestamp'], row['watt'], cumulative_watt_hours, row['pf']))
+
+    if max_points and len(points) > max_points:
+        points = downsample.downsample(points, max_points, bucket)
+
+    for timestamp, watt, cumulative_watt_hours, pf in points:
+        formatted_timestamp = timestamp.strftime('%Y-%m-%d %H:%M:%S')
+
+        formatted_data.append({
+            'timestamp': formatted_timestamp,
+            'watt': round(watt, 2) if watt is not None else 0.0,
+            'total_watt_hours': round(cumulative_watt_hours, 2),
+            'pf': round(pf, 2) if pf is not None else 0.0
+        })
+    return formatted_data
+
+def chunk_baseline(first_row):
+    """
+    串流時由第一筆 tuple 決定累積用電的基準值：彙總資料取第 5 欄 first_total_watt_hours，
+    原始資料取該筆的 total_watt_hours；皆為 NULL 時為 0。
+    """
+    baseline = first_row[4] if len(first_row) > 4 else first_row[2]
+    return float(baseline) if baseline is not None else 0.0
+
+def format_chunk(rows, initial_watt_hours):
+    """
+    rows 為一批 tuple (timestamp, watt, total_watt_hours, pf[, first_total_watt_hours])，
+    輸出格式與 format_rows 相同；基準值由呼叫端在第一批時以 chunk_baseline 決定並沿用。
+    """
+    return [
+        {
+            'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            'watt': round(float(watt), 2) if watt is not None else 0.0,
+            'total_watt_hours': round(float(total_watt_hours) - initial_watt_hours, 2) if total_watt_hours is not None else 0.0,
+            'pf': round(float(pf), 2) if pf is not None else 0.0,
+        }
+        for timestamp, watt, total_watt_hours, pf, *_ in rows
+    ]
+
+def format_columns(rows, initial_watt_hours=None, max_points=None, bucket="lttb"):
+    """
+    rows 為依時間排序的 tuple (epoch 秒數, watt, total_watt_hours, pf)，epoch 秒數以台灣時間計算
+    (即 timestamp 欄位的值直接視為 UTC)；NULL 以 None 表示。
+    initial_watt_hours 未指定時以第一筆的 total_watt_hours 為基準值。
+    """
+    if not rows:
+        return {column: [] for column in COLUMNS}
+
+    # None 轉為 float64 陣列時會成為 NaN
+    data = np.array(rows, dtype=np.float64)
+    epoch = data[:, 0].astype(np.int64)
+    total_watt_hours = data[:, 2]
+
+    if initial_watt_hours is None:
+        initial_watt_hours = 0.0 if np.isnan(total_watt_hours[0]) else total_watt_hours[0]
+    cumulative = np.where(np.isnan(total_watt_hours), 0.0, total_watt_hours - initial_watt_hours)
+    watt = np.nan_to_num(data[:, 1], nan=0.0)
+    pf = np.nan_to_num(data[:, 3], nan=0.0)
+
+    if max_points and len(epoch) > max_points:
+        epoch, watt, cumulative, pf = downsample.downsample_columns(epoch, watt, cumulative, pf, max_points, bucket)
+
+    timestamps = np.char.replace(np.datetime_as_string(epoch.astype("datetime64[s]"), unit="s"), "T", " ")
+    return {
+        "timestamp": timestamps.tolist(),
+        "watt": np.round(watt, 2).tolist(),
+        "total_watt_hours": np.round(cumulative, 2).tolist(),
+        "pf": np.round(pf, 2).tolist(),
+    }
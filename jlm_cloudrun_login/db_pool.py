@@ -0,0 +1,224 @@
+import asyncio
+import os
+import time
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+import log
+import metrics
+
+# 資料庫連線池管理
+# aiomysql 的連線池用完時會無限期等待，啟動時建立失敗後所有請求都回覆 500 直到重新部署。
+# PoolManager 在外層加上：
+#   - 取得連線最多等待 DB_POOL_ACQUIRE_TIMEOUT 秒，同時等待的請求超過 DB_POOL_MAX_WAITERS 個時直接回覆 503
+#   - 連線使用超過 DB_POOL_RECYCLE_SECONDS 秒後由 aiomysql 重新連線 (pool_recycle)；
+#     閒置超過 DB_POOL_VALIDATE_IDLE_SECONDS 秒的連線取出時先 ping，已中斷者重新連線
+#   - 建立失敗時由之後的請求重新建立，失敗間隔以指數退避拉長 (最多 DB_POOL_INIT_BACKOFF_MAX_SECONDS 秒)，
+#     期間回覆 503 與 Retry-After
+#   - 使用中、等待中的連線數與取得連線的延遲，供 GET /api/db/stats 查看 (Prometheus 格式見 GET /metrics)
+#
+# 每個 gunicorn worker 各有一個連線池 (start.sh 預設 4 個 worker)，
+# 資料庫端的連線數上限須大於 worker 數 × DB_POOL_MAX_SIZE，再加上 ESP32 專用服務的連線數。
+
+def config_from_env():
+    return {
+        "minsize": int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+        "maxsize": int(os.environ.get("DB_POOL_MAX_SIZE", "10")),
+        "acquire_timeout": float(os.environ.get("DB_POOL_ACQUIRE_TIMEOUT", "5")),
+        "max_waiters": int(os.environ.get("DB_POOL_MAX_WAITERS", "32")),
+        "recycle_seconds": int(os.environ.get("DB_POOL_RECYCLE_SECONDS", "1800")),
+        "validate_idle_seconds": float(os.environ.get("DB_POOL_VALIDATE_IDLE_SECONDS", "30")),
+        "init_backoff_max": float(os.environ.get("DB_POOL_INIT_BACKOFF_MAX_SECONDS", "60")),
+        "warm_size": int(os.environ.get("DB_POOL_WARM_SIZE", "2")),
+    }
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return round(sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))], 2)
+
+logger = log.get_logger(__name__)
+
+def busy():
+    return HTTPException(status_code=503, detail="資料庫忙碌中，請稍後再試", headers={"Retry-After": "1"})
+
+
+class PoolManager:
+    """
+    包裝 aiomysql 連線池。create_pool(minsize, maxsize, recycle_seconds) 為建立連線池的 coroutine function。
+    所有操作都在同一個 event loop 中執行，計數不需加鎖。
+    """
+
+    def __init__(self, create_pool, minsize=1, maxsize=10, acquire_timeout=5.0, max_waiters=32,
+                 recycle_seconds=1800, validate_idle_seconds=30.0, init_backoff_max=60.0, warm_size=2):
+        self.create_pool = create_pool
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.acquire_timeout = acquire_timeout
+        self.max_waiters = max_waiters
+        self.recycle_seconds = recycle_seconds
+        self.validate_idle_seconds = validate_idle_seconds
+        self.init_backoff_max = init_backoff_max
+        self.warm_size = min(warm_size, maxsize)
+        self.pool = None
+        self._init_lock = asyncio.Lock()
+        self._next_attempt = 0.0
+        self._backoff = 1.0
+        # 連線 → 上次歸還的時間 (time.monotonic())；連線被關閉後自動移除
+        self._released_at = weakref.WeakKeyDictionary()
+        self._acquire_ms = deque(maxlen=1000)
+        self.waiters = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.validated = 0
+        self.init_failures = 0
+        self.last_error = None
+
+    async def init(self):
+        """建立連線池，失敗時記錄錯誤、排定下一次可重試的時間並拋出例外。"""
+        try:
+            self.pool = await self.create_pool(self.minsize, self.maxsize, self.recycle_seconds)
+        except Exception as e:
+            self.init_failures += 1
+            self.last_error = type(e).__name__
+            self._next_attempt = time.monotonic() + self._backoff
+            self._backoff = min(self._backoff * 2, self.init_backoff_max)
+            raise
+        self._backoff = 1.0
+        self.last_error = None
+        return self.pool
+
+    async def warm_up(self):
+        """
+        建立連線池並預先開啟 warm_size 個連線 (服務啟動後在背景呼叫)，第一批請求不必等待建立連線。
+        與請求共用同一個鎖，不會重複建立連線池；失敗時拋出例外，之後的請求會以退避間隔重試。
+        """
+        async with self._init_lock:
+            if self.pool is None:
+                await self.init()
+        pool = self.pool
+        conns = await asyncio.gather(*(pool.acquire() for _ in range(self.warm_size)), return_exceptions=True)
+        for conn in conns:
+            if not isinstance(conn, BaseException):
+                self._released_at[conn] = time.monotonic()
+                pool.release(conn)
+        return pool
+
+    async def _ensure(self):
+        if self.pool is not None:
+            return self.pool
+        retry_after = self._next_attempt - time.monotonic()
+        if retry_after > 0:
+            raise HTTPException(status_code=503, detail="資料庫暫時無法連線，請稍後再試",
+                                headers={"Retry-After": str(max(1, round(retry_after)))})
+        async with self._init_lock:
+            if self.pool is None:
+                try:
+                    await self.init()
+                    logger.info("資料庫連線池已重新建立")
+                except Exception as e:
+                    logger.error("資料庫連線池建立失敗", error=repr(e), retry_after=self._backoff)
+                    raise HTTPException(status_code=503, detail="資料庫暫時無法連線，請稍後再試",
+                                        headers={"Retry-After": str(round(self._backoff))})
+        return self.pool
+
+    async def _acquire(self, pool):
+        if self.waiters >= self.max_waiters:
+            self.rejected += 1
+            raise busy()
+        self.waiters += 1
+        started = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(pool.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise busy()
+        except Exception as e:
+            logger.error("從連線池取得連線失敗", error=repr(e))
+            raise HTTPException(status_code=500, detail="無法從資料庫連線池取得連線。")
+        finally:
+            self.waiters -= 1
+        elapsed = time.perf_counter() - started
+        self._acquire_ms.append(elapsed * 1000)
+        metrics.db_pool_acquire_seconds.observe(elapsed)
+        return conn
+
+    async def _validate(self, pool, conn):
+        """閒置過久的連線先 ping，已中斷者重新連線；重新連線失敗時關閉並歸還後拋出例外。"""
+        released_at = self._released_at.get(conn)
+        if released_at is None or time.monotonic() - released_at < self.validate_idle_seconds:
+            return
+        self.validated += 1
+        try:
+            await conn.ping(reconnect=True)
+        except Exception as e:
+            conn.close()
+            pool.release(conn)
+            logger.error("資料庫連線已中斷且無法重新連線", error=repr(e))
+            raise HTTPException(status_code=500, detail="無法從資料庫連線池取得連線。")
+
+    @asynccontextmanager
+    async def connection(self):
+        """取得連線，離開 with 區塊時自動歸還。等待逾時或等待的請求過多時拋出 503。"""
+        pool = await self._ensure()
+        conn = await self._acquire(pool)
+        await self._validate(pool, conn)
+        self.acquired += 1
+        self.in_use += 1
+        try:
+            yield conn
+        finally:
+            self.in_use -= 1
+            self._released_at[conn] = time.monotonic()
+            pool.release(conn)
+
+    async def close(self):
+        """關閉連線池並等待所有連線釋放。"""
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            pool.close()
+            await pool.wait_closed()
+
+    def connection_samples(self):
+        """GET /metrics 的 db_pool_connections (依狀態分類的連線數)。"""
+        free = self.pool.freesize if self.pool is not None else 0
+        return [(("in_use",), self.in_use), (("free",), free), (("waiting",), self.waiters)]
+
+    def failure_samples(self):
+        """GET /metrics 的 db_pool_acquire_failures_total (依原因分類)。"""
+        return [(("timeout",), self.timeouts), (("rejected",), self.rejected), (("init",), self.init_failures)]
+
+    def register_metrics(self):
+        metrics.register_collector(
+            "db_pool_connections", "連線池中依狀態分類的連線數", "gauge", ("state",), self.connection_samples
+        )
+        metrics.register_collector(
+            "db_pool_acquire_failures_total", "無法取得連線的次數", "counter", ("reason",), self.failure_samples
+        )
+
+    def stats(self):
+        """回傳使用中、等待中的連線數與取得連線的延遲 (最近 1000 次) 等統計數據。"""
+        latencies = sorted(self._acquire_ms)
+        return {
+            "initialized": self.pool is not None,
+            "size": self.pool.size if self.pool is not None else 0,
+            "free": self.pool.freesize if self.pool is not None else 0,
+            "maxsize": self.maxsize,
+            "in_use": self.in_use,
+            "waiters": self.waiters,
+            "max_waiters": self.max_waiters,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "validated": self.validated,
+            "init_failures": self.init_failures,
+            "last_error": self.last_error,
+            "acquire_p50_ms": percentile(latencies, 0.5),
+            "acquire_p99_ms": percentile(latencies, 0.99),
+            "acquire_max_ms": percentile(latencies, 1.0),
+        }
@@ -0,0 +1,239 @@
+import asyncio
+import os
+import re
+import time
+
+import log
+import repository
+import storage
+
+logger = log.get_logger(__name__)
+
+# 機器 (電表) 登錄表
+# 原本合法的機器名稱寫死在兩個服務的 VALID_TABLES 中，新增電表必須改程式並重新部署。
+# 現在以 devices 資料表登錄機器與其屬性 (額定功率、碳排係數、是否啟用)，每個 worker 在記憶體中保留一份，
+# 查詢時以 dict 直接判斷，不需每個請求查資料庫；每 DEVICE_REGISTRY_REFRESH_SECONDS 秒重新載入，
+# 本 worker 經由 POST /api/devices 修改時立即重新載入，遇到未登錄的名稱時也會 (有間隔地) 重新載入一次。
+#
+# 啟用方式：執行 `python migrations.py apply` 建立 devices 資料表 (並登錄 DEFAULT_DEVICES)。
+# 尚未建立 devices 資料表時使用 DEFAULT_DEVICES，行為與原本相同。
+
+# 尚未建立 devices 資料表時的機器列表 (即原本的 VALID_TABLES)
+DEFAULT_DEVICES = [
+    '120型',
+    'sensor_data1',
+    'sensor_data2',
+    '冰水機',
+    '空壓機',
+    '破碎機(220V)',
+    '雕刻機',
+    '攪拌機A'
+]
+
+DEVICE_REGISTRY_REFRESH_SECONDS = int(os.environ.get("DEVICE_REGISTRY_REFRESH_SECONDS", "60"))
+
+# 查不到機器名稱時，距上次載入超過此秒數才重新載入 (不合法的名稱不會讓每個請求都查資料庫)
+MISS_REFRESH_SECONDS = 5
+
+# 機器名稱會作為資料表名稱放進 SQL (以 ` 括住)，只允許不含 ` 與控制字元的名稱
+NAME_PATTERN = re.compile(r"^[^`\x00-\x1f\x7f]{1,64}$")
+
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS devices (
+        device_id SMALLINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        name VARCHAR(64) NOT NULL UNIQUE,
+        rated_power_kw DOUBLE NULL,
+        co2e_kg_per_kwh DOUBLE NULL,
+        active TINYINT(1) NOT NULL DEFAULT 1,
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )
+"""
+
+# storage.py create-schema 較早建立的 devices 資料表沒有這些欄位
+ADDED_COLUMNS = {
+    "rated_power_kw": "DOUBLE NULL",
+    "co2e_kg_per_kwh": "DOUBLE NULL",
+    "active": "TINYINT(1) NOT NULL DEFAULT 1",
+    "updated_at": "DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP",
+}
+
+UPSERT_QUERY = """
+    INSERT INTO devices (name, rated_power_kw, co2e_kg_per_kwh, active) VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        rated_power_kw = VALUES(rated_power_kw), co2e_kg_per_kwh = VALUES(co2e_kg_per_kwh), active = VALUES(active)
+"""
+
+def default_device(name):
+    return {"device_id": None, "name": name, "rated_power_kw": None, "co2e_kg_per_kwh": None, "active": True}
+
+
+class DeviceRegistry:
+    """
+    機器名稱 → 機器屬性 (device_id、name、rated_power_kw、co2e_kg_per_kwh、active)。
+    `name in registry` 判斷是否為已登錄的機器 (含已停用者，歷史資料仍可查詢)；
+    names() 為啟用中的機器，依 device_id 排序，用於每日總用電量、匯出等彙總所有機器的路由。
+    重新載入時整份替換，讀取端不需加鎖。
+    """
+
+    def __init__(self, defaults, refresh_seconds=60, miss_refresh_seconds=MISS_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.miss_refresh_seconds = miss_refresh_seconds
+        self.source = "default"
+        self.loaded_at = 0.0
+        self._task = None
+        self._lock = asyncio.Lock()
+        self._set([default_device(name) for name in defaults])
+
+    def _set(self, devices):
+        self._devices = {device["name"]: device for device in devices}
+        self._names = [device["name"] for device in devices if device["active"]]
+        # 二進位上傳 (POST /api/upload_packed) 以 device_id 指定機器；DEFAULT_DEVICES 沒有 device_id，不可猜測
+        self._by_id = {device["device_id"]: device for device in devices if device["device_id"] is not None}
+
+    def __contains__(self, name):
+        return name in self._devices
+
+    def get(self, name):
+        return self._devices.get(name)
+
+    def names(self):
+        return list(self._names)
+
+    def all(self):
+        return list(self._devices.values())
+
+    def is_active(self, name):
+        device = self._devices.get(name)
+        return device is not None and device["active"]
+
+    async def refresh(self, conn):
+        """由 devices 資料表重新載入；資料表不存在或沒有任何機器時保留 DEFAULT_DEVICES。"""
+        rows = await repository.fetch_all(
+            conn,
+            "SELECT table_name AS name FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = 'devices'",
+        )
+        self.loaded_at = time.monotonic()
+        if not rows:
+            return
+        rows = await repository.fetch_all(
+            conn, "SELECT device_id, name, rated_power_kw, co2e_kg_per_kwh, active FROM devices ORDER BY device_id"
+        )
+        if not rows:
+            return
+        self._set([{**row, "active": bool(row["active"])} for row in rows])
+        if self.source != "devices":
+            logger.info("機器登錄表已由 devices 資料表載入", devices=len(rows))
+        self.source = "devices"
+
+    async def reload(self):
+        """取得連線並重新載入，失敗時保留目前的內容。同時只有一個重新載入在執行。"""
+        if self._lock.locked():
+            async with self._lock:
+                return
+        async with self._lock:
+            try:
+                async with repository.connection() as conn:
+                    await self.refresh(conn)
+            except Exception as e:
+                self.loaded_at = time.monotonic()
+                logger.error("重新載入機器登錄表失敗", error=repr(e))
+
+    async def resolve(self, name):
+        """
+        回傳機器屬性，未登錄時回傳 None。
+        名稱不在記憶體中時 (可能是其他 worker 剛新增的機器)，距上次載入超過 miss_refresh_seconds 秒才重新載入一次。
+        """
+        device = self._devices.get(name)
+        if device is None and time.monotonic() - self.loaded_at >= self.miss_refresh_seconds:
+            await self.reload()
+            device = self._devices.get(name)
+        return device
+
+    async def has_device_ids(self):
+        """登錄表是否已由 devices 資料表載入 (才有 device_id)；尚未載入時 (有間隔地) 先載入一次。"""
+        if self.source != "devices" and time.monotonic() - self.loaded_at >= self.miss_refresh_seconds:
+            await self.reload()
+        return self.source == "devices"
+
+    async def resolve_id(self, device_id):
+        """與 resolve 相同，但以 device_id 查詢 (二進位上傳)。"""
+        device = self._by_id.get(device_id)
+        if device is None and time.monotonic() - self.loaded_at >= self.miss_refresh_seconds:
+            await self.reload()
+            device = self._by_id.get(device_id)
+        return device
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            await self.reload()
+
+    def start(self):
+        """在 event loop 中啟動定時重新載入 (FastAPI startup 事件)。"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "source": self.source,
+            "devices": len(self._devices),
+            "active": len(self._names),
+            "loaded_seconds_ago": round(time.monotonic() - self.loaded_at, 1) if self.loaded_at else None,
+        }
+
+
+registry = DeviceRegistry(DEFAULT_DEVICES, refresh_seconds=DEVICE_REGISTRY_REFRESH_SECONDS)
+
+# --- 建立資料表與登錄機器 ---
+async def missing_columns(conn):
+    """devices 資料表缺少的欄位，資料表不存在時回傳空列表。"""
+    rows = await repository.fetch_all(
+        conn,
+        "SELECT column_name AS name FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = 'devices'",
+    )
+    existing = {row['name'] for row in rows}
+    if not existing:
+        return []
+    return [column for column in ADDED_COLUMNS if column not in existing]
+
+async def create_schema(conn):
+    """建立 devices 資料表 (已存在時補上缺少的欄位)，並登錄 DEFAULT_DEVICES 中的機器。"""
+    async with conn.cursor() as cursor:
+        await cursor.execute(CREATE_TABLE)
+        for column in await missing_columns(conn):
+            await cursor.execute(f"ALTER TABLE devices ADD COLUMN {column} {ADDED_COLUMNS[column]}")
+    await register(conn, DEFAULT_DEVICES)
+
+async def register(conn, names):
+    """將機器名稱登錄到 devices (已存在者不變)，並重新載入登錄表。"""
+    async with repository.transaction(conn) as cursor:
+        await cursor.executemany("INSERT IGNORE INTO devices (name) VALUES (%s)", [(name,) for name in names])
+    await registry.refresh(conn)
+
+async def save(conn, name, rated_power_kw=None, co2e_kg_per_kwh=None, active=True):
+    """
+    新增或更新一台機器並重新載入登錄表，回傳機器屬性。
+    使用各機器資料表 (STORAGE_LAYOUT 為 per_table 或 dual) 時，新機器的資料表以既有機器的資料表結構建立。
+    """
+    if storage.writes_per_table() and name not in registry:
+        template = next((existing for existing in registry.names() if existing != name), None)
+        if template is None:
+            raise ValueError("沒有可參考結構的機器資料表")
+        async with conn.cursor() as cursor:
+            await cursor.execute(f"CREATE TABLE IF NOT EXISTS `{name}` LIKE `{template}`")
+    async with repository.transaction(conn) as cursor:
+        await cursor.execute(UPSERT_QUERY, (name, rated_power_kw, co2e_kg_per_kwh, int(active)))
+    await registry.refresh(conn)
+    return registry.get(name)
@@ -0,0 +1,160 @@
+import numpy as np
+
+# 圖表資料的伺服器端降採樣
+# points 為依時間排序的 (timestamp, watt, cumulative_watt_hours, pf) 序列，
+# cumulative_watt_hours 已減去區間起點的基準值；降採樣只挑選或合併資料點，不改變基準值。
+# downsample_columns 為相同演算法的 NumPy 版本，供欄式 (columnar) 格式使用。
+
+BUCKET_MODES = ("lttb", "avg", "minmax")
+
+def lttb(points, threshold):
+    """
+    Largest-Triangle-Three-Buckets：保留 threshold 個最能維持 watt 曲線形狀的原始資料點。
+    第一點與最後一點一定保留。
+    """
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(points)
+
+    xs = [point[0].timestamp() for point in points]
+    ys = [point[1] or 0.0 for point in points]
+    sampled = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+        # 下一個區間的平均點，作為三角形的第三個頂點
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_count = avg_end - avg_start
+        avg_x = sum(xs[avg_start:avg_end]) / avg_count
+        avg_y = sum(ys[avg_start:avg_end]) / avg_count
+
+        # 在目前區間中挑出與前一個選取點、下一區間平均點構成最大三角形面積的點
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        max_area = -1.0
+        picked = range_start
+        for j in range(range_start, range_end):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > max_area:
+                max_area = area
+                picked = j
+        sampled.append(points[picked])
+        a = picked
+
+    sampled.append(points[-1])
+    return sampled
+
+def _time_buckets(points, bucket_count):
+    """依時間將資料點等寬分組，沒有資料的區間會被略過。"""
+    start = points[0][0].timestamp()
+    span = points[-1][0].timestamp() - start
+    width = span / bucket_count if span > 0 else 1.0
+    buckets = []
+    current_index = None
+    for point in points:
+        index = min(int((point[0].timestamp() - start) / width), bucket_count - 1)
+        if index != current_index:
+            buckets.append([])
+            current_index = index
+        buckets[-1].append(point)
+    return buckets
+
+def bucket_avg(points, max_points):
+    """每個時間區間合併為一點：watt、pf 取平均，累積用電取區間最後一筆。"""
+    if len(points) <= max_points:
+        return list(points)
+    reduced = []
+    for bucket in _time_buckets(points, max_points):
+        count = len(bucket)
+        reduced.append((
+            bucket[0][0],
+            sum(point[1] or 0.0 for point in bucket) / count,
+            bucket[-1][2],
+            sum(point[3] or 0.0 for point in bucket) / count,
+        ))
+    return reduced
+
+def bucket_minmax(points, max_points):
+    """每個時間區間保留 watt 最小與最大的兩個原始資料點 (依時間排序)，保留尖峰。"""
+    if len(points) <= max_points:
+        return list(points)
+    reduced = []
+    for bucket in _time_buckets(points, max(max_points // 2, 1)):
+        low = min(bucket, key=lambda point: point[1] or 0.0)
+        high = max(bucket, key=lambda point: point[1] or 0.0)
+        if low is high:
+            reduced.append(low)
+        else:
+            reduced.extend(sorted((low, high), key=lambda point: point[0]))
+    return reduced
+
+def downsample(points, max_points, mode="lttb"):
+    if mode == "avg":
+        return bucket_avg(points, max_points)
+    if mode == "minmax":
+        return bucket_minmax(points, max_points)
+    return lttb(points, max_points)
+
+# --- NumPy 欄式版本：epoch 為 int64 秒數，其餘為 float64 陣列 ---
+def _bucket_starts(epoch, bucket_count):
+    """依時間等寬分組，回傳每個非空區間第一筆的索引。"""
+    span = epoch[-1] - epoch[0]
+    width = span / bucket_count if span > 0 else 1.0
+    index = np.minimum(((epoch - epoch[0]) / width).astype(np.int64), bucket_count - 1)
+    return np.concatenate(([0], np.flatnonzero(np.diff(index)) + 1))
+
+def lttb_indices(xs, ys, threshold):
+    """LTTB 的 NumPy 版本，回傳被保留的資料點索引。"""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    picked = np.empty(threshold, dtype=np.int64)
+    picked[0] = 0
+    picked[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = xs[avg_start:avg_end].mean()
+        avg_y = ys[avg_start:avg_end].mean()
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        area = np.abs(
+            (xs[a] - avg_x) * (ys[range_start:range_end] - ys[a])
+            - (xs[a] - xs[range_start:range_end]) * (avg_y - ys[a])
+        )
+        a = range_start + int(np.argmax(area))
+        picked[i + 1] = a
+    return picked
+
+def downsample_columns(epoch, watt, cumulative, pf, max_points, mode="lttb"):
+    """回傳降採樣後的 (epoch, watt, cumulative, pf)。"""
+    n = len(epoch)
+    if n <= max_points:
+        return epoch, watt, cumulative, pf
+
+    if mode == "avg":
+        starts = _bucket_starts(epoch, max_points)
+        ends = np.append(starts[1:], n)
+        counts = ends - starts
+        return (
+            epoch[starts],
+            np.add.reduceat(watt, starts) / counts,
+            cumulative[ends - 1],
+            np.add.reduceat(pf, starts) / counts,
+        )
+
+    if mode == "minmax":
+        starts = _bucket_starts(epoch, max(max_points // 2, 1))
+        ends = np.append(starts[1:], n)
+        picked = []
+        for start, end in zip(starts, ends):
+            picked.append(start + int(np.argmin(watt[start:end])))
+            picked.append(start + int(np.argmax(watt[start:end])))
+        index = np.unique(picked)
+    else:
+        index = lttb_indices(epoch.astype(np.float64), watt, max_points)
+    return epoch[index], watt[index], cumulative[index], pf[index]
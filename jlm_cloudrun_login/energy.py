@@ -0,0 +1,198 @@
+import os
+
+import boundaries
+import ingest_guard
+import repository
+import rollups
+import storage
+
+# 區間用電量的計算
+# 所有計算用電量的路由 (自訂區間、班別、POST /api/energy/query、每日總用電量) 都經由 compute()，
+# 依 ENERGY_METHOD 選擇計算方式：
+#   lookup：起點 (含) 之後第一筆與終點 (含) 之前最後一筆相減，每個區間只查兩筆 (可使用邊界讀數索引、
+#           彙總資料表與最新讀數快取)，電表歸零以寫入時記錄的 counter_offsets 補上 (須啟用 COUNTER_OFFSETS_ENABLED，
+#           未啟用時跨越歸零的區間會算錯)。
+#   scan：在資料庫中以 window function (LAG) 一次計算區間內相鄰兩筆的差值並加總，遇到歸零時以歸零後的讀數計入
+#         (電表由 0 重新累計)，不需要額外的資料表；每個區間只回傳一列彙總結果，區間再長也不會把原始資料載入記憶體。
+#         會掃描區間內的所有資料，較 lookup 慢，適合未啟用 counter_offsets 又需要處理歸零的情況。需要 MySQL 8。
+#   auto (預設)：已啟用 COUNTER_OFFSETS_ENABLED 時為 lookup，否則為 scan，兩者都會正確處理電表歸零。
+ENERGY_METHOD = os.environ.get("ENERGY_METHOD", "auto").lower()
+
+# scan 方式下，total_watt_hours 缺漏 (NULL) 的區段是否以 watt 對時間積分補上 (watt 與 total_watt_hours 須為對應單位，
+# 例如 kW 與 kWh)；相鄰兩筆間隔超過 ENERGY_MAX_GAP_SECONDS 視為斷線，不積分
+ENERGY_INTEGRATE_WATT = os.environ.get("ENERGY_INTEGRATE_WATT", "false").lower() == "true"
+ENERGY_MAX_GAP_SECONDS = int(os.environ.get("ENERGY_MAX_GAP_SECONDS", "900"))
+
+# scan 方式下每次 UNION ALL 查詢最多包含的區間數
+SCAN_BATCH_SIZE = 50
+
+def method():
+    if ENERGY_METHOD in ("lookup", "scan"):
+        return ENERGY_METHOD
+    return "lookup" if ingest_guard.COUNTER_OFFSETS_ENABLED else "scan"
+
+def _format(ts):
+    return ts.strftime('%Y-%m-%d %H:%M:%S')
+
+# --- scan：在資料庫中逐筆計算 ---
+# 每一列與前一筆的差值 (delta，只在有 total_watt_hours 的讀數之間計算)、間隔秒數 (dt)，
+# 以及可否以 watt 積分 (integrable：不在第一筆與最後一筆有效讀數之間，且未斷線)
+SCAN_SEGMENTS = """
+    SELECT timestamp, total_watt_hours, watt,
+           total_watt_hours - LAG(total_watt_hours) OVER (PARTITION BY total_watt_hours IS NULL ORDER BY timestamp) AS delta,
+           LAG(timestamp) OVER w AS prev_ts,
+           LAG(watt) OVER w AS prev_watt,
+           TIMESTAMPDIFF(SECOND, LAG(timestamp) OVER w, timestamp) AS dt,
+           MIN(CASE WHEN total_watt_hours IS NOT NULL THEN timestamp END) OVER () AS first_valid,
+           MAX(CASE WHEN total_watt_hours IS NOT NULL THEN timestamp END) OVER () AS last_valid
+    FROM {table} WHERE timestamp >= %s AND timestamp <= %s
+    WINDOW w AS (ORDER BY timestamp)
+"""
+
+SCAN_TOTALS = """
+    (SELECT {index} AS range_index,
+            COUNT(*) AS readings,
+            COUNT(total_watt_hours) AS valid_readings,
+            SUM(CASE WHEN delta < -%s THEN total_watt_hours ELSE delta END) AS counter_watt_hours,
+            COALESCE(SUM(delta < -%s), 0) AS resets,
+            COALESCE(SUM(dt > %s), 0) AS gaps,
+            SUM(CASE WHEN integrable THEN (watt + prev_watt) / 2 * dt / 3600 END) AS integrated_watt_hours,
+            COALESCE(SUM(integrable), 0) AS integrable_segments
+     FROM (
+         SELECT total_watt_hours, watt, delta, dt, prev_watt,
+                dt <= %s AND watt IS NOT NULL AND prev_watt IS NOT NULL
+                AND NOT COALESCE(prev_ts >= first_valid AND timestamp <= last_valid, FALSE) AS integrable
+         FROM ({segments}) AS segments
+     ) AS classified)
+"""
+
+def scan_query(ranges):
+    """
+    ranges 為 [(table_name, start_str, end_str)]，回傳以 UNION ALL 合併的 (query, args)，
+    每個區間一列：range_index、readings (資料筆數)、valid_readings (有 total_watt_hours 的筆數)、
+    counter_watt_hours (相鄰有效讀數差值的總和，差值小於 -COUNTER_RESET_TOLERANCE 視為歸零，以歸零後的讀數計入)、
+    resets、gaps (間隔超過 ENERGY_MAX_GAP_SECONDS 的次數)、integrated_watt_hours (缺漏區段以 watt 梯形積分的結果)
+    與 integrable_segments。
+    """
+    tolerance = ingest_guard.COUNTER_RESET_TOLERANCE
+    parts = []
+    args = []
+    for index, (table_name, start_str, end_str) in enumerate(ranges):
+        segments = SCAN_SEGMENTS.format(table=storage.table_ref(table_name))
+        parts.append(SCAN_TOTALS.format(index=index, segments=segments))
+        args.extend((tolerance, tolerance, ENERGY_MAX_GAP_SECONDS, ENERGY_MAX_GAP_SECONDS, start_str, end_str))
+    return " UNION ALL ".join(parts) + " ORDER BY range_index", args
+
+def scan_result(row):
+    """scan_query 的一列 → 區間用電量；沒有可用資料時 kilo_watt_hours 為 None。"""
+    kwh = None
+    if row["valid_readings"]:
+        kwh = float(row["counter_watt_hours"] or 0)
+    if ENERGY_INTEGRATE_WATT and row["integrable_segments"]:
+        kwh = (kwh or 0) + float(row["integrated_watt_hours"] or 0)
+    return {
+        "kilo_watt_hours": kwh,
+        "resets": int(row["resets"]),
+        "gaps": int(row["gaps"]),
+        "readings": int(row["readings"]),
+    }
+
+async def scan(conn, ranges):
+    """以 scan 方式計算 ranges [(table_name, start, end)] 的用電量，每 SCAN_BATCH_SIZE 個區間一次查詢。"""
+    results = []
+    for offset in range(0, len(ranges), SCAN_BATCH_SIZE):
+        batch = [(table_name, _format(start), _format(end)) for table_name, start, end in ranges[offset:offset + SCAN_BATCH_SIZE]]
+        rows = await repository.fetch_all(conn, *scan_query(batch))
+        results.extend(scan_result(row) for row in rows)
+    return results
+
+# --- lookup：只查起訖兩筆 ---
+def boundary_lookup_queries(kind, table_name, ts):
+    """
+    依優先順序列出可回答邊界讀數查詢的 (query, args)：邊界讀數索引、彙總資料表、原始資料表。
+    kind 為 'first' (ts (含) 之後的第一筆) 或 'last' (ts (含) 之前的最後一筆)；ts 為帶時區的台灣時間。
+    """
+    ts_str = _format(ts)
+    candidates = []
+    # 班別與每日的起訖時間落在邊界時刻上，直接以主鍵查詢邊界讀數索引
+    if boundaries.BOUNDARY_INDEX_ENABLED and boundaries.is_boundary(ts):
+        if kind == "first":
+            candidates.append(boundaries.first_total_watt_hours_query(table_name, ts_str))
+        else:
+            candidates.append(boundaries.last_total_watt_hours_query(table_name, ts_str))
+    # 起訖時間恰好落在 分/時/日 的邊界上時 (例如班別的整點)，改查最粗的彙總資料表
+    resolution = rollups.aligned_resolution(ts) if rollups.ROLLUPS_ENABLED else None
+    if resolution:
+        if kind == "first":
+            candidates.append(rollups.first_total_watt_hours_query(table_name, resolution, ts_str))
+        else:
+            candidates.append(rollups.last_total_watt_hours_query(table_name, resolution, ts_str))
+    if kind == "first":
+        candidates.append(repository.first_total_watt_hours_query(table_name, ts_str))
+    else:
+        candidates.append(repository.last_total_watt_hours_query(table_name, ts_str))
+    return candidates
+
+def lookup_queries(lookup):
+    """
+    lookup 為 ('first' | 'last', table_name, ts) 的邊界讀數，或 ('offset', table_name, start, end)
+    區間內電表歸零的 offset 總和；回傳依優先順序排列的 (query, args)。
+    """
+    if lookup[0] == "offset":
+        kind, table_name, start_time, end_time = lookup
+        return [ingest_guard.offset_sum_query(table_name, _format(start_time), _format(end_time))]
+    return boundary_lookup_queries(*lookup)
+
+def range_lookups(table_name, start_time, end_time):
+    """計算一個區間需要的 lookups：起點第一筆、終點最後一筆，以及 (啟用時) 區間內的歸零 offset。"""
+    lookups = [("first", table_name, start_time), ("last", table_name, end_time)]
+    if ingest_guard.COUNTER_OFFSETS_ENABLED:
+        lookups.append(("offset", table_name, start_time, end_time))
+    return lookups
+
+async def resolve_lookups(conn, lookups):
+    """
+    lookups 為不重複的 lookup (見 lookup_queries)，回傳 {lookup: total_watt_hours}，沒有資料者為 None。
+    每一輪把所有尚未有答案的查詢合併為一次 UNION ALL；查無資料時改用下一個資料來源，通常一輪即完成。
+    """
+    candidates = {lookup: lookup_queries(lookup) for lookup in lookups}
+    values = {}
+    pending = list(lookups)
+    while pending:
+        queries = [candidates[lookup].pop(0) for lookup in pending]
+        results = await repository.fetch_lookups(conn, queries)
+        retry = []
+        for lookup, value in zip(pending, results):
+            values[lookup] = value
+            if value is None and candidates[lookup]:
+                retry.append(lookup)
+        pending = retry
+    return values
+
+async def lookup(conn, ranges):
+    """以 lookup 方式計算 ranges 的用電量；相同的邊界讀數 (例如相鄰班別共用的起訖時間) 只查一次。"""
+    lookups = list(dict.fromkeys(
+        item for table_name, start, end in ranges for item in range_lookups(table_name, start, end)
+    ))
+    values = await resolve_lookups(conn, lookups)
+    results = []
+    for table_name, start, end in ranges:
+        start_watt_hours = values[("first", table_name, start)]
+        end_watt_hours = values[("last", table_name, end)]
+        kwh = None
+        if start_watt_hours is not None and end_watt_hours is not None:
+            kwh = end_watt_hours - start_watt_hours + (values.get(("offset", table_name, start, end)) or 0)
+        results.append({"kilo_watt_hours": kwh})
+    return results
+
+async def compute(conn, ranges):
+    """
+    計算 ranges [(table_name, start, end)] 各區間的用電量，start/end 為帶時區的台灣時間。
+    回傳依輸入順序排列的 dict 列表，kilo_watt_hours 為區間用電量 (沒有資料時為 None)；
+    scan 方式另附 resets (歸零次數)、gaps (斷線次數) 與 readings (資料筆數)。
+    """
+    if not ranges:
+        return []
+    if method() == "lookup":
+        return await lookup(conn, ranges)
+    return await scan(conn, ranges)
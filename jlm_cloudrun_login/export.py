@@ -0,0 +1,112 @@
+import csv
+import io
+
+# 能源歷史資料的批次匯出 (CSV / Parquet)
+# 輸入為 (table_name, baseline, rows) 的非同步序列，rows 為 server-side cursor 取回的一批 tuple
+# (timestamp, watt, total_watt_hours, pf[, first_total_watt_hours])，baseline 為該資料表在區間起點的電表讀數。
+# 兩種格式都逐批輸出，不會把整個匯出範圍留在記憶體中。
+
+COLUMNS = ("table_name", "timestamp", "watt", "total_watt_hours", "watt_hours", "pf")
+EXPORT_FORMATS = ("csv", "parquet")
+MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+def _values(table_name, baseline, rows):
+    """
+    將一批 tuple 轉為匯出欄位：total_watt_hours 為電表原始讀數，
+    watt_hours 為自區間起點累積的用電量 (Wh)，NULL 維持空值。
+    """
+    for timestamp, watt, total_watt_hours, pf, *_ in rows:
+        watt_hours = float(total_watt_hours) - baseline if total_watt_hours is not None else None
+        yield (
+            table_name,
+            timestamp,
+            float(watt) if watt is not None else None,
+            float(total_watt_hours) if total_watt_hours is not None else None,
+            watt_hours,
+            float(pf) if pf is not None else None,
+        )
+
+async def csv_stream(chunks):
+    """輸出 CSV (含 BOM，Excel 可直接開啟中文資料表名稱)。"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    buffer.write("\ufeff")
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue().encode("utf-8")
+
+    async for table_name, baseline, rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        for table, timestamp, watt, total_watt_hours, watt_hours, pf in _values(table_name, baseline, rows):
+            writer.writerow((
+                table,
+                timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                "" if watt is None else round(watt, 3),
+                "" if total_watt_hours is None else round(total_watt_hours, 3),
+                "" if watt_hours is None else round(watt_hours, 3),
+                "" if pf is None else round(pf, 3),
+            ))
+        yield buffer.getvalue().encode("utf-8")
+
+class _StreamSink:
+    """
+    給 ParquetWriter 寫入的檔案物件，只暫存上次 drain 之後寫入的位元組。
+    Parquet 檔案是依序寫入、最後才寫 footer，不需要回頭修改，因此可以邊寫邊送出。
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+async def parquet_stream(chunks):
+    """輸出 Parquet，每批資料寫成一個 row group；pyarrow 只在實際匯出 Parquet 時才載入。"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("table_name", pa.string()),
+        ("timestamp", pa.timestamp("s")),
+        ("watt", pa.float64()),
+        ("total_watt_hours", pa.float64()),
+        ("watt_hours", pa.float64()),
+        ("pf", pa.float64()),
+    ])
+    sink = _StreamSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+    try:
+        async for table_name, baseline, rows in chunks:
+            columns = list(zip(*_values(table_name, baseline, rows)))
+            writer.write_batch(pa.record_batch(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema,
+            ))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
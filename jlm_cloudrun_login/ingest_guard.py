@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import devices
+import log
+import repository
+import storage
+
+logger = log.get_logger(__name__)
+
+# 上傳資料的驗證、去重複與電表歸零紀錄 (counter_offsets)
+# 電表歸零 (更換電表、斷電重置或韌體網頁的 /reset) 後 'total_watt_hours' 由 0 重新累計，
+# 「終點讀數 - 起點讀數」會變成負值或偏小。寫入時偵測歸零並記錄歸零前的最後讀數 (offset)，
+# 計算用電量時加上區間內所有 offset 即可，不必在每個查詢中另外處理。
+# ESP32 專用服務 (jlm_cloudrun_esp32/ingest_guard.py) 以相同方式偵測並寫入。
+#
+# 啟用方式：先執行 `python migrations.py apply` (建立資料表) 與
+# `python ingest_guard.py backfill` 找出歷史資料中的歸零，再設定環境變數 COUNTER_OFFSETS_ENABLED=true。
+COUNTER_OFFSETS_ENABLED = os.environ.get("COUNTER_OFFSETS_ENABLED", "false").lower() == "true"
+
+# 'total_watt_hours' 比前一筆小超過此值時視為電表歸零
+COUNTER_RESET_TOLERANCE = float(os.environ.get("COUNTER_RESET_TOLERANCE", "0.001"))
+
+# 韌體 RS485_data() 讀取失敗時回傳的數值
+FIRMWARE_READ_FAILURE = 9999.99
+
+def validate_reading(reading):
+    """檢查一筆上傳資料，不合理時回傳錯誤訊息，否則回傳 None。"""
+    values = {
+        "voltage": reading.voltage,
+        "current": reading.current,
+        "frequency": reading.frequency,
+        "pf": reading.pf,
+        "watt": reading.watt,
+        "total_watt_hours": reading.total_watt_hours,
+    }
+    for name, value in values.items():
+        if not math.isfinite(value):
+            return f"{name} is not a finite number"
+        # 讀取失敗的數值若寫入，之後的正常讀數會被誤判為電表歸零
+        if abs(value - FIRMWARE_READ_FAILURE) < 0.001:
+            return f"{name} is the firmware read-failure value {FIRMWARE_READ_FAILURE}"
+    if reading.total_watt_hours < 0:
+        return "total_watt_hours must not be negative"
+    return None
+
+def idempotency_key(header_key, device_id, seq):
+    """
+    取得一筆上傳資料的去重複 key：優先使用 Idempotency-Key 標頭，其次為 (device_id, seq)；
+    兩者皆無時回傳 None (不去重複)。
+    """
+    if header_key:
+        return ("key", header_key)
+    if device_id is not None and seq is not None:
+        return ("seq", device_id, seq)
+    return None
+
+
+class DedupWindow:
+    """
+    最近看過的去重複 key (每個 worker 各自一份)。
+    key 保留 ttl_seconds 秒，且最多 max_keys 個 (超過時淘汰最舊的)；寫入失敗時呼叫 forget()，
+    讓裝置的重送不會被誤判為重複。
+    """
+
+    def __init__(self, max_keys=50000, ttl_seconds=600):
+        self.max_keys = max_keys
+        self.ttl_seconds = ttl_seconds
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def seen(self, key):
+        """key 仍在時間窗內時回傳 True (重複)；否則記錄 key 並回傳 False。"""
+        now = time.monotonic()
+        with self._lock:
+            # 保留時間固定，插入順序即到期順序，只需從最舊的開始清除
+            while self._keys and next(iter(self._keys.values())) <= now:
+                self._keys.popitem(last=False)
+            if key in self._keys:
+                self.duplicates += 1
+                return True
+            self._keys[key] = now + self.ttl_seconds
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+            return False
+
+    def forget(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def stats(self):
+        return {"keys": len(self._keys), "max_keys": self.max_keys, "duplicates": self.duplicates}
+
+# --- 電表歸零偵測 ---
+def find_resets(table_name, previous, rows):
+    """
+    依時間順序比較相鄰兩筆 'total_watt_hours'，回傳歸零紀錄
+    (table_name, reset_ts, previous_ts, previous_total_watt_hours, reset_total_watt_hours, offset_watt_hours)。
+    previous 為新資料之前資料庫中的最後一筆 (timestamp, total_watt_hours)，沒有時為 None。
+    電表歸零後由 0 重新累計，offset 即為歸零前的最後讀數。
+    """
+    resets = []
+    for voltage, current, frequency, pf, watt, total_watt_hours, timestamp in sorted(rows, key=lambda row: row[6]):
+        if previous is not None and total_watt_hours < previous[1] - COUNTER_RESET_TOLERANCE:
+            resets.append((table_name, timestamp, previous[0], previous[1], total_watt_hours, previous[1]))
+        previous = (timestamp, total_watt_hours)
+    return resets
+
+RESET_COLUMNS = "(table_name, reset_ts, previous_ts, previous_total_watt_hours, reset_total_watt_hours, offset_watt_hours)"
+
+# 同一次歸零可能由兩個服務各自偵測到，以主鍵 (table_name, reset_ts) 忽略重複
+INSERT_QUERY = f"INSERT IGNORE INTO counter_offsets {RESET_COLUMNS} VALUES (%s, %s, %s, %s, %s, %s)"
+
+async def record_resets(cursor, rows_by_table):
+    """
+    在寫入原始資料的同一個交易中偵測並記錄歸零，回傳歸零紀錄。
+    每張資料表以 (timestamp, total_watt_hours) 索引查一次新資料之前的最後一筆。
+    """
+    resets = []
+    for table_name, rows in rows_by_table.items():
+        first_ts = min(row[6] for row in rows)
+        await cursor.execute(
+            f"SELECT timestamp, total_watt_hours FROM {storage.table_ref(table_name)} WHERE timestamp < %s ORDER BY timestamp DESC LIMIT 1",
+            (first_ts,)
+        )
+        row = await cursor.fetchone()
+        previous = (row['timestamp'], row['total_watt_hours']) if row else None
+        resets.extend(find_resets(table_name, previous, rows))
+    if resets:
+        await cursor.executemany(INSERT_QUERY, resets)
+        for table_name, reset_ts, previous_ts, previous_total, reset_total, offset in resets:
+            logger.warning(
+                "偵測到電表歸零", table=table_name, previous_ts=previous_ts, previous_total=previous_total,
+                reset_ts=reset_ts, reset_total=reset_total
+            )
+    return resets
+
+# --- 查詢 (時間參數格式為 '%Y-%m-%d %H:%M:%S') ---
+def offset_sum_query(table_name, start_time_str, end_time_str):
+    """
+    區間內歸零 offset 的總和，回傳 (query, args)，欄位名稱與邊界讀數查詢相同 (total_watt_hours)，
+    可一起以 repository.fetch_lookups 合併查詢。
+    用電量以「start (含) 之後第一筆」與「end (含) 之前最後一筆」相減，歸零前後兩筆都落在這兩筆之間
+    (previous_ts >= start 且 reset_ts <= end) 時才需要補上 offset。
+    """
+    query = """
+        SELECT COALESCE(SUM(offset_watt_hours), 0) AS total_watt_hours FROM counter_offsets
+        WHERE table_name = %s AND previous_ts >= %s AND reset_ts <= %s
+    """
+    return query, (table_name, start_time_str, end_time_str)
+
+async def offset_sum(conn, table_name, start_time_str, end_time_str):
+    row = await repository.fetch_one(conn, *offset_sum_query(table_name, start_time_str, end_time_str))
+    return row['total_watt_hours'] if row else 0
+
+async def offset_sums_by_table(conn, start_time_str, end_time_str):
+    """所有資料表在區間內的歸零 offset 總和，回傳 {資料表: offset}，沒有歸零的資料表不在結果中。"""
+    rows = await repository.fetch_all(
+        conn,
+        """
+        SELECT table_name, SUM(offset_watt_hours) AS offset_watt_hours FROM counter_offsets
+        WHERE previous_ts >= %s AND reset_ts <= %s GROUP BY table_name
+        """,
+        (start_time_str, end_time_str),
+    )
+    return {row['table_name']: row['offset_watt_hours'] for row in rows}
+
+# --- 建立資料表與回補歷史資料 ---
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS counter_offsets (
+        table_name VARCHAR(64) NOT NULL,
+        reset_ts DATETIME NOT NULL,
+        previous_ts DATETIME NOT NULL,
+        previous_total_watt_hours DOUBLE NOT NULL,
+        reset_total_watt_hours DOUBLE NOT NULL,
+        offset_watt_hours DOUBLE NOT NULL,
+        PRIMARY KEY (table_name, reset_ts),
+        INDEX idx_table_previous_ts (table_name, previous_ts)
+    )
+"""
+
+def backfill_query(table_name):
+    """以 LAG() 依時間比較相鄰兩筆，找出資料表中所有的歸零。"""
+    return f"""
+        INSERT IGNORE INTO counter_offsets {RESET_COLUMNS}
+        SELECT %s, timestamp, previous_ts, previous_total, total_watt_hours, previous_total
+        FROM (
+            SELECT timestamp, total_watt_hours,
+                   LAG(timestamp) OVER w AS previous_ts,
+                   LAG(total_watt_hours) OVER w AS previous_total
+            FROM {storage.table_ref(table_name)}
+            WINDOW w AS (ORDER BY timestamp)
+        ) AS readings
+        WHERE total_watt_hours < previous_total - %s
+    """
+
+async def create_schema(conn):
+    async with conn.cursor() as cursor:
+        await cursor.execute(CREATE_TABLE)
+
+async def backfill_table(conn, table_name):
+    async with repository.transaction(conn) as cursor:
+        await cursor.execute(backfill_query(table_name), (table_name, COUNTER_RESET_TOLERANCE))
+        print(f"資料表 '{table_name}' 新增 {cursor.rowcount} 筆歸零紀錄。")
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="建立電表歸零紀錄並回補歷史資料")
+    parser.add_argument("command", choices=["create-schema", "backfill"])
+    parser.add_argument("--tables", nargs="*", default=None, help="要回補的資料表 (預設為全部)")
+    args = parser.parse_args(argv)
+
+    await repository.init_pool()
+    try:
+        async with repository.connection() as conn:
+            if args.command == "create-schema":
+                await create_schema(conn)
+                print("counter_offsets 資料表已建立。")
+                return
+            for table_name in args.tables or devices.registry.names():
+                if table_name not in devices.registry:
+                    raise SystemExit(f"Invalid table name: {table_name}")
+                await backfill_table(conn, table_name)
+    finally:
+        await repository.close_pool()
+
+if __name__ == "__main__":
+    asyncio.run(main())
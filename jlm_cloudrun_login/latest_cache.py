@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import log
+
+logger = log.get_logger(__name__)
+
+def default_cache_path():
+    """預設放在 /dev/shm (記憶體檔案系統)，不存在時改用暫存目錄。"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "jlm_latest_readings.sqlite3")
+
+
+class LatestReadingCache:
+    """
+    每張資料表最新一筆讀數的快取。
+
+    資料存放在記憶體檔案系統上的 SQLite 檔案中，因此 start.sh 以 gunicorn 啟動的
+    多個 worker 會共用同一份快取：任一 worker 寫入新資料後，其他 worker 立即讀得到。
+    每筆快取同時記錄當日 (台灣時間) 第一筆 'total_watt_hours' 與當日電表歸零的 offset 總和，供每日總用電量使用。
+
+    快取項目由資料庫查詢結果建立 (prime)，之後由上傳路由持續更新；
+    建立超過 ttl_seconds 秒後視為過期，會重新向資料庫查詢一次，
+    藉此修正從其他服務 (例如 ESP32 專用服務) 寫入、本服務看不到的資料。
+    """
+
+    def __init__(self, path=None, ttl_seconds=60):
+        self.path = path or default_cache_path()
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        self._execute("""
+            CREATE TABLE IF NOT EXISTS latest_readings (
+                table_name TEXT PRIMARY KEY,
+                reading_ts TEXT,
+                total_watt_hours REAL,
+                watt REAL,
+                pf REAL,
+                day TEXT,
+                day_start_watt_hours REAL,
+                day_offset_watt_hours REAL,
+                primed_at REAL NOT NULL
+            )
+        """)
+        # 舊版建立的快取檔案沒有 day_offset_watt_hours 欄位
+        try:
+            columns = {row["name"] for row in self._connect().execute("PRAGMA table_info(latest_readings)")}
+        except sqlite3.Error:
+            columns = None
+        if columns and "day_offset_watt_hours" not in columns:
+            self._execute("ALTER TABLE latest_readings ADD COLUMN day_offset_watt_hours REAL")
+
+    def _connect(self):
+        # sqlite3 連線不可跨執行緒共用，每個執行緒各自保留一個；
+        # 也不可跨程序共用 (gunicorn --preload 時主程序建立的連線會被 fork 到各 worker)，程序不同時重新連線
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _execute(self, query, args=()):
+        try:
+            self._connect().execute(query, args)
+        except sqlite3.Error as e:
+            logger.warning("寫入最新讀數快取失敗", sample=0.1, error=repr(e))
+
+    def get(self, table_name):
+        """取得未過期的快取項目，沒有或已過期時回傳 None。"""
+        try:
+            row = self._connect().execute(
+                "SELECT * FROM latest_readings WHERE table_name = ?", (table_name,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            # 快取只是加速用，讀取失敗時視為未命中，改查資料庫
+            logger.warning("讀取最新讀數快取失敗", sample=0.1, error=repr(e))
+            return None
+        if row is None or time.time() - row["primed_at"] > self.ttl_seconds:
+            return None
+        return dict(row)
+
+    def prime(self, table_name, latest, day, day_start_watt_hours, day_offset_watt_hours=0):
+        """
+        以資料庫查詢結果建立快取項目。
+        latest 為最新一筆資料 (含 timestamp、total_watt_hours、watt、pf)，資料表沒有資料時為 None；
+        day_start_watt_hours 為當日第一筆 'total_watt_hours'，今日尚無資料時為 None；
+        day_offset_watt_hours 為當日電表歸零的 offset 總和。
+        """
+        latest = latest or {}
+        reading_ts = latest.get("timestamp")
+        self._execute(
+            """
+            INSERT OR REPLACE INTO latest_readings
+            (table_name, reading_ts, total_watt_hours, watt, pf, day, day_start_watt_hours, day_offset_watt_hours, primed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                table_name,
+                reading_ts.strftime('%Y-%m-%d %H:%M:%S') if reading_ts else None,
+                latest.get("total_watt_hours"),
+                latest.get("watt"),
+                latest.get("pf"),
+                day,
+                day_start_watt_hours,
+                day_offset_watt_hours,
+                time.time(),
+            ),
+        )
+
+    def record(self, table_name, reading_ts, total_watt_hours, watt, pf, offset_watt_hours=0):
+        """
+        上傳路由寫入資料庫後呼叫，更新該資料表的最新讀數。
+        只更新已建立的快取項目 (尚未建立者下次查詢時會由資料庫取得)，且忽略比快取更舊的資料；
+        跨日後的第一筆資料即為新一天的起始值。offset_watt_hours 為這次寫入在 reading_ts 當日偵測到的歸零 offset。
+        """
+        ts_str = reading_ts.strftime('%Y-%m-%d %H:%M:%S')
+        day = reading_ts.strftime('%Y-%m-%d')
+        self._execute(
+            """
+            UPDATE latest_readings
+            SET reading_ts = ?,
+                total_watt_hours = ?,
+                watt = ?,
+                pf = ?,
+                day_start_watt_hours = CASE WHEN day = ? AND day_start_watt_hours IS NOT NULL
+                                            THEN day_start_watt_hours ELSE ? END,
+                day_offset_watt_hours = CASE WHEN day = ? THEN COALESCE(day_offset_watt_hours, 0) + ? ELSE ? END,
+                day = ?
+            WHERE table_name = ? AND (reading_ts IS NULL OR reading_ts <= ?)
+            """,
+            (ts_str, total_watt_hours, watt, pf, day, total_watt_hours, day, offset_watt_hours, offset_watt_hours,
+             day, table_name, ts_str),
+        )
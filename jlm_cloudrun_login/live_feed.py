@@ -0,0 +1,219 @@
+import asyncio
+import json
+
+import log
+import metrics
+
+logger = log.get_logger(__name__)
+
+
+class Subscriber:
+    """一個 /api/stream/live 連線：待送出的事件 (已編碼的 SSE bytes) 與是否已因跟不上而被移除。"""
+
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = False
+
+
+# 每張資料表保留的欄位 (與 LatestReadingCache 的欄位相同)
+ENTRY_FIELDS = ("reading_ts", "total_watt_hours", "watt", "pf", "day", "day_start_watt_hours", "day_offset_watt_hours")
+
+
+def encode_event(event, data):
+    """編碼為 SSE 格式；每個事件只序列化一次，再放入所有訂閱者的佇列。"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def rolling_totals(entries, today, allow_negative):
+    """
+    以各資料表的最新讀數計算總覽數據，計算方式與 get_total_latest_kwh、get_total_daily_kwh (lookup 方式) 相同：
+    total_latest_kwh 為最新 'total_watt_hours' 的總和，total_daily_kwh 為 (最新 - 當日第一筆 + 當日歸零 offset) 的總和。
+    allow_negative 為 False 時忽略負的差值 (未啟用歸零紀錄時的電表歸零)。
+    """
+    total_latest = 0
+    total_daily = 0
+    for entry in entries.values():
+        latest_kwh = entry.get("total_watt_hours")
+        if latest_kwh is None:
+            continue
+        total_latest += latest_kwh
+        start_kwh = entry.get("day_start_watt_hours") if entry.get("day") == today else None
+        if start_kwh is not None:
+            difference = latest_kwh - start_kwh + (entry.get("day_offset_watt_hours") or 0)
+            if allow_negative or difference >= 0:
+                total_daily += difference
+    return {"total_latest_kwh": total_latest, "total_daily_kwh": total_daily}
+
+
+class LiveFeed:
+    """
+    即時數據的程序內 pub/sub (每個 worker 各自一份)，供 GET /api/stream/live 推送新讀數與總覽數據。
+
+    上傳路由寫入資料庫後呼叫 publish_reading，事件立即放入所有訂閱者的佇列。
+    每個訂閱者的佇列最多 queue_size 個事件；佇列已滿表示該連線跟不上 (網路慢或分頁在背景)，
+    直接移除該訂閱者並結束其連線，不讓一個慢的連線拖住上傳路由或佔用無上限的記憶體；
+    瀏覽器的 EventSource 會自動重新連線並重新取得 snapshot。
+
+    其他 worker 與 ESP32 專用服務寫入的資料本 worker 看不到，因此有訂閱者時每 refresh_seconds 秒
+    以 loader() (即 load_latest_readings，優先取自共用的最新讀數快取) 重新整理一次並推送有變動的資料表。
+    重新整理只在有訂閱者時進行，且不論連線數多少每個 worker 只做一次，資料庫負載與觀看人數無關。
+    """
+
+    def __init__(self, loader, today, allow_negative, queue_size=64, max_subscribers=500, refresh_seconds=10):
+        self.loader = loader
+        self.today = today
+        self.allow_negative = allow_negative
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.refresh_seconds = refresh_seconds
+        self.subscribers = set()
+        self.entries = None
+        self._prime_lock = asyncio.Lock()
+        self._refresh_task = None
+        self.published = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    async def subscribe(self):
+        """
+        新增訂閱者，回傳 (Subscriber, snapshot 事件)；已達 max_subscribers 時回傳 (None, None)。
+        第一位訂閱者會先以 loader() 載入各資料表的最新讀數，之後的訂閱者直接使用記憶體中的數據。
+        """
+        if len(self.subscribers) >= self.max_subscribers:
+            self.rejected += 1
+            return None, None
+        # 等待載入期間最後一位訂閱者離開時 unsubscribe 會清除 entries，因此加入前再確認一次
+        while self.entries is None:
+            async with self._prime_lock:
+                if self.entries is None:
+                    self.entries = await self._load()
+        subscriber = Subscriber(self.queue_size)
+        self.subscribers.add(subscriber)
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+        return subscriber, encode_event("snapshot", self.snapshot())
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        if not self.subscribers:
+            # 沒有訂閱者時停止重新整理並清除數據，之後的上傳不再需要維護任何狀態
+            if self._refresh_task is not None:
+                self._refresh_task.cancel()
+                self._refresh_task = None
+            self.entries = None
+
+    def snapshot(self):
+        return {
+            "readings": {table_name: self._reading(table_name, entry) for table_name, entry in self.entries.items()},
+            **rolling_totals(self.entries, self.today(), self.allow_negative),
+        }
+
+    @staticmethod
+    def _reading(table_name, entry):
+        return {
+            "table_name": table_name,
+            "timestamp": entry.get("reading_ts"),
+            "total_watt_hours": entry.get("total_watt_hours"),
+            "watt": entry.get("watt"),
+            "pf": entry.get("pf"),
+        }
+
+    def publish_reading(self, table_name, reading_ts, total_watt_hours, watt, pf, offset_watt_hours=0):
+        """
+        上傳路由寫入資料庫後呼叫 (參數與 LatestReadingCache.record 相同)，推送新讀數與更新後的總覽數據。
+        沒有訂閱者時直接返回；比目前數據更舊的資料 (補傳) 不推送。
+        """
+        if not self.subscribers:
+            return
+        ts_str = reading_ts.strftime('%Y-%m-%d %H:%M:%S')
+        day = reading_ts.strftime('%Y-%m-%d')
+        entry = self.entries.get(table_name)
+        if entry is None:
+            # 尚未載入的資料表 (例如剛新增的機器) 由下次重新整理取得
+            return
+        if entry.get("reading_ts") is not None and entry["reading_ts"] > ts_str:
+            return
+        # 與 LatestReadingCache.record 相同：跨日後的第一筆即為新一天的起始值
+        if entry.get("day") == day and entry.get("day_start_watt_hours") is not None:
+            entry["day_offset_watt_hours"] = (entry.get("day_offset_watt_hours") or 0) + offset_watt_hours
+        else:
+            entry["day_start_watt_hours"] = total_watt_hours
+            entry["day_offset_watt_hours"] = offset_watt_hours
+        entry.update({"reading_ts": ts_str, "total_watt_hours": total_watt_hours, "watt": watt, "pf": pf, "day": day})
+        self._publish_changes([table_name])
+
+    async def refresh(self):
+        """以 loader() 重新載入各資料表的最新讀數，推送比目前數據新的資料表。"""
+        entries = await self._load()
+        if self.entries is None:
+            return
+        changed = []
+        for table_name, entry in entries.items():
+            current = self.entries.get(table_name)
+            if current is not None and (current.get("reading_ts") or "") > (entry.get("reading_ts") or ""):
+                # 本 worker 已推送更新的資料 (共用快取稍後才會反映)
+                continue
+            if current != entry:
+                self.entries[table_name] = entry
+                changed.append(table_name)
+        self._publish_changes(changed)
+
+    async def _load(self):
+        entries = await self.loader()
+        return {table_name: {field: entry.get(field) for field in ENTRY_FIELDS} for table_name, entry in entries.items()}
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("重新整理即時數據失敗", error=repr(e))
+
+    def _publish_changes(self, table_names):
+        if not table_names:
+            return
+        # 先編碼所有事件：推送途中移除最後一位訂閱者時 self.entries 會被清除
+        chunks = [encode_event("reading", self._reading(table_name, self.entries[table_name])) for table_name in table_names]
+        chunks.append(encode_event("totals", rolling_totals(self.entries, self.today(), self.allow_negative)))
+        for chunk in chunks:
+            self._fan_out(chunk)
+
+    def _fan_out(self, chunk):
+        self.published += 1
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(chunk)
+            except asyncio.QueueFull:
+                self._drop(subscriber)
+
+    def _drop(self, subscriber):
+        """移除跟不上的訂閱者：清空其佇列並放入 None，送出端讀到 None 時結束連線。"""
+        subscriber.dropped = True
+        self.dropped += 1
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(None)
+        self.unsubscribe(subscriber)
+        logger.info("即時數據連線跟不上，已中斷", sample=0.1, queue_size=self.queue_size)
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "max_subscribers": self.max_subscribers,
+            "queue_size": self.queue_size,
+            "published": self.published,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+        }
+
+    def register_metrics(self):
+        metrics.register_collector(
+            "live_stream_subscribers", "/api/stream/live 的連線數", "gauge", (), lambda: [((), len(self.subscribers))]
+        )
+        metrics.register_collector(
+            "live_stream_disconnects_total", "/api/stream/live 因跟不上而中斷或因連線數已滿而拒絕的次數", "counter",
+            ("reason",), lambda: [(("slow_consumer",), self.dropped), (("rejected",), self.rejected)],
+        )
@@ -0,0 +1,51 @@
+import json
+import os
+import random
+import sys
+
+# 結構化日誌
+# 以 JSON 一行一筆輸出到 stdout，Cloud Run / Cloud Logging 會依 severity 分級並可依欄位篩選。
+# 訊息固定、變動的內容放在欄位中 (例如 table=...)，同類事件可以直接彙總。
+# LOG_LEVEL 設定輸出的最低等級 (DEBUG、INFO、WARNING、ERROR，預設 INFO)；
+# 低於該等級的呼叫在組合任何字串前就返回，關閉時幾乎沒有成本。
+# 高頻率的事件可傳入 sample (0~1)，只輸出該比例的紀錄。
+# 兩個服務使用相同的 log.py。
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+LOG_LEVEL = LEVELS.get(os.environ.get("LOG_LEVEL", "INFO").upper(), LEVELS["INFO"])
+
+
+class Logger:
+    def __init__(self, name):
+        self.name = name
+
+    def _emit(self, severity, message, sample, fields):
+        if sample is not None and random.random() >= sample:
+            return
+        record = {"severity": severity, "message": message, "logger": self.name}
+        if sample is not None:
+            record["sample"] = sample
+        record.update(fields)
+        sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        sys.stdout.flush()
+
+    def debug(self, message, sample=None, **fields):
+        if LEVELS["DEBUG"] >= LOG_LEVEL:
+            self._emit("DEBUG", message, sample, fields)
+
+    def info(self, message, sample=None, **fields):
+        if LEVELS["INFO"] >= LOG_LEVEL:
+            self._emit("INFO", message, sample, fields)
+
+    def warning(self, message, sample=None, **fields):
+        if LEVELS["WARNING"] >= LOG_LEVEL:
+            self._emit("WARNING", message, sample, fields)
+
+    def error(self, message, sample=None, **fields):
+        if LEVELS["ERROR"] >= LOG_LEVEL:
+            self._emit("ERROR", message, sample, fields)
+
+
+def get_logger(name):
+    return Logger(name)
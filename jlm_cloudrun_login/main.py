@@ -1,22 +1,44 @@
 import os
-import mysql.connector
-from fastapi import FastAPI, HTTPException, Query, Depends, status, Request
-from datetime import datetime, timedelta, timezone
+import json
+import time
+import asyncio
+import functools
+from fastapi import FastAPI, HTTPException, Header, Query, Depends, status, Request, Response, Body
+from fastapi.encoders import jsonable_encoder
+from datetime import date, datetime, timedelta, timezone
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List
-from mysql.connector import pooling
-from dateutil.parser import isoparse
 import pytz
 from pydantic import BaseModel
 from typing import Optional
-from passlib.context import CryptContext
 import secrets
 import string
 import hashlib
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+import repository
+import rollups
+import boundaries
+import ingest_guard
+import migrations
+import downsample
+import chart_format
+import export
+import energy
+import storage
+import devices
+from latest_cache import LatestReadingCache
+from response_cache import ResponseCache
+from auth_cache import TokenCache, ProfileCache, make_decoder
+from password_hasher import PasswordHasher, PasswordHasherBusy
+import log
+import metrics
+import startup
+from live_feed import LiveFeed
+import packed
+
+logger = log.get_logger(__name__)
 
 # 建立 FastAPI 應用程式實例
 app = FastAPI()
@@ -25,20 +47,64 @@ app = FastAPI()
 # 當使用者訪問 /static/ 時，會從 'static' 資料夾中尋找對應的檔案
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# 集中管理所有合法的資料表名稱
-VALID_TABLES = [
-    '120型',
-    'sensor_data1',
-    'sensor_data2',
-    '冰水機',
-    '空壓機',
-    '破碎機(220V)',
-    '雕刻機',
-    '攪拌機A'
-]
+# 彙總所有資料表時，同時查詢的資料表數上限 (每張表各佔一個連線)
+FANOUT_CONCURRENCY = int(os.environ.get("FANOUT_CONCURRENCY", "4"))
+
+# 台灣時區，資料表的 timestamp 欄位一律存台灣時間
+TAIWAN_TZ = pytz.timezone('Asia/Taipei')
+
+# 各資料表最新讀數的共用快取 (同一容器內的 gunicorn worker 共用)
+latest_cache = LatestReadingCache(ttl_seconds=int(os.environ.get("LATEST_CACHE_TTL_SECONDS", "60")))
+
+# 查詢結果快取 (每個 worker 各自一份)；區間結束時間早於現在超過 HISTORICAL_SETTLE 才視為不再變動，
+# 保留裝置稍晚上傳資料的空間。ESP32 專用服務寫入的補傳、批次資料無法移除本服務的快取，
+# 因此 HISTORICAL_SETTLE 須大於最長的上傳延遲 (韌體一個週期約 10 分鐘，加上重送與離線補傳)，
+# 已結束區間的快取時間也不宜過長
+response_cache = ResponseCache(
+    max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    live_ttl_seconds=int(os.environ.get("RESPONSE_CACHE_LIVE_TTL_SECONDS", "30")),
+    historical_ttl_seconds=int(os.environ.get("RESPONSE_CACHE_HISTORICAL_TTL_SECONDS", "3600")),
+)
+HISTORICAL_SETTLE = timedelta(seconds=int(os.environ.get("RESPONSE_CACHE_HISTORICAL_SETTLE_SECONDS", "3600")))
+
+# GET /api/stream/live 的即時數據推送 (每個 worker 各自一份)：每個連線最多暫存的事件數、連線數上限、
+# 有連線時重新整理共用快取數據的間隔秒數，以及沒有新數據時送出 keepalive 註解的間隔秒數
+live_feed = LiveFeed(
+    loader=lambda: load_live_entries(),
+    today=lambda: datetime.now(TAIWAN_TZ).strftime('%Y-%m-%d'),
+    allow_negative=ingest_guard.COUNTER_OFFSETS_ENABLED,
+    queue_size=int(os.environ.get("LIVE_STREAM_QUEUE_SIZE", "64")),
+    max_subscribers=int(os.environ.get("LIVE_STREAM_MAX_CLIENTS", "500")),
+    refresh_seconds=float(os.environ.get("LIVE_STREAM_REFRESH_SECONDS", "10")),
+)
+live_feed.register_metrics()
+LIVE_STREAM_KEEPALIVE_SECONDS = float(os.environ.get("LIVE_STREAM_KEEPALIVE_SECONDS", "15"))
+
+# 上傳資料的去重複時間窗 (每個 worker 各自一份)：相同的 Idempotency-Key 或 (device_id, seq) 只寫入一次
+dedup_window = ingest_guard.DedupWindow(
+    max_keys=int(os.environ.get("INGEST_DEDUP_MAX_KEYS", "50000")),
+    ttl_seconds=int(os.environ.get("INGEST_DEDUP_WINDOW_SECONDS", "600")),
+)
+
+# 欄式圖表資料以 timestamp 欄位 (台灣時間) 距此的秒數表示時間
+EPOCH = datetime(1970, 1, 1)
+
+# 批次上傳的筆數上限，以及裝置時間可超前伺服器的容許範圍
+MAX_BATCH_ROWS = 1000
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+
+# 密碼雜湊設定，使用 bcrypt 演算法 (passlib 在第一次登入或註冊時才載入)
+@functools.lru_cache(maxsize=None)
+def password_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-# 密碼雜湊設定，使用 bcrypt 演算法
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt 專用的執行緒池：同時計算數、等待上限與等待逾時 (秒)，超過時回覆 503
+password_hasher = PasswordHasher(
+    max_workers=int(os.environ.get("PASSWORD_HASH_WORKERS", "2")),
+    max_pending=int(os.environ.get("PASSWORD_HASH_MAX_PENDING", "32")),
+    queue_timeout=float(os.environ.get("PASSWORD_HASH_QUEUE_TIMEOUT", "5")),
+)
 
 # JWT 認證設定
 SECRET_KEY = os.environ.get("JWT_SECRET_KEY")
@@ -47,6 +113,14 @@ if not SECRET_KEY:
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# JWT 驗證：JWT_BACKEND 可設為 pyjwt 改用 PyJWT 解碼 (預設為 python-jose)；
+# 驗證過的 token 快取 TOKEN_CACHE_TTL_SECONDS 秒 (不超過 token 本身的 exp)
+decode_token = make_decoder(os.environ.get("JWT_BACKEND", "jose"), SECRET_KEY, ALGORITHM)
+token_cache = TokenCache(max_ttl_seconds=int(os.environ.get("TOKEN_CACHE_TTL_SECONDS", "300")))
+
+# /api/users/me 的使用者資料快取
+profile_cache = ProfileCache(ttl_seconds=int(os.environ.get("PROFILE_CACHE_TTL_SECONDS", "60")))
+
 # OAuth2 設定，定義了 JWT Token 的獲取路徑
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
 
@@ -69,79 +143,236 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 建立資料庫連線池 (省略，與您原有的程式碼相同)
-try:
-    db_user = os.environ.get("DB_USER")
-    db_password = os.environ.get("DB_PASSWORD")
-    db_name = os.environ.get("DB_NAME")
-    db_connection_name = os.environ.get("DB_CONNECTION_NAME")
-    unix_socket_path = f"/cloudsql/{db_connection_name}"
-
-    if not all([db_user, db_password, db_name, db_connection_name]):
-        raise ValueError("Missing one or more database environment variables.")
-
-    db_connection_pool = pooling.MySQLConnectionPool(
-        pool_name="db_pool",
-        pool_size=10,
-        user=db_user,
-        password=db_password,
-        database=db_name,
-        unix_socket=unix_socket_path
-    )
-    print("資料庫連線池已成功建立。")
+# 各路由的回應時間 (GET /metrics)
+app.add_middleware(metrics.MetricsMiddleware)
 
-except Exception as e:
-    print(f"資料庫連線池建立失敗: {e}")
-    db_connection_pool = None
+# 記錄第一個請求的時間 (啟動時間見 GET /api/startup)
+app.add_middleware(startup.FirstRequestMiddleware)
 
-# 資料庫連線函式
-def get_db_connection_from_pool():
-    if db_connection_pool is None:
-        raise HTTPException(status_code=500, detail="資料庫連線池未初始化。")
+# 延後載入的模組 (只有登入、註冊與解析時間參數時才用到)，服務開始接受請求後在背景預先載入
+DEFERRED_IMPORTS = ("passlib.context", "jose.jwt", "dateutil.parser")
+
+# 建立非同步資料庫連線池
+# aiomysql 連線池必須在 event loop 中建立，因此在 startup 事件中開始；
+# 預設 (STARTUP_WARM_UP=background) 不等待連線池建立即開始接受請求，在背景建立連線池並檢查資料庫結構，
+# 第一個需要資料庫的請求若早於背景工作完成，會等待同一個連線池建立 (不會重複建立)
+@app.on_event("startup")
+async def open_db_pool():
+    # 機器登錄表在建立連線池時載入，之後定時重新載入
+    devices.registry.start()
+    if startup.STARTUP_WARM_UP == "blocking":
+        await warm_up()
+    elif startup.STARTUP_WARM_UP == "background":
+        app.state.warm_up_task = asyncio.create_task(warm_up())
+    startup.mark("ready")
+
+async def warm_up():
+    """建立連線池、載入機器登錄表並檢查資料庫結構，同時在執行緒中預先載入 DEFERRED_IMPORTS。"""
+    imports = asyncio.create_task(asyncio.to_thread(startup.warm_imports, DEFERRED_IMPORTS))
     try:
-        return db_connection_pool.get_connection()
+        await repository.init_pool()
+        startup.mark("pool_ready")
+        logger.info("資料庫連線池已成功建立", warm_size=repository.pool_manager.warm_size)
     except Exception as e:
-        print(f"從連線池取得連線失敗: {e}")
-        raise HTTPException(status_code=500, detail="無法從資料庫連線池取得連線。")
+        # 之後的請求會以退避間隔重新建立連線池
+        logger.error("資料庫連線池建立失敗", error=repr(e))
+        await imports
+        return
+
+    # 只檢查並提示，不在啟動時修改資料庫結構 (大資料表新增索引需要時間，應由 migrations.py 執行)
+    try:
+        async with repository.connection() as conn:
+            problems = await migrations.check(conn, devices.registry.names())
+        for problem in problems:
+            logger.warning("資料庫結構檢查", problem=problem)
+        if problems:
+            logger.warning("請執行 `python migrations.py apply` 補上缺少的索引與資料表")
+    except Exception as e:
+        logger.error("資料庫結構檢查失敗", error=repr(e))
+    await imports
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    await devices.registry.stop()
+    await repository.close_pool()
+    password_hasher.shutdown()
 
 # Helper Functions
-def get_password_hash(password):
-    return pwd_context.hash(password)
+# bcrypt 刻意設計為耗費 CPU，放到專用且有上限的執行緒池執行，避免阻塞 event loop 與其他請求
+async def run_password_hasher(fn, *args):
+    try:
+        return await password_hasher.run(fn, *args)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="登入人數過多，請稍後再試", headers={"Retry-After": "1"})
+
+async def get_password_hash(password):
+    return await run_password_hasher(password_context().hash, password)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await run_password_hasher(password_context().verify, plain_password, hashed_password)
 
 def create_access_token(data: dict):
     # 建立一個包含過期時間的 Token
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
+    from jose import jwt
+
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def isoparse(value):
+    """解析 ISO 8601 時間字串 (dateutil 在第一次解析時才載入)。"""
+    from dateutil.parser import isoparse as parse
+
+    return parse(value)
+
+def to_taipei_naive(ts):
+    """將時間轉為不含時區資訊的台灣時間，以符合資料表的 timestamp 欄位。未帶時區者視為台灣時間。"""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(TAIWAN_TZ)
+    return ts.replace(tzinfo=None, microsecond=0)
+
+async def write_readings(rows_by_table):
+    """
+    將依資料表分組的多筆資料與其彙總資料在同一個交易中寫入資料庫 (所有資料表只需一次 commit)，
+    啟用 COUNTER_OFFSETS_ENABLED 時同時記錄新發生的電表歸零。
+    完成後以每張資料表時間最新的一筆更新最新讀數快取並推送給 /api/stream/live，再移除受影響區間的查詢結果快取。
+    """
+    resets = []
+    async with repository.connection() as conn:
+        async with repository.transaction(conn) as cursor:
+            if ingest_guard.COUNTER_OFFSETS_ENABLED:
+                resets = await ingest_guard.record_resets(cursor, rows_by_table)
+            await repository.insert_readings(cursor, rows_by_table)
+            if rollups.ROLLUPS_ENABLED:
+                await rollups.upsert_rollups(cursor, rows_by_table)
+            if boundaries.BOUNDARY_INDEX_ENABLED:
+                await boundaries.upsert_segments(cursor, rows_by_table)
+
+    for table_name, rows in rows_by_table.items():
+        voltage, current, frequency, pf, watt, total_watt_hours, timestamp = max(rows, key=lambda row: row[6])
+        # 當日 (最新一筆的日期) 發生的歸零 offset，計入每日總用電量
+        day_offset = sum(
+            reset[5] for reset in resets if reset[0] == table_name and reset[2].date() == timestamp.date()
+        )
+        latest_cache.record(table_name, timestamp, total_watt_hours, watt, pf, day_offset)
+        live_feed.publish_reading(table_name, timestamp, total_watt_hours, watt, pf, day_offset)
+        response_cache.invalidate(table_name, min(row[6] for row in rows))
+
+async def load_latest_readings(table_names):
+    """
+    取得各資料表的最新讀數、當日 (台灣時間) 第一筆 'total_watt_hours' 與當日電表歸零的 offset 總和。
+    先查共用快取，未命中或已過期的資料表才同時查詢資料庫，並寫回快取；
+    使用單一 readings 資料表時，所有未命中的資料表以一次查詢取得。
+    回傳 ({資料表: 快取項目}, {資料表: 查詢耗時毫秒})。
+    """
+    now = datetime.now(TAIWAN_TZ)
+    today = now.strftime('%Y-%m-%d')
+    start_time_str = f"{today} 00:00:00"
+    entries = {}
+    for table_name in table_names:
+        entry = latest_cache.get(table_name)
+        if entry is not None:
+            entries[table_name] = entry
+
+    timings = {}
+    missing = [table_name for table_name in table_names if table_name not in entries]
+    now_str = now.strftime('%Y-%m-%d %H:%M:%S')
+    if missing and storage.reads_unified():
+        started = time.perf_counter()
+        async with repository.connection() as conn:
+            rows = await repository.fetch_all(conn, *storage.latest_readings_query(start_time_str))
+            day_offsets = {}
+            if ingest_guard.COUNTER_OFFSETS_ENABLED:
+                day_offsets = await ingest_guard.offset_sums_by_table(conn, start_time_str, now_str)
+        timings = {"readings": round((time.perf_counter() - started) * 1000, 2)}
+        rows_by_table = {row['table_name']: row for row in rows}
+        results = {}
+        for table_name in missing:
+            row = rows_by_table.get(table_name)
+            latest = row if row and row['timestamp'] is not None else None
+            results[table_name] = (latest, row['day_start_watt_hours'] if row else None, day_offsets.get(table_name, 0))
+    elif missing:
+        async def query_table(conn, table_name):
+            latest = await repository.latest_reading(conn, table_name)
+            if boundaries.BOUNDARY_INDEX_ENABLED:
+                day_start_kwh = await boundaries.first_total_watt_hours_at_or_after(conn, table_name, start_time_str)
+            else:
+                day_start_kwh = await repository.first_total_watt_hours_at_or_after(conn, table_name, start_time_str)
+            day_offset = 0
+            if ingest_guard.COUNTER_OFFSETS_ENABLED:
+                day_offset = await ingest_guard.offset_sum(conn, table_name, start_time_str, now_str)
+            return latest, day_start_kwh, day_offset
+
+        results, timings = await repository.fan_out(missing, query_table, FANOUT_CONCURRENCY)
+    if missing:
+        for table_name, (latest, day_start_kwh, day_offset) in results.items():
+            latest_cache.prime(table_name, latest, today, day_start_kwh, day_offset)
+            entries[table_name] = {
+                "reading_ts": latest['timestamp'].strftime('%Y-%m-%d %H:%M:%S') if latest else None,
+                "total_watt_hours": latest['total_watt_hours'] if latest else None,
+                "watt": latest['watt'] if latest else None,
+                "pf": latest['pf'] if latest else None,
+                "day": today,
+                "day_start_watt_hours": day_start_kwh,
+                "day_offset_watt_hours": day_offset
+            }
+    return entries, timings
+
+async def load_live_entries():
+    """live_feed 的資料來源：所有啟用中機器的最新讀數 (與總覽路由相同，優先取自共用快取)。"""
+    entries, _ = await load_latest_readings(devices.registry.names())
+    return entries
+
+async def cached_response(request, key, table_name, end_time, compute):
+    """
+    以 response_cache 回應查詢：命中時直接回傳已序列化的結果，未命中時 await compute() 計算並存入
+    (compute 拋出的 HTTPException 不會被快取)。end_time 為帶時區的區間結束時間。
+    回應附上 ETag 與 Cache-Control，瀏覽器帶 If-None-Match 且內容未變時回傳 304。
+    """
+    entry = response_cache.get(key)
+    if entry is None:
+        result = await compute()
+        body = json.dumps(jsonable_encoder(result), ensure_ascii=False).encode("utf-8")
+        historical = end_time <= datetime.now(TAIWAN_TZ) - HISTORICAL_SETTLE
+        entry = response_cache.put(key, table_name, to_taipei_naive(end_time), body, historical)
+
+    headers = {"ETag": entry["etag"], "Cache-Control": f"private, max-age={response_cache.max_age(entry)}"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if entry["etag"] in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
+
 def generate_random_token():
     return ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(64))
 
 # JWT 核心驗證函式
-def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(token: str = Depends(oauth2_scheme)):
     """
     此函式由 FastAPI 自動調用，從請求的 Authorization Header 中解析並驗證 JWT Token。
     如果 Token 無效或過期，它會自動拋出 HTTPException，並回傳 401 Unauthorized 狀態碼。
+    同一個 token 驗證成功後會被快取，之後的請求不必重新驗證簽章。
+    (以 async 定義，直接在 event loop 中執行，不必為了查快取而切換到執行緒池)
     """
+    return verify_token(token)["sub"]
+
+def verify_token(token):
+    """驗證 JWT Token 並回傳其內容 (payload)，無效或過期時拋出 401。"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        # 解碼 Token，如果解碼失敗 (例如簽名無效)，會拋出 JWTError
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
-    except JWTError:
+    payload = token_cache.get(token) if token else None
+    if payload is None and token:
+        # 解碼 Token，解碼失敗 (例如簽名無效或已過期) 時回傳 None
+        payload = decode_token(token)
+        if payload is not None:
+            token_cache.put(token, payload)
+    if payload is None or payload.get("sub") is None:
         raise credentials_exception
-    return user_id
+    return payload
 
 # Pydantic Models (省略，與您原有的程式碼相同)
 # 請將此段程式碼新增到 main.py 的 Pydantic Models 區塊
@@ -153,6 +384,34 @@ class SensorData(BaseModel):
     pf: float
     watt: float
     total_watt_hours: float
+    # 去重複用：裝置識別碼與每次上傳遞增的序號，重送時沿用相同的序號
+    device_id: Optional[str] = None
+    seq: Optional[int] = None
+
+class SensorReading(SensorData):
+    # 裝置端的量測時間；未提供時以伺服器接收時間為準
+    timestamp: Optional[datetime] = None
+
+class SensorBatch(BaseModel):
+    readings: List[SensorReading]
+
+class EnergyRange(BaseModel):
+    # 指定 start/end，或指定 shift (day_shift / night_shift / since_morning) 與可選的 day
+    table_name: str
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    shift: Optional[str] = None
+    day: Optional[date] = None
+
+class EnergyQuery(BaseModel):
+    ranges: List[EnergyRange]
+
+class DeviceIn(BaseModel):
+    name: str
+    # 額定功率 (kW) 與碳排係數 (kgCO2e/kWh)，未知時為 None
+    rated_power_kw: Optional[float] = None
+    co2e_kg_per_kwh: Optional[float] = None
+    active: bool = True
 
 class UserCreate(BaseModel):
     employee_name: str
@@ -178,77 +437,62 @@ class User(BaseModel):
 
 # API Route to get current user info
 @app.get("/api/users/me", response_model=User)
-def read_users_me(user_id: int = Depends(get_current_user)):
+async def read_users_me(user_id: int = Depends(get_current_user)):
     """
     根據 JWT Token 獲取當前登入者的資訊。
+    使用者資料短時間內不會改變，快取 PROFILE_CACHE_TTL_SECONDS 秒，不必每次查詢 employees。
     """
-    conn = None
-    cursor = None
+    user = profile_cache.get(user_id)
+    if user is not None:
+        return user
     try:
-        conn = get_db_connection_from_pool()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id, employee_name, account FROM employees WHERE id = %s", (user_id,))
-        user = cursor.fetchone()
+        async with repository.connection() as conn:
+            user = await repository.get_employee_by_id(conn, user_id)
         if user is None:
             raise HTTPException(status_code=404, detail="找不到使用者")
+        profile_cache.put(user_id, user)
         return user
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"獲取使用者資訊時發生錯誤: {e}")
+        logger.error("獲取使用者資訊時發生錯誤", error=repr(e))
         raise HTTPException(status_code=500, detail="無法獲取使用者資訊")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
 
 @app.post("/api/register")
-def register_user(user: UserCreate):
+async def register_user(user: UserCreate):
     """
     建立新會員帳號。
     """
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection_from_pool()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM employees WHERE account = %s", (user.account,))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="此帳號已存在")
+        async with repository.connection() as conn:
+            if await repository.get_employee_id(conn, user.account) is not None:
+                raise HTTPException(status_code=400, detail="此帳號已存在")
+        # 不在 bcrypt 計算期間佔用連線
         salt = secrets.token_hex(16)
-        password_hash = get_password_hash(user.password + salt)
-        query = "INSERT INTO employees (employee_name, account, password_hash, salt, created_at) VALUES (%s, %s, %s, %s, NOW())"
-        values = (user.employee_name, user.account, password_hash, salt)
-        cursor.execute(query, values)
-        conn.commit()
+        password_hash = await get_password_hash(user.password + salt)
+        async with repository.connection() as conn:
+            await repository.create_employee(conn, user.employee_name, user.account, password_hash, salt)
         return {"message": "會員註冊成功"}
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"註冊時發生錯誤: {e}")
+        logger.error("註冊時發生錯誤", error=repr(e))
         raise HTTPException(status_code=500, detail="註冊失敗，請稍後再試")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
 
 @app.post("/api/login")
-def login_for_access_token(user_data: UserLogin):
+async def login_for_access_token(user_data: UserLogin):
     """
     驗證使用者帳號和密碼。若成功則回傳 JWT token。
     此路由不再設定 session，因為我們改用 JWT 認證。
     """
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection_from_pool()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id, password_hash, salt FROM employees WHERE account = %s", (user_data.account,))
-        user = cursor.fetchone()
+        # 查詢完畢即歸還連線，不在 bcrypt 驗證期間佔用連線
+        async with repository.connection() as conn:
+            user = await repository.get_employee_credentials(conn, user_data.account)
         if not user:
             raise HTTPException(status_code=400, detail="帳號或密碼不正確")
         password_with_salt = user_data.password + user['salt']
-        if not verify_password(password_with_salt, user['password_hash']):
+        if not await verify_password(password_with_salt, user['password_hash']):
             raise HTTPException(status_code=400, detail="帳號或密碼不正確")
         
         # 建立 JWT Token，其中 'sub' (subject) 欄位通常用來存放使用者 ID
@@ -259,86 +503,56 @@ def login_for_access_token(user_data: UserLogin):
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"登入時發生錯誤: {e}")
+        logger.error("登入時發生錯誤", error=repr(e))
         raise HTTPException(status_code=500, detail="登入失敗，請稍後再試")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
 
 @app.post("/api/forgot_password")
-def forgot_password(reset_request: PasswordResetRequest):
+async def forgot_password(reset_request: PasswordResetRequest):
     """
     處理忘記密碼請求 (省略，與您原有的程式碼相同)
     """
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection_from_pool()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id FROM employees WHERE account = %s", (reset_request.account,))
-        user = cursor.fetchone()
-        if not user:
-            raise HTTPException(status_code=404, detail="找不到此帳號")
-        employee_id = user['id']
-        token = generate_random_token()
-        expires_at = datetime.utcnow() + timedelta(hours=1)
-        cursor.execute("DELETE FROM password_resets WHERE employee_id = %s", (employee_id,))
-        query = "INSERT INTO password_resets (employee_id, token, expires_at) VALUES (%s, %s, %s)"
-        cursor.execute(query, (employee_id, token, expires_at))
-        conn.commit()
-        print(f"請使用此 token 重設密碼: {token}")
+        async with repository.connection() as conn:
+            employee_id = await repository.get_employee_id(conn, reset_request.account)
+            if employee_id is None:
+                raise HTTPException(status_code=404, detail="找不到此帳號")
+            token = generate_random_token()
+            expires_at = datetime.utcnow() + timedelta(hours=1)
+            await repository.replace_password_reset_token(conn, employee_id, token, expires_at)
+        logger.info("請使用此 token 重設密碼", token=token)
         return {"message": "密碼重設連結已發送 (請查看控制台的 token)。", "token": token}
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"忘記密碼時發生錯誤: {e}")
+        logger.error("忘記密碼時發生錯誤", error=repr(e))
         raise HTTPException(status_code=500, detail="處理請求時發生錯誤")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
 
 @app.post("/api/reset_password")
-def reset_password(reset_data: PasswordReset):
+async def reset_password(reset_data: PasswordReset):
     """
     使用 token 驗證並重設密碼 (省略，與您原有的程式碼相同)
     """
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection_from_pool()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT employee_id FROM password_resets WHERE token = %s AND expires_at > NOW()", (reset_data.token,))
-        result = cursor.fetchone()
+        async with repository.connection() as conn:
+            result = await repository.get_password_reset(conn, reset_data.token)
         if not result:
             raise HTTPException(status_code=400, detail="無效或過期的 token")
         employee_id = result['employee_id']
         salt = secrets.token_hex(16)
-        password_hash = get_password_hash(reset_data.new_password + salt)
-        update_query = "UPDATE employees SET password_hash = %s, salt = %s WHERE id = %s"
-        cursor.execute(update_query, (password_hash, salt, employee_id))
-        delete_query = "DELETE FROM password_resets WHERE employee_id = %s"
-        cursor.execute(delete_query, (employee_id,))
-        conn.commit()
+        password_hash = await get_password_hash(reset_data.new_password + salt)
+        async with repository.connection() as conn:
+            await repository.update_password(conn, employee_id, password_hash, salt)
         return {"message": "密碼重設成功"}
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"重設密碼時發生錯誤: {e}")
+        logger.error("重設密碼時發生錯誤", error=repr(e))
         raise HTTPException(status_code=500, detail="重設密碼失敗")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
 
 # 這是一個受保護的路由，需要 JWT Token 才能存取。
 # Depends(get_current_user) 會自動從請求中驗證 Token，並將解析後的使用者 ID 傳入函式。
 @app.get("/api/protected")
-def protected_route(user_id: int = Depends(get_current_user)):
+async def protected_route(user_id: int = Depends(get_current_user)):
     """
     一個需要認證才能存取的保護路由。
     """
@@ -351,130 +565,239 @@ def redirect_to_login():
 
 # 以下為原本的程式碼，請依序複製貼上
 # 修正後的 get_total_watt_hours_difference 函式
-def get_total_watt_hours_difference(start_time, end_time, table_name):
+async def get_total_watt_hours_difference(start_time, end_time, table_name):
     """
-    計算指定時間區間內 'total_watt_hours' 的差值。
-    此版本接收帶有時區的 datetime 物件，並將其格式化為字串進行查詢。
+    計算指定時間區間內的用電量 ('total_watt_hours' 的差值，電表歸零已處理)。
+    此版本接收帶有時區的 datetime 物件；計算方式見 energy.compute。
     """
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection_from_pool()
-        cursor = conn.cursor(dictionary=True)
-        
-        # --- 修正處：將傳入的 datetime 物件格式化為查詢字串 ---
-        # 這樣可以確保傳遞給資料庫的格式永遠是正確的
-        start_time_str = start_time.strftime('%Y-%m-%d %H:%M:%S')
-        end_time_str = end_time.strftime('%Y-%m-%d %H:%M:%S')
-        # --- 修正結束 ---
-
-        # 取得開始時間區間的第一筆 'total_watt_hours'
-        query_start = f"SELECT total_watt_hours FROM `{table_name}` WHERE timestamp >= %s ORDER BY timestamp ASC LIMIT 1"
-        cursor.execute(query_start, (start_time_str,))
-        start_watt_hours = cursor.fetchone()
-
-        # 取得結束時間區間的最後一筆 'total_watt_hours'
-        query_end = f"SELECT total_watt_hours FROM `{table_name}` WHERE timestamp <= %s ORDER BY timestamp DESC LIMIT 1"
-        cursor.execute(query_end, (end_time_str,))
-        end_watt_hours = cursor.fetchone()
-        
-        if start_watt_hours and end_watt_hours:
-            difference = end_watt_hours['total_watt_hours'] - start_watt_hours['total_watt_hours']
-            return difference
-        return None
+        async with repository.connection() as conn:
+            results = await energy.compute(conn, [(table_name, start_time, end_time)])
+        return results[0]["kilo_watt_hours"]
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"計算瓦特小時差值時發生錯誤: {e}")
+        logger.error("計算瓦特小時差值時發生錯誤", error=repr(e))
         raise HTTPException(status_code=500, detail="計算瓦特小時時發生錯誤")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
+
+async def accepts_uploads(table_name):
+    """上傳資料的機器必須已登錄且啟用中；名稱未登錄時會 (有間隔地) 重新載入登錄表確認一次。"""
+    device = await devices.registry.resolve(table_name)
+    return device is not None and device["active"]
 
 # 新增 API 路由
 @app.post("/api/upload_data")
-def upload_sensor_data(data: SensorData):
+async def upload_sensor_data(data: SensorData, idempotency_key: Optional[str] = Header(None)):
     """
     接收 ESP32 上傳的感測器資料，並將其寫入指定的資料表。
+    帶有 Idempotency-Key 標頭或 (device_id, seq) 的重送資料只寫入一次，重複者回應 duplicate: true。
     """
     # 確保傳入的資料表名稱是合法的，以避免 SQL 注入
-    if data.table_name not in VALID_TABLES:
+    if not await accepts_uploads(data.table_name):
         raise HTTPException(status_code=400, detail=f"Invalid table name: {data.table_name}")
+    error = ingest_guard.validate_reading(data)
+    if error:
+        raise HTTPException(status_code=422, detail=f"資料不合理: {error}")
+
+    key = ingest_guard.idempotency_key(idempotency_key, data.device_id, data.seq)
+    if key is not None and dedup_window.seen(key):
+        return {"message": f"Duplicate data ignored for {data.table_name}", "duplicate": True}
     
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection_from_pool()
-        cursor = conn.cursor()
-        
         # 使用參數化查詢，防止 SQL 注入攻擊
         # 資料庫中的 timestamp 欄位應為 datetime 類型
-        # FastAPI 後端負責處理 NOW() 的部分，不需要 ESP32 傳入
-        query = f"""
-            INSERT INTO `{data.table_name}` 
-            (voltage, current, frequency, pf, watt, total_watt_hours, timestamp)
-            VALUES (%s, %s, %s, %s, %s, %s, CONVERT_TZ(NOW(),'UTC','Asia/Taipei'))
-        """
-        
-        # 參數化查詢的資料
+        # FastAPI 後端負責產生台灣時間，不需要 ESP32 傳入
         values = (
             data.voltage, 
             data.current, 
             data.frequency, 
             data.pf, 
             data.watt, 
-            data.total_watt_hours
+            data.total_watt_hours,
+            to_taipei_naive(datetime.now(TAIWAN_TZ))
         )
         
-        cursor.execute(query, values)
-        conn.commit()
+        await write_readings({data.table_name: [values]})
         
         return {"message": f"Data successfully inserted into {data.table_name}"}
         
     except Exception as e:
+        # 寫入失敗時裝置會重送，key 不可留在時間窗中
+        if key is not None:
+            dedup_window.forget(key)
+        # 連線池忙碌 (503 與 Retry-After) 等 HTTPException 原樣回應，讓裝置稍後重送
+        if isinstance(e, HTTPException):
+            raise e
         # 在終端機印出詳細錯誤訊息，方便除錯
-        print(f"寫入資料庫時發生錯誤: {e}")
+        logger.error("寫入資料庫時發生錯誤", error=repr(e))
         raise HTTPException(status_code=500, detail="寫入資料庫失敗")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
 
+@app.post("/api/upload_batch")
+async def upload_sensor_batch(batch: SensorBatch, idempotency_key: Optional[str] = Header(None)):
+    """
+    接收多筆感測器資料 (可跨多張資料表)，依資料表分組後各以一次 executemany 寫入，
+    並在同一個交易中 commit。回傳每一筆資料是否被接受。
+    重送的資料 (整批相同的 Idempotency-Key，或相同的 device_id 與 seq) 視為已接受但不再寫入，標示 duplicate: true。
+    """
+    if not batch.readings:
+        raise HTTPException(status_code=400, detail="readings 不可為空")
+    if len(batch.readings) > MAX_BATCH_ROWS:
+        raise HTTPException(status_code=413, detail=f"單次批次最多 {MAX_BATCH_ROWS} 筆資料")
+
+    received_at = to_taipei_naive(datetime.now(TAIWAN_TZ))
+    latest_allowed = received_at + MAX_CLOCK_SKEW
+    results = []
+    rows_by_table = {}
+    keys = []
+
+    for index, reading in enumerate(batch.readings):
+        # 逐筆驗證資料表名稱，不合法者只拒絕該筆，不影響其他資料
+        if not await accepts_uploads(reading.table_name):
+            results.append({"index": index, "accepted": False, "error": f"Invalid table name: {reading.table_name}"})
+            continue
+        timestamp = to_taipei_naive(reading.timestamp) if reading.timestamp else received_at
+        if timestamp > latest_allowed:
+            results.append({"index": index, "accepted": False, "error": "timestamp is in the future"})
+            continue
+        error = ingest_guard.validate_reading(reading)
+        if error:
+            results.append({"index": index, "accepted": False, "error": error})
+            continue
+        key = ingest_guard.idempotency_key(
+            f"{idempotency_key}:{index}" if idempotency_key else None, reading.device_id, reading.seq
+        )
+        if key is not None:
+            if dedup_window.seen(key):
+                results.append({"index": index, "accepted": True, "duplicate": True})
+                continue
+            keys.append(key)
+        rows_by_table.setdefault(reading.table_name, []).append((
+            reading.voltage,
+            reading.current,
+            reading.frequency,
+            reading.pf,
+            reading.watt,
+            reading.total_watt_hours,
+            timestamp
+        ))
+        results.append({"index": index, "accepted": True})
+
+    if rows_by_table:
+        try:
+            # 所有資料表在同一個交易中 commit，只需一次 fsync
+            await write_readings(rows_by_table)
+        except Exception as e:
+            # 寫入失敗時裝置會整批重送，這批的 key 不可留在時間窗中
+            for key in keys:
+                dedup_window.forget(key)
+            if isinstance(e, HTTPException):
+                raise e
+            logger.error("批次寫入資料庫時發生錯誤", error=repr(e))
+            raise HTTPException(status_code=500, detail="批次寫入資料庫失敗")
+
+    accepted = sum(1 for result in results if result["accepted"])
+    return {
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+        "duplicates": sum(1 for result in results if result.get("duplicate")),
+        "results": results
+    }
+
+@app.post("/api/upload_packed")
+async def upload_packed_readings(body: bytes = Body(..., media_type=packed.CONTENT_TYPE)):
+    """
+    接收 packed.py 格式的二進位 frame (Content-Type: application/octet-stream)，每筆以 device_id 指定機器，
+    驗證與寫入方式與 /api/upload_batch 相同，以 (MAC, seq) 去重複 (與 JSON 上傳的 (device_id, seq) 相同)。
+    為了讓回應也保持精簡，只列出未被接受的紀錄 (errors)。
+    """
+    try:
+        mac, records = packed.decode(body, MAX_BATCH_ROWS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"frame 格式錯誤: {e}")
+    # device_id 只能以 devices 資料表對應，不可依預設列表的順序猜測 (寫錯資料表也不會有任何錯誤)
+    if not await devices.registry.has_device_ids():
+        raise HTTPException(
+            status_code=503, detail="機器登錄表尚未由 devices 資料表載入，無法以 device_id 對應機器",
+            headers={"Retry-After": "60"}
+        )
+
+    received_at = to_taipei_naive(datetime.now(TAIWAN_TZ))
+    latest_allowed = received_at + MAX_CLOCK_SKEW
+    errors = []
+    rows_by_table = {}
+    keys = []
+    count = 0
+    duplicates = 0
+
+    for index, record in enumerate(records):
+        count += 1
+        device = await devices.registry.resolve_id(record.device_id)
+        if device is None or not device["active"]:
+            errors.append({"index": index, "error": f"Invalid device_id: {record.device_id}"})
+            continue
+        # timestamp 為 UTC epoch 秒，0 表示以伺服器接收時間為準
+        timestamp = (
+            to_taipei_naive(datetime.fromtimestamp(record.timestamp, timezone.utc)) if record.timestamp else received_at
+        )
+        if timestamp > latest_allowed:
+            errors.append({"index": index, "error": "timestamp is in the future"})
+            continue
+        error = ingest_guard.validate_reading(record)
+        if error:
+            errors.append({"index": index, "error": error})
+            continue
+        key = ingest_guard.idempotency_key(None, mac, record.seq)
+        if dedup_window.seen(key):
+            duplicates += 1
+            continue
+        keys.append(key)
+        rows_by_table.setdefault(device["name"], []).append((
+            record.voltage,
+            record.current,
+            record.frequency,
+            record.pf,
+            record.watt,
+            record.total_watt_hours,
+            timestamp
+        ))
+
+    if rows_by_table:
+        try:
+            await write_readings(rows_by_table)
+        except Exception as e:
+            # 寫入失敗時裝置會整個 frame 重送，這些 key 不可留在時間窗中
+            for key in keys:
+                dedup_window.forget(key)
+            if isinstance(e, HTTPException):
+                raise e
+            logger.error("二進位批次寫入資料庫時發生錯誤", rows=count, error=repr(e))
+            raise HTTPException(status_code=500, detail="批次寫入資料庫失敗")
 
+    return {
+        "accepted": count - len(errors),
+        "rejected": len(errors),
+        "duplicates": duplicates,
+        "errors": errors
+    }
 
 # API 路由
 @app.get("/api/get_tables", response_model=List[str])
-def get_tables(user_id: int = Depends(get_current_user)):
-    """從資料庫回傳所有合法的資料表名稱列表。"""
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection_from_pool()
-        cursor = conn.cursor()
-        cursor.execute("SHOW TABLES")
-        tables = [table[0] for table in cursor.fetchall()]
-        return tables
-    except HTTPException as e:
-        raise e
-    except Exception as e:
-        print(f"從資料庫取得資料表時發生錯誤: {e}")
-        raise HTTPException(status_code=500, detail="無法從資料庫取得資料表清單")
-    finally:
-        if 'conn' in locals() and conn.is_connected():
-            cursor.close()
-            conn.close()
+async def get_tables(user_id: int = Depends(get_current_user)):
+    """回傳啟用中的機器 (資料表) 名稱列表，由記憶體中的機器登錄表取得，不查詢資料庫。"""
+    return devices.registry.names()
 
 @app.get("/api/get_total_daily_kwh")
-def get_total_daily_kwh(user_id: int = Depends(get_current_user)):
+async def get_total_daily_kwh(debug: bool = False, user_id: int = Depends(get_current_user)):
     """
     計算從今天凌晨 00:00:00 到現在所有合法資料表總用電量的總和。
     此函數會查詢每個資料表在 08:00:00 後的第一筆數據，並與最新一筆數據做差值計算，
     最後將所有差值加總，以顯示當日的總耗電量。
+    scan 方式 (見 energy.compute) 以一次查詢取回所有資料表今天的讀數並逐筆計算 (含電表歸零)；
+    lookup 方式的數據優先取自最新讀數快取，未命中的資料表才以獨立連線同時查詢；
+    debug=true 時會附上查詢耗時。
     """
-    conn = None
-    cursor = None
     total_kwh_sum = 0
+    table_names = devices.registry.names()
     
     try:
         # 修正時區問題，明確設定為台灣時間
@@ -489,81 +812,75 @@ def get_total_daily_kwh(user_id: int = Depends(get_current_user)):
         if now_taipei < start_time_today_taipei:
             return {"total_kwh": 0}
             
-        # 將台灣時間的 00:00 轉換為 UTC，並移除時區資訊，以匹配資料庫的時間戳記
-        start_time_str = start_time_today_taipei.strftime('%Y-%m-%d %H:%M:%S')
-            
-        conn = get_db_connection_from_pool()
-        cursor = conn.cursor(dictionary=True)
-        
-        for table_name in VALID_TABLES:
-            # 查詢 00:00:00 後的第一筆數據 (當日開工數據)
-            query_start = f"SELECT total_watt_hours FROM `{table_name}` WHERE timestamp >= %s ORDER BY timestamp ASC LIMIT 1"
-            cursor.execute(query_start, (start_time_str,))
-            result_start = cursor.fetchone()
-            
-            # 查詢最新一筆數據 (當前數據)
-            query_latest = f"SELECT total_watt_hours FROM `{table_name}` ORDER BY timestamp DESC LIMIT 1"
-            cursor.execute(query_latest)
-            result_latest = cursor.fetchone()
-            
-            # 如果兩筆數據都存在，才進行差值計算
-            if result_start and result_latest:
-                start_kwh = result_start['total_watt_hours']
-                latest_kwh = result_latest['total_watt_hours']
-                
-                # 確保最新數據不小於起始數據，以避免電表重置等問題
-                if latest_kwh >= start_kwh:
-                    total_kwh_sum += (latest_kwh - start_kwh)
+        if energy.method() == "scan":
+            started = time.perf_counter()
+            async with repository.connection() as conn:
+                totals = await energy.compute(
+                    conn, [(table_name, start_time_today_taipei, now_taipei) for table_name in table_names]
+                )
+            timings = {"scan": round((time.perf_counter() - started) * 1000, 2)}
+            for table_name, total in zip(table_names, totals):
+                if total["kilo_watt_hours"] is not None:
+                    total_kwh_sum += total["kilo_watt_hours"]
                 else:
-                    print(f"警告：資料表 '{table_name}' 的最新數據 ({latest_kwh}) 小於起始數據 ({start_kwh})，已忽略此差值。")
+                    logger.info("資料表今日沒有足夠數據可供計算", table=table_name)
+            if debug:
+                return {"total_kwh": total_kwh_sum, "timings_ms": timings}
+            return {"total_kwh": total_kwh_sum}
+
+        today = start_time_today_taipei.strftime('%Y-%m-%d')
+        # 每張資料表的當日第一筆數據 (當日開工數據) 與最新一筆數據 (當前數據)
+        entries, timings = await load_latest_readings(table_names)
+
+        for table_name in table_names:
+            entry = entries[table_name]
+            start_kwh = entry['day_start_watt_hours'] if entry['day'] == today else None
+            latest_kwh = entry['total_watt_hours']
+            # 如果兩筆數據都存在，才進行差值計算
+            if start_kwh is not None and latest_kwh is not None:
+                # 電表歸零已由寫入時記錄的 offset 補上 (預設的 auto 只在啟用 COUNTER_OFFSETS_ENABLED 時使用 lookup)
+                total_kwh_sum += latest_kwh - start_kwh + (entry.get('day_offset_watt_hours') or 0)
             else:
                 # 如果缺少任何一筆數據，表示今日無足夠資料進行計算
-                print(f"資訊：資料表 '{table_name}' 今日沒有足夠數據可供計算。")
+                logger.info("資料表今日沒有足夠數據可供計算", table=table_name)
 
+        if debug:
+            return {"total_kwh": total_kwh_sum, "timings_ms": timings}
         return {"total_kwh": total_kwh_sum}
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"取得所有表格每日總用電量時發生錯誤: {e}")
+        logger.error("取得所有表格每日總用電量時發生錯誤", error=repr(e))
         raise HTTPException(status_code=500, detail="無法取得每日總用電量數據")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
 
 
 @app.get("/api/get_total_latest_kwh")
-def get_total_latest_kwh(user_id: int = Depends(get_current_user)):
-    """取得所有合法資料表最新一筆 'total_watt_hours' 的總和，不進行單位轉換。"""
-    conn = None
-    cursor = None
+async def get_total_latest_kwh(debug: bool = False, user_id: int = Depends(get_current_user)):
+    """
+    取得所有合法資料表最新一筆 'total_watt_hours' 的總和，不進行單位轉換。
+    數據優先取自最新讀數快取，未命中的資料表才以獨立連線同時查詢；
+    debug=true 時會附上每張資料表的查詢耗時。
+    """
     total_kwh_sum = 0
     try:
-        conn = get_db_connection_from_pool()
-        cursor = conn.cursor(dictionary=True)
-        for table_name in VALID_TABLES:
-            query = f"SELECT total_watt_hours FROM `{table_name}` ORDER BY timestamp DESC LIMIT 1"
-            cursor.execute(query)
-            result = cursor.fetchone()
-            if result and 'total_watt_hours' in result:
-                total_kwh_sum += result['total_watt_hours']
+        entries, timings = await load_latest_readings(devices.registry.names())
+        for entry in entries.values():
+            latest_kwh = entry['total_watt_hours']
+            if latest_kwh is not None:
+                total_kwh_sum += latest_kwh
         
+        if debug:
+            return {"total_kwh": total_kwh_sum, "timings_ms": timings}
         return {"total_kwh": total_kwh_sum} # 移除 / 1000
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"取得所有表格最新數據時發生錯誤: {e}")
+        logger.error("取得所有表格最新數據時發生錯誤", error=repr(e))
         raise HTTPException(status_code=500, detail="無法取得總耗能數據")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
 
 @app.get("/api/get_watt_hours/custom/{table_name}")
-def get_custom_watt_hours(table_name: str, start_iso: str, end_iso: str, user_id: int = Depends(get_current_user)):
-    if table_name not in VALID_TABLES:
+async def get_custom_watt_hours(request: Request, table_name: str, start_iso: str, end_iso: str, user_id: int = Depends(get_current_user)):
+    if table_name not in devices.registry:
         raise HTTPException(status_code=400, detail=f"Invalid table name: {table_name}")
         
     try:
@@ -576,32 +893,50 @@ def get_custom_watt_hours(table_name: str, start_iso: str, end_iso: str, user_id
     except ValueError:
         raise HTTPException(status_code=400, detail="時間格式不正確，請使用 ISO 8601 格式。")
         
-    # 將轉換後的台灣時間傳遞給底層函式
-    kwh = get_total_watt_hours_difference(start_time_tw, end_time_tw, table_name)
-    
-    if kwh is None:
-        raise HTTPException(status_code=404, detail="找不到指定時間範圍內的資料")
-        
-    return {"kilo_watt_hours": kwh}
+    return await watt_hours_response(request, start_time_tw.replace(microsecond=0), end_time_tw.replace(microsecond=0), table_name)
+
+async def watt_hours_response(request, start_time, end_time, table_name):
+    """自訂區間與班別用電量共用的回應 (相同區間共用同一個快取項目)。"""
+    async def compute():
+        # 將轉換後的台灣時間傳遞給底層函式
+        kwh = await get_total_watt_hours_difference(start_time, end_time, table_name)
+        if kwh is None:
+            raise HTTPException(status_code=404, detail="找不到指定時間範圍內的資料")
+        return {"kilo_watt_hours": kwh}
+
+    key = ("watt_hours", table_name, start_time.strftime('%Y-%m-%d %H:%M:%S'), end_time.strftime('%Y-%m-%d %H:%M:%S'))
+    return await cached_response(request, key, table_name, end_time, compute)
 
 @app.get("/api/get_chart_data")
-async def get_chart_data(table_name: str, start_iso: str, end_iso: str, user_id: int = Depends(get_current_user)):
+async def get_chart_data(
+    request: Request,
+    table_name: str,
+    start_iso: str,
+    end_iso: str,
+    resolution: str = "raw",
+    max_points: Optional[int] = Query(None, ge=3, le=20000),
+    bucket: str = "lttb",
+    layout: str = "rows",
+    user_id: int = Depends(get_current_user)
+):
     """
     根據時間範圍和資料表名稱，取得即時用電數據。
-    (此版本包含偵錯用的 print 語句)
+    resolution 可為 raw (原始資料)、minute、hour、day，或 auto (依時間範圍自動選擇最粗的彙總資料)；
+    未啟用彙總資料表時一律回傳原始資料。
+    指定 max_points 時，資料點超過此數量會在伺服器端降採樣，bucket 為降採樣方式：
+    lttb (保留曲線形狀)、avg (區間平均)、minmax (保留區間最小與最大值)。
+    layout=columns 時改回傳欄式格式 {"timestamp": [...], "watt": [...], ...}，以 NumPy 整欄處理，
+    適合大範圍查詢；預設 rows 維持每筆一個物件的格式。
+    LOG_LEVEL=DEBUG 時記錄收到的時間範圍與轉換後的查詢字串。
     """
-    if table_name not in VALID_TABLES:
+    if table_name not in devices.registry:
         raise HTTPException(status_code=400, detail=f"Invalid table name: {table_name}")
-
-    # ==================== DEBUG START ====================
-    print("\n--- [DEBUG] Entering get_chart_data ---")
-    print(f"1. Raw ISO strings received from frontend:")
-    print(f"   start_iso: {start_iso}")
-    print(f"   end_iso:   {end_iso}")
-    # ====================  DEBUG END  ====================
-
-    db_connection = get_db_connection_from_pool()
-    cursor = db_connection.cursor(dictionary=True)
+    if resolution not in ("raw", "auto") + rollups.RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid resolution: {resolution}")
+    if bucket not in downsample.BUCKET_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid bucket: {bucket}")
+    if layout not in ("rows", "columns"):
+        raise HTTPException(status_code=400, detail=f"Invalid layout: {layout}")
 
     try:
         taiwan_tz = pytz.timezone('Asia/Taipei')
@@ -612,81 +947,455 @@ async def get_chart_data(table_name: str, start_iso: str, end_iso: str, user_id:
         start_time_tw = start_time_utc.astimezone(taiwan_tz)
         end_time_tw = end_time_utc.astimezone(taiwan_tz)
 
-        # ==================== DEBUG START ====================
-        print(f"2. Converted to Taiwan Time (datetime objects):")
-        print(f"   start_time_tw: {start_time_tw}")
-        print(f"   end_time_tw:   {end_time_tw}")
-        # ====================  DEBUG END  ====================
-
         start_time_str = start_time_tw.strftime('%Y-%m-%d %H:%M:%S')
         end_time_str = end_time_tw.strftime('%Y-%m-%d %H:%M:%S')
 
-        # ==================== DEBUG START ====================
-        print(f"3. Final strings for SQL query:")
-        print(f"   start_time_str: '{start_time_str}'")
-        print(f"   end_time_str:   '{end_time_str}'")
-        print("-------------------------------------------\n")
-        # ====================  DEBUG END  ====================
+        logger.debug(
+            "get_chart_data 時間範圍", table=table_name, start_iso=start_iso, end_iso=end_iso,
+            start_time_str=start_time_str, end_time_str=end_time_str
+        )
 
-        query = f"SELECT timestamp, watt, total_watt_hours, pf FROM `{table_name}` WHERE timestamp BETWEEN %s AND %s ORDER BY timestamp"
-        cursor.execute(query, (start_time_str, end_time_str))
-        rows = cursor.fetchall()
-        
-        # (以下程式碼保持不變)
-        formatted_data = []
-        initial_watt_hours = None
-
-        if rows:
-            initial_watt_hours = rows[0]['total_watt_hours'] if rows[0]['total_watt_hours'] is not None else 0.0
-
-            for row in rows:
-                cumulative_watt_hours = 0.0
-                if initial_watt_hours is not None and row['total_watt_hours'] is not None:
-                    cumulative_watt_hours = row['total_watt_hours'] - initial_watt_hours
-
-                formatted_timestamp = row['timestamp'].strftime('%Y-%m-%d %H:%M:%S')
-
-                formatted_data.append({
-                    'timestamp': formatted_timestamp,
-                    'watt': round(row['watt'], 2) if row['watt'] is not None else 0.0,
-                    'total_watt_hours': round(cumulative_watt_hours, 2),
-                    'pf': round(row['pf'], 2) if row['pf'] is not None else 0.0
-                })
-        
-        return {"data": formatted_data}
+        if not rollups.ROLLUPS_ENABLED:
+            resolution = "raw"
+        elif resolution == "auto":
+            resolution = rollups.choose_resolution(start_time_tw, end_time_tw)
+
+        async def compute():
+            async with repository.connection() as conn:
+                if resolution == "raw" and layout == "columns":
+                    rows = await repository.fetch_chart_columns(conn, table_name, start_time_str, end_time_str)
+                elif resolution == "raw":
+                    rows = await repository.fetch_chart_rows(conn, table_name, start_time_str, end_time_str)
+                else:
+                    rows = await rollups.fetch_chart_rows(conn, table_name, resolution, start_time_tw, end_time_tw)
+
+            if layout == "columns":
+                initial_watt_hours = None
+                if resolution != "raw":
+                    # 彙總資料筆數有限，轉為 tuple 後沿用同一套欄式處理
+                    initial_watt_hours = rows[0]['first_total_watt_hours'] if rows else None
+                    rows = [
+                        (int((row['timestamp'] - EPOCH).total_seconds()), row['watt'], row['total_watt_hours'], row['pf'])
+                        for row in rows
+                    ]
+                with metrics.timed(metrics.stage_seconds, "chart_format_columns"):
+                    columns = chart_format.format_columns(rows, initial_watt_hours, max_points, bucket)
+                return {**columns, "resolution": resolution}
+
+            with metrics.timed(metrics.stage_seconds, "chart_format_rows"):
+                formatted_data = chart_format.format_rows(rows, max_points, bucket)
+            return {"data": formatted_data, "resolution": resolution}
+
+        key = ("chart", table_name, start_time_str, end_time_str, resolution, max_points, bucket, layout)
+        return await cached_response(request, key, table_name, end_time_tw, compute)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database query error: {e}")
-    finally:
-        cursor.close()
-        db_connection.close()
 
-@app.get("/api/get_watt_hours/{shift_type}/{table_name}")
-def get_shift_watt_hours(shift_type: str, table_name: str,user_id: int = Depends(get_current_user)):
-    if table_name not in VALID_TABLES:
+async def stream_chart_data(query, args, output_format, resolution, chunk_size):
+    """
+    以 server-side cursor 逐批讀取並輸出圖表資料，記憶體用量只與 chunk_size 有關，與時間範圍無關。
+    output_format=ndjson 時每行一筆 JSON；json 時輸出與 /api/get_chart_data 相同的 {"data": [...], "resolution": ...}。
+    輸出途中查詢失敗時，ndjson 最後一行為 {"error": ...}，json 則在結尾附上 "error" 欄位。
+    """
+    initial_watt_hours = None
+    started = False
+    try:
+        async for rows in repository.iter_chunks(query, args, chunk_size):
+            if initial_watt_hours is None:
+                initial_watt_hours = chart_format.chunk_baseline(rows[0])
+            lines = [json.dumps(point, ensure_ascii=False) for point in chart_format.format_chunk(rows, initial_watt_hours)]
+            if output_format == "ndjson":
+                yield ("\n".join(lines) + "\n").encode("utf-8")
+            else:
+                yield (("{\"data\":[" if not started else ",") + ",".join(lines)).encode("utf-8")
+            started = True
+    except Exception as e:
+        if not started:
+            raise
+        logger.error("串流圖表資料時發生錯誤", error=repr(e))
+        error = json.dumps(f"Database query error: {e}", ensure_ascii=False)
+        if output_format == "ndjson":
+            yield f'{{"error":{error}}}\n'.encode("utf-8")
+        else:
+            yield f'],"resolution":"{resolution}","error":{error}}}'.encode("utf-8")
+        return
+
+    if output_format == "json":
+        prefix = "" if started else '{"data":['
+        yield (prefix + f'],"resolution":"{resolution}"}}').encode("utf-8")
+
+async def start_stream(chunks):
+    """
+    先取得第一段輸出再建立回應：連線池、查詢本身的錯誤仍能以一般的 HTTP 錯誤回傳，
+    開始傳送後才發生的錯誤則由 stream_chart_data 寫在輸出結尾。
+    """
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def body():
+        if first is None:
+            return
+        yield first
+        async for chunk in chunks:
+            yield chunk
+    return body()
+
+@app.get("/api/get_chart_data/stream")
+async def get_chart_data_stream(
+    table_name: str,
+    start_iso: str,
+    end_iso: str,
+    resolution: str = "raw",
+    format: str = "ndjson",
+    chunk_size: int = Query(1000, ge=100, le=10000),
+    user_id: int = Depends(get_current_user)
+):
+    """
+    /api/get_chart_data 的串流版本，適合一年以上的長時間範圍：
+    資料由 MySQL 逐批送出並立即寫回用戶端，不會先把整個範圍讀進記憶體。
+    format 為 ndjson (每行一筆) 或 json (與 /api/get_chart_data 相同的格式，分段送出)。
+    串流模式不支援降採樣 (max_points 需要完整資料)，需要較少資料點時請改用 resolution。
+    """
+    if table_name not in devices.registry:
         raise HTTPException(status_code=400, detail=f"Invalid table name: {table_name}")
-    
-    taiwan_tz = pytz.timezone('Asia/Taipei')    
-    now = datetime.now(taiwan_tz)    # 使用台灣時間
+    if resolution not in ("raw", "auto") + rollups.RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid resolution: {resolution}")
+    if format not in ("ndjson", "json"):
+        raise HTTPException(status_code=400, detail=f"Invalid format: {format}")
 
-    start_time_obj = None
-    end_time_obj = None
+    try:
+        start_time_tw = isoparse(start_iso).astimezone(TAIWAN_TZ)
+        end_time_tw = isoparse(end_iso).astimezone(TAIWAN_TZ)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="時間格式錯誤，請使用 ISO 8601 格式。")
 
-    if shift_type == "day_shift":
-        start_time_obj = (now.replace(hour=8, minute=0, second=0, microsecond=0) - timedelta(days=1))
-        end_time_obj = (now.replace(hour=17, minute=0, second=0, microsecond=0) - timedelta(days=1))
-    elif shift_type == "night_shift":
-        start_time_obj = (now.replace(hour=19, minute=0, second=0, microsecond=0) - timedelta(days=1))
-        end_time_obj = now.replace(hour=5, minute=0, second=0, microsecond=0)
-    elif shift_type == "since_morning":
-        start_time_obj = now.replace(hour=8, minute=0, second=0, microsecond=0)
-        end_time_obj = now.replace(microsecond=0) # 將毫秒去掉
+    if not rollups.ROLLUPS_ENABLED:
+        resolution = "raw"
+    elif resolution == "auto":
+        resolution = rollups.choose_resolution(start_time_tw, end_time_tw)
+
+    if resolution == "raw":
+        query, args = repository.chart_query(
+            table_name, start_time_tw.strftime('%Y-%m-%d %H:%M:%S'), end_time_tw.strftime('%Y-%m-%d %H:%M:%S')
+        )
     else:
-        raise HTTPException(status_code=400, detail="Invalid shift type")
-    
-    # 直接傳遞 datetime 物件，而不是字串
-    kwh = get_total_watt_hours_difference(start_time_obj, end_time_obj, table_name)
+        query, args = rollups.chart_query(table_name, resolution, start_time_tw, end_time_tw)
+
+    try:
+        body = await start_stream(stream_chart_data(query, args, format, resolution, chunk_size))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database query error: {e}")
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "application/json"
+    return StreamingResponse(body, media_type=media_type, headers={"X-Resolution": resolution})
+
+async def iter_export_chunks(queries, chunk_size):
+    """依序以 server-side cursor 讀取每張資料表，逐批產生 (table_name, baseline, rows)，同一時間只佔用一個連線。"""
+    for table_name, query, args in queries:
+        baseline = None
+        async for rows in repository.iter_chunks(query, args, chunk_size):
+            if baseline is None:
+                baseline = chart_format.chunk_baseline(rows[0])
+            yield table_name, baseline, rows
+
+@app.get("/api/export")
+async def export_energy_history(
+    start_iso: str,
+    end_iso: str,
+    tables: Optional[List[str]] = Query(None),
+    resolution: str = "raw",
+    format: str = "csv",
+    chunk_size: int = Query(5000, ge=100, le=50000),
+    user_id: int = Depends(get_current_user)
+):
+    """
+    批次匯出多張資料表的能源歷史資料 (供碳排放報表使用)，未指定 tables 時匯出全部資料表。
+    format 為 csv 或 parquet，欄位為 table_name、timestamp、watt、total_watt_hours (電表讀數)、
+    watt_hours (自區間起點累積的用電量)、pf。resolution 用法同 /api/get_chart_data，
+    啟用彙總資料表時可改匯出 minute / hour / day 彙總資料。
+    資料以 server-side cursor 逐批讀取並立即寫出，匯出一整年的全部機台也不會把資料全部留在記憶體中。
+    """
+    table_names = list(dict.fromkeys(tables or devices.registry.names()))
+    invalid_tables = [table_name for table_name in table_names if table_name not in devices.registry]
+    if invalid_tables:
+        raise HTTPException(status_code=400, detail=f"Invalid table name: {', '.join(invalid_tables)}")
+    if resolution not in ("raw", "auto") + rollups.RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid resolution: {resolution}")
+    if format not in export.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format: {format}")
+
+    try:
+        start_time_tw = isoparse(start_iso).astimezone(TAIWAN_TZ)
+        end_time_tw = isoparse(end_iso).astimezone(TAIWAN_TZ)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="時間格式錯誤，請使用 ISO 8601 格式。")
+    if end_time_tw <= start_time_tw:
+        raise HTTPException(status_code=400, detail="結束時間必須晚於開始時間。")
+
+    if not rollups.ROLLUPS_ENABLED:
+        resolution = "raw"
+    elif resolution == "auto":
+        resolution = rollups.choose_resolution(start_time_tw, end_time_tw)
+
+    queries = []
+    for table_name in table_names:
+        if resolution == "raw":
+            query, args = repository.chart_query(
+                table_name, start_time_tw.strftime('%Y-%m-%d %H:%M:%S'), end_time_tw.strftime('%Y-%m-%d %H:%M:%S')
+            )
+        else:
+            query, args = rollups.chart_query(table_name, resolution, start_time_tw, end_time_tw)
+        queries.append((table_name, query, args))
+
+    try:
+        chunks = await start_stream(iter_export_chunks(queries, chunk_size))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database query error: {e}")
+
+    body = export.csv_stream(chunks) if format == "csv" else export.parquet_stream(chunks)
+    filename = f"energy_{start_time_tw:%Y%m%d%H%M}_{end_time_tw:%Y%m%d%H%M}_{resolution}.{format}"
+    return StreamingResponse(
+        body,
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "X-Resolution": resolution},
+    )
+
+SHIFT_TYPES = ("day_shift", "night_shift", "since_morning")
+
+def shift_range(shift_type, now, day=None):
+    """
+    回傳班別的 (開始, 結束) 台灣時間。day 為班別開始的日期，未指定時與 /api/get_watt_hours/{shift_type} 相同：
+    日班、夜班為昨天開始的班別，since_morning 為今天 08:00 至現在。
+    """
+    if day is None:
+        day = now.date() if shift_type == "since_morning" else now.date() - timedelta(days=1)
+    start_of_day = TAIWAN_TZ.localize(datetime.combine(day, datetime.min.time()))
+    if shift_type == "day_shift":
+        return start_of_day.replace(hour=8), start_of_day.replace(hour=17)
+    if shift_type == "night_shift":
+        next_day = TAIWAN_TZ.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+        return start_of_day.replace(hour=19), next_day.replace(hour=5)
+    # since_morning：當天 08:00 至現在 (過去的日期則至當天結束)
+    end = min(now.replace(microsecond=0), start_of_day + timedelta(days=1))
+    return start_of_day.replace(hour=8), end
+
+# 單次請求最多可查詢的區間數
+MAX_ENERGY_QUERIES = 500
+
+@app.post("/api/energy/query")
+async def query_energy(query: EnergyQuery, user_id: int = Depends(get_current_user)):
+    """
+    一次計算多個 (資料表, 區間) 的用電量，取代逐一呼叫 /api/get_watt_hours/custom 與 /api/get_watt_hours/{shift_type}。
+    所有區間共用一個連線，並合併成少數幾次 UNION ALL 查詢 (計算方式見 energy.compute)。
+    例如「全部機台最近 7 天的日班、夜班」只需一個請求。
+    回傳 results 依輸入順序排列，kilo_watt_hours 的意義與單一區間的路由相同，查無資料時為 null；
+    scan 方式另附 resets (電表歸零次數)、gaps (斷線次數) 與 readings (資料筆數)。
+    """
+    if not query.ranges:
+        return {"results": [], "method": energy.method()}
+    if len(query.ranges) > MAX_ENERGY_QUERIES:
+        raise HTTPException(status_code=400, detail=f"Too many ranges: {len(query.ranges)} > {MAX_ENERGY_QUERIES}")
+
+    now = datetime.now(TAIWAN_TZ)
+    resolved = []
+    for index, item in enumerate(query.ranges):
+        if item.table_name not in devices.registry:
+            raise HTTPException(status_code=400, detail=f"ranges[{index}]: Invalid table name: {item.table_name}")
+        if item.shift is not None:
+            if item.shift not in SHIFT_TYPES:
+                raise HTTPException(status_code=400, detail=f"ranges[{index}]: Invalid shift type: {item.shift}")
+            start_time, end_time = shift_range(item.shift, now, item.day)
+        elif item.start is not None and item.end is not None:
+            # 未帶時區的時間視為台灣時間
+            start_time = item.start.astimezone(TAIWAN_TZ) if item.start.tzinfo else TAIWAN_TZ.localize(item.start)
+            end_time = item.end.astimezone(TAIWAN_TZ) if item.end.tzinfo else TAIWAN_TZ.localize(item.end)
+        else:
+            raise HTTPException(status_code=400, detail=f"ranges[{index}]: 請指定 start 與 end，或指定 shift。")
+        resolved.append((item, start_time, end_time))
+
+    try:
+        async with repository.connection() as conn:
+            totals = await energy.compute(conn, [(item.table_name, start_time, end_time) for item, start_time, end_time in resolved])
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("批次計算用電量時發生錯誤", error=repr(e))
+        raise HTTPException(status_code=500, detail="計算瓦特小時時發生錯誤")
+
+    results = []
+    for (item, start_time, end_time), total in zip(resolved, totals):
+        results.append({
+            "table_name": item.table_name,
+            "shift": item.shift,
+            "start": start_time.isoformat(),
+            "end": end_time.isoformat(),
+            **total,
+        })
+    return {"results": results, "method": energy.method()}
+
+@app.get("/api/get_watt_hours/{shift_type}/{table_name}")
+async def get_shift_watt_hours(request: Request, shift_type: str, table_name: str,user_id: int = Depends(get_current_user)):
+    if table_name not in devices.registry:
+        raise HTTPException(status_code=400, detail=f"Invalid table name: {table_name}")
     
-    if kwh is None:
-        raise HTTPException(status_code=404, detail="找不到指定時間範圍內的資料")
+    now = datetime.now(TAIWAN_TZ)    # 使用台灣時間
+    if shift_type not in SHIFT_TYPES:
+        raise HTTPException(status_code=400, detail="Invalid shift type")
+    start_time_obj, end_time_obj = shift_range(shift_type, now)
     
-    return {"kilo_watt_hours": kwh}
\ No newline at end of file
+    # 直接傳遞 datetime 物件，而不是字串；昨天的日班、夜班為已結束的區間，會由快取直接回應
+    return await watt_hours_response(request, start_time_obj, end_time_obj, table_name)
+
+# 即時數據推送 (Server-Sent Events)
+class LiveStreamResponse(StreamingResponse):
+    """
+    回應結束時一定取消訂閱：用戶端在第一個區塊送出前斷線或回應被取消時，產生器不會開始執行，
+    不能只靠產生器中的 finally，否則訂閱者會一直佔用 LIVE_STREAM_MAX_CLIENTS 並讓 live_feed 持續重新整理。
+    """
+
+    def __init__(self, subscriber, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self.subscriber = subscriber
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            live_feed.unsubscribe(self.subscriber)
+
+@app.get("/api/stream/live")
+async def stream_live(request: Request, token: Optional[str] = None):
+    """
+    以 SSE 推送即時數據，取代儀表板定時呼叫 get_total_latest_kwh 與 get_total_daily_kwh：
+    連線後先送出 snapshot (各機器的最新讀數與總覽數據)，之後每筆新讀數送出 reading 與 totals 事件。
+    瀏覽器的 EventSource 無法設定 Header，token 可由查詢參數 ?token= 傳入 (也接受 Authorization Header)；
+    token 到期時結束連線，用戶端以新的 token 重新連線。
+    數據由 live_feed 在記憶體中推送給所有連線，連線數不影響資料庫負載；
+    連線跟不上 (暫存事件超過 LIVE_STREAM_QUEUE_SIZE) 時中斷該連線，連線數達 LIVE_STREAM_MAX_CLIENTS 時回覆 503。
+    """
+    if token is None:
+        authorization = request.headers.get("authorization", "")
+        if authorization.lower().startswith("bearer "):
+            token = authorization[7:]
+    payload = verify_token(token)
+
+    subscriber, snapshot = await live_feed.subscribe()
+    if subscriber is None:
+        raise HTTPException(status_code=503, detail="即時數據連線數已達上限，請稍後再試")
+    expires_at = payload.get("exp") or time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+    async def events():
+        # retry 為 EventSource 斷線後重新連線前等待的毫秒數
+        yield b"retry: 3000\n\n" + snapshot
+        while True:
+            remaining = expires_at - time.time()
+            if remaining <= 0:
+                yield b"event: expired\ndata: {}\n\n"
+                return
+            try:
+                chunk = await asyncio.wait_for(
+                    subscriber.queue.get(), min(LIVE_STREAM_KEEPALIVE_SECONDS, remaining)
+                )
+            except asyncio.TimeoutError:
+                # 定時送出註解，避免閒置的連線被代理伺服器或負載平衡器關閉
+                yield b": keepalive\n\n"
+                continue
+            if chunk is None:
+                return
+            yield chunk
+
+    # 取消訂閱由 LiveStreamResponse 負責，不論產生器是否開始執行
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return LiveStreamResponse(subscriber, events(), media_type="text/event-stream", headers=headers)
+
+# 監控端點 (/metrics、/api/db/stats、/api/stream/stats) 的存取權杖，供 Prometheus 等以 Authorization: Bearer <METRICS_TOKEN> 抓取；
+# 未設定或不符時須以 DEVICE_ADMIN_ACCOUNTS 中的帳號登入 (監控數據含機器名稱、各路由延遲與連線池狀態，不公開)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+async def require_monitoring_access(token: str = Depends(oauth2_scheme)):
+    """METRICS_TOKEN 或管理帳號的 JWT 才可查看監控數據，未登入回應 401、其他帳號回應 403。"""
+    if METRICS_TOKEN and secrets.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return
+    await require_device_admin(await get_current_user(token))
+
+@app.get("/api/stream/stats", dependencies=[Depends(require_monitoring_access)])
+async def get_stream_stats():
+    """回傳本 worker 的即時數據連線數、推送的事件數與中斷的連線數。"""
+    return live_feed.stats()
+
+# 啟動時間
+@app.get("/api/startup")
+async def get_startup_report():
+    """回傳本 worker 由容器開始執行到各啟動階段完成的秒數 (不需認證、不查詢資料庫，可作為啟動探測)。"""
+    return startup.report()
+
+# 資料庫連線池的監控數據
+@app.get("/api/db/stats", dependencies=[Depends(require_monitoring_access)])
+async def get_db_stats():
+    """回傳連線池使用中、等待中的連線數、逾時次數與取得連線的延遲。"""
+    return repository.pool_manager.stats()
+
+@app.get("/metrics", dependencies=[Depends(require_monitoring_access)])
+async def get_metrics():
+    """
+    Prometheus 格式的效能指標：各路由的回應時間、取得連線的等待時間、各 SQL 的執行時間與連線池狀態。
+    數值為回應此請求的 worker 所有，以 worker 標籤區分。
+    """
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# 機器登錄表
+# 可新增或修改機器 (POST /api/devices) 的帳號，以逗號分隔；未設定時任何帳號都不能修改。
+# /api/register 對所有人開放，因此不能只要求登入：修改機器會建立資料表 (DDL)，停用機器會讓該電表的上傳被拒絕
+DEVICE_ADMIN_ACCOUNTS = {
+    account.strip() for account in os.environ.get("DEVICE_ADMIN_ACCOUNTS", "").split(",") if account.strip()
+}
+
+async def require_device_admin(user_id: int = Depends(get_current_user)):
+    """只有 DEVICE_ADMIN_ACCOUNTS 中的帳號可以管理機器，其他人回應 403。"""
+    if DEVICE_ADMIN_ACCOUNTS:
+        user = profile_cache.get(user_id)
+        if user is None:
+            async with repository.connection() as conn:
+                user = await repository.get_employee_by_id(conn, user_id)
+            if user is not None:
+                profile_cache.put(user_id, user)
+        if user is not None and user["account"] in DEVICE_ADMIN_ACCOUNTS:
+            return user_id
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="沒有管理機器的權限")
+
+@app.get("/api/devices")
+async def list_devices(user_id: int = Depends(get_current_user)):
+    """回傳所有已登錄的機器 (含已停用者) 與其屬性，以及登錄表的來源 (devices 資料表或預設列表)。"""
+    return {"devices": devices.registry.all(), "registry": devices.registry.stats()}
+
+@app.post("/api/devices")
+async def save_device(device: DeviceIn, user_id: int = Depends(require_device_admin)):
+    """
+    新增機器或更新機器的屬性 (active=false 為停用，停用後不再接受上傳，但歷史資料仍可查詢)。
+    只有 DEVICE_ADMIN_ACCOUNTS 中的帳號可以呼叫。
+    本 worker 立即生效，其他 worker 與 ESP32 專用服務在下次重新載入登錄表時生效 (遇到新機器上傳時也會提前重新載入)。
+    """
+    if not devices.NAME_PATTERN.match(device.name):
+        raise HTTPException(status_code=400, detail=f"Invalid table name: {device.name}")
+    if devices.registry.source != "devices":
+        raise HTTPException(status_code=409, detail="尚未建立 devices 資料表，請先執行 `python migrations.py apply`")
+    try:
+        async with repository.connection() as conn:
+            saved = await devices.save(conn, device.name, device.rated_power_kw, device.co2e_kg_per_kwh, device.active)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error("儲存機器時發生錯誤", device=device.name, error=repr(e))
+        raise HTTPException(status_code=500, detail="儲存機器失敗")
+    return saved
+
+# 程式載入完成 (以 gunicorn --preload 啟動時於主程序中記錄)
+startup.mark("imports")
@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+
+import aiomysql
+
+import boundaries
+import ingest_guard
+import devices
+import repository
+import rollups
+import storage
+
+# 資料庫結構檢查與遷移
+# 電表資料表由 ESP32 上傳建立，原本沒有任何索引，「某時刻之後的第一筆 / 之前的最後一筆」
+# 都要排序掃描整張表。check 列出缺少的索引與輔助資料表，apply 補上。
+#
+#   python migrations.py check   # 只檢查，不修改 (有缺漏時結束代碼為 1)
+#   python migrations.py apply   # 新增缺少的索引並建立 rollup / energy_segments / counter_offsets / devices 資料表
+
+# 電表資料表需要的複合索引：(timestamp, total_watt_hours) 讓依時間查讀數只需讀索引，不必回表
+RAW_INDEXES = {
+    "idx_timestamp_total_watt_hours": ("timestamp", "total_watt_hours"),
+}
+
+# 輔助資料表：名稱 → 建立函式
+AUXILIARY_TABLES = {
+    **{rollups.rollup_table(resolution): rollups.create_schema for resolution in rollups.RESOLUTIONS},
+    "energy_segments": boundaries.create_schema,
+    "counter_offsets": ingest_guard.create_schema,
+    "devices": devices.create_schema,
+}
+
+async def table_indexes(conn, table_name):
+    """回傳 {索引名稱: (欄位, ...)}，欄位依索引中的順序排列。"""
+    async with conn.cursor(aiomysql.DictCursor) as cursor:
+        await cursor.execute(f"SHOW INDEX FROM `{table_name}`")
+        rows = await cursor.fetchall()
+    indexes = {}
+    for row in sorted(rows, key=lambda row: (row['Key_name'], row['Seq_in_index'])):
+        indexes.setdefault(row['Key_name'], []).append(row['Column_name'])
+    return {name: tuple(columns) for name, columns in indexes.items()}
+
+async def missing_indexes(conn, table_name):
+    """
+    回傳缺少的索引名稱。已有相同開頭欄位的其他索引 (不論名稱) 也視為滿足。
+    讀取單一 readings 資料表時 (STORAGE_LAYOUT=unified)，主鍵 (device_id, ts) 即可滿足，不檢查機器資料表。
+    """
+    if storage.reads_unified():
+        return []
+    existing = (await table_indexes(conn, table_name)).values()
+    return [
+        name for name, columns in RAW_INDEXES.items()
+        if not any(index[:len(columns)] == columns for index in existing)
+    ]
+
+async def missing_tables(conn):
+    rows = await repository.fetch_all(
+        conn, "SELECT table_name AS name FROM information_schema.tables WHERE table_schema = DATABASE()"
+    )
+    existing = {row['name'] for row in rows}
+    return [name for name in AUXILIARY_TABLES if name not in existing]
+
+async def check(conn, table_names):
+    """回傳需要處理的項目描述，空列表表示資料庫結構完整。"""
+    problems = []
+    for table_name in table_names:
+        for index_name in await missing_indexes(conn, table_name):
+            problems.append(f"資料表 '{table_name}' 缺少索引 {index_name} {RAW_INDEXES[index_name]}")
+    for name in await missing_tables(conn):
+        problems.append(f"缺少資料表 '{name}'")
+    for column in await devices.missing_columns(conn):
+        problems.append(f"資料表 'devices' 缺少欄位 {column}")
+    return problems
+
+async def apply(conn, table_names):
+    """新增缺少的索引並建立缺少的輔助資料表，已存在者不變。"""
+    async with conn.cursor() as cursor:
+        for table_name in table_names:
+            for index_name in await missing_indexes(conn, table_name):
+                columns = ", ".join(RAW_INDEXES[index_name])
+                print(f"正在為 '{table_name}' 新增索引 {index_name} ({columns}) ...")
+                await cursor.execute(f"ALTER TABLE `{table_name}` ADD INDEX {index_name} ({columns})")
+    create_functions = {AUXILIARY_TABLES[name] for name in await missing_tables(conn)}
+    if await devices.missing_columns(conn):
+        create_functions.add(devices.create_schema)
+    for create_schema in create_functions:
+        await create_schema(conn)
+    print("資料庫結構已更新。")
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="檢查並補上電表資料表的索引與輔助資料表")
+    parser.add_argument("command", choices=["check", "apply"])
+    parser.add_argument("--tables", nargs="*", default=None, help="要處理的資料表 (預設為全部)")
+    args = parser.parse_args(argv)
+
+    await repository.init_pool()
+    try:
+        # 機器登錄表在建立連線池時載入
+        table_names = args.tables or devices.registry.names()
+        for table_name in table_names:
+            if table_name not in devices.registry:
+                raise SystemExit(f"Invalid table name: {table_name}")
+        async with repository.connection() as conn:
+            if args.command == "apply":
+                await apply(conn, table_names)
+            problems = await check(conn, table_names)
+    finally:
+        await repository.close_pool()
+
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(1)
+    print("資料庫結構完整。")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PasswordHasherBusy(Exception):
+    """等待 bcrypt 執行緒的請求過多，或等待超過 queue_timeout 秒。"""
+
+
+class PasswordHasher:
+    """
+    在專用、有上限的執行緒池中執行 bcrypt (雜湊與驗證)。
+
+    bcrypt 刻意設計為耗費 CPU；交班時大量登入若直接使用共用的執行緒池，會佔滿 CPU 與執行緒，
+    同一個 worker 上的感測器上傳與查詢都會排在後面。這裡同時執行的 bcrypt 最多 max_workers 個
+    (bcrypt 計算期間會釋放 GIL，因此執行緒即可平行運算)，等待中的請求最多 max_pending 個，
+    且最多等待 queue_timeout 秒，超過時拋出 PasswordHasherBusy，由路由回覆 503 請用戶端稍後重試。
+    """
+
+    def __init__(self, max_workers=2, max_pending=32, queue_timeout=5.0):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._semaphore = None
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    async def run(self, fn, *args):
+        # Semaphore 在第一次使用時建立，確保綁定到執行中的 event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        finally:
+            self._pending -= 1
+
+        wait_ms = (time.perf_counter() - start) * 1000
+        self.total_wait_ms += wait_ms
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._semaphore.release()
+            self.completed += 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "pending": self._pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait_ms / self.completed, 2) if self.completed else 0.0,
+            "max_wait_ms": round(self.max_wait_ms, 2),
+        }
@@ -0,0 +1,284 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+import aiomysql
+
+import db_pool
+import devices
+import metrics
+import storage
+
+# 非同步資料存取層
+# 所有路由都透過此模組存取 MySQL，查詢期間會讓出 event loop，
+# 同一個 worker 因此可以同時服務多位使用者，而不會被單一慢查詢卡住。
+
+# 每個 SQL 的執行時間依操作與資料表記錄到 db_query_duration_seconds (GET /metrics)。
+# executemany 由 aiomysql 內部呼叫 execute，同樣會被記錄；server-side cursor 記錄的是取得第一批結果前的時間。
+class TimedCursorMixin:
+    async def execute(self, query, args=None):
+        started = time.perf_counter()
+        try:
+            result = await super().execute(query, args)
+        except Exception:
+            metrics.observe_query(query, time.perf_counter() - started, failed=True)
+            raise
+        metrics.observe_query(query, time.perf_counter() - started)
+        return result
+
+class Cursor(TimedCursorMixin, aiomysql.Cursor):
+    pass
+
+class DictCursor(TimedCursorMixin, aiomysql.DictCursor):
+    pass
+
+class SSCursor(TimedCursorMixin, aiomysql.SSCursor):
+    pass
+
+async def create_pool(minsize, maxsize, recycle_seconds):
+    """建立 aiomysql 連線池 (由 pool_manager 呼叫)。"""
+    db_user = os.environ.get("DB_USER")
+    db_password = os.environ.get("DB_PASSWORD")
+    db_name = os.environ.get("DB_NAME")
+    db_connection_name = os.environ.get("DB_CONNECTION_NAME")
+    # 設定 DB_HOST 時改以 TCP 連線 (本機的 MySQL，例如 benchmarks/ 的負載測試)，否則經由 Cloud SQL 的 unix socket
+    db_host = os.environ.get("DB_HOST")
+
+    if not all([db_user, db_password, db_name, db_connection_name or db_host]):
+        raise ValueError("Missing one or more database environment variables.")
+    if db_host:
+        address = {"host": db_host, "port": int(os.environ.get("DB_PORT", "3306"))}
+    else:
+        address = {"unix_socket": f"/cloudsql/{db_connection_name}"}
+
+    # autocommit=True：唯讀查詢不會留下未結束的交易 (否則 aiomysql 會在歸還時關閉連線)，
+    # 需要交易的寫入則透過 transaction() 明確開始與提交
+    return await aiomysql.create_pool(
+        minsize=minsize,
+        maxsize=maxsize,
+        pool_recycle=recycle_seconds,
+        user=db_user,
+        password=db_password,
+        db=db_name,
+        **address,
+        charset="utf8mb4",
+        autocommit=True,
+        cursorclass=Cursor
+    )
+
+# 連線池的大小、等待逾時與重試設定見 db_pool.py
+pool_manager = db_pool.PoolManager(create_pool, **db_pool.config_from_env())
+pool_manager.register_metrics()
+
+async def init_pool():
+    """
+    建立連線池、預先開啟 DB_POOL_WARM_SIZE 個連線並載入機器登錄表，需在 event loop 啟動後呼叫
+    (服務啟動後在背景執行，見 main.warm_up)。
+    失敗時拋出例外；之後的 connection() 會以退避間隔自動重試。
+    """
+    await pool_manager.warm_up()
+    # 載入機器登錄表 (devices 資料表尚未建立時保留預設的機器列表)
+    async with connection() as conn:
+        await devices.registry.refresh(conn)
+
+async def close_pool():
+    """關閉連線池並等待所有連線釋放。"""
+    await pool_manager.close()
+
+def connection():
+    """從連線池取得一個連線 (async with)，離開 with 區塊時自動歸還。"""
+    return pool_manager.connection()
+
+@asynccontextmanager
+async def transaction(conn):
+    """在 with 區塊內執行交易，成功時 commit，發生例外時 rollback。"""
+    await conn.begin()
+    try:
+        async with conn.cursor(DictCursor) as cursor:
+            yield cursor
+        await conn.commit()
+    except BaseException:
+        await conn.rollback()
+        raise
+
+@asynccontextmanager
+async def streaming_cursor(query, args=None):
+    """
+    以獨立連線與 server-side (unbuffered) cursor 執行查詢，結果由 MySQL 逐批送來，不會一次載入記憶體。
+    未讀完就離開時 (例如用戶端中途斷線) 直接關閉連線：讀到一半的連線不能放回連線池，
+    也不值得為了歸還連線而把剩下的結果讀完。
+    """
+    async with connection() as conn:
+        cursor = await conn.cursor(SSCursor)
+        finished = False
+        try:
+            await cursor.execute(query, args)
+            yield cursor
+            finished = True
+        finally:
+            if finished:
+                await cursor.close()
+            else:
+                conn.close()
+
+async def iter_chunks(query, args=None, chunk_size=1000):
+    """以 streaming_cursor 逐批取得查詢結果 (tuple)，每次最多 chunk_size 筆。"""
+    async with streaming_cursor(query, args) as cursor:
+        while True:
+            rows = await cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+async def fetch_one(conn, query, args=None):
+    async with conn.cursor(DictCursor) as cursor:
+        await cursor.execute(query, args)
+        return await cursor.fetchone()
+
+async def fetch_all(conn, query, args=None):
+    async with conn.cursor(DictCursor) as cursor:
+        await cursor.execute(query, args)
+        return await cursor.fetchall()
+
+# 合併查詢時每個 UNION ALL 最多包含的子查詢數
+LOOKUP_BATCH_SIZE = 100
+
+async def fetch_lookups(conn, queries):
+    """
+    queries 為 [(query, args)]，每個查詢至多回傳一列、欄位為 total_watt_hours。
+    以 UNION ALL 合併成一次查詢執行 (每批最多 LOOKUP_BATCH_SIZE 個)，依輸入順序回傳結果，沒有資料者為 None。
+    """
+    values = [None] * len(queries)
+    for offset in range(0, len(queries), LOOKUP_BATCH_SIZE):
+        parts = []
+        args = []
+        for index, (query, query_args) in enumerate(queries[offset:offset + LOOKUP_BATCH_SIZE], start=offset):
+            parts.append(f"SELECT {index} AS lookup_index, total_watt_hours FROM ({query}) AS lookup_{index}")
+            args.extend(query_args)
+        for row in await fetch_all(conn, " UNION ALL ".join(parts), args):
+            values[row['lookup_index']] = row['total_watt_hours']
+    return values
+
+async def fan_out(table_names, query_fn, concurrency):
+    """
+    以各自的連線同時查詢多張資料表，總耗時約等於最慢的單一資料表。
+    query_fn(conn, table_name) 為每張資料表要執行的查詢；同時進行的查詢數以 concurrency 為上限，
+    避免一次佔滿連線池。回傳 ({資料表: 結果}, {資料表: 耗時毫秒})。
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(table_name):
+        async with semaphore:
+            start = time.perf_counter()
+            async with connection() as conn:
+                result = await query_fn(conn, table_name)
+            return table_name, result, (time.perf_counter() - start) * 1000
+
+    outcomes = await asyncio.gather(*(run(table_name) for table_name in table_names))
+    results = {table_name: result for table_name, result, _ in outcomes}
+    timings = {table_name: round(elapsed_ms, 2) for table_name, _, elapsed_ms in outcomes}
+    return results, timings
+
+# --- 會員相關查詢 ---
+async def get_employee_by_id(conn, user_id):
+    return await fetch_one(conn, "SELECT id, employee_name, account FROM employees WHERE id = %s", (user_id,))
+
+async def get_employee_credentials(conn, account):
+    return await fetch_one(conn, "SELECT id, password_hash, salt FROM employees WHERE account = %s", (account,))
+
+async def get_employee_id(conn, account):
+    """依帳號取得員工 ID，帳號不存在時回傳 None。"""
+    row = await fetch_one(conn, "SELECT id FROM employees WHERE account = %s", (account,))
+    return row['id'] if row else None
+
+async def create_employee(conn, employee_name, account, password_hash, salt):
+    async with transaction(conn) as cursor:
+        query = "INSERT INTO employees (employee_name, account, password_hash, salt, created_at) VALUES (%s, %s, %s, %s, NOW())"
+        await cursor.execute(query, (employee_name, account, password_hash, salt))
+
+async def replace_password_reset_token(conn, employee_id, token, expires_at):
+    async with transaction(conn) as cursor:
+        await cursor.execute("DELETE FROM password_resets WHERE employee_id = %s", (employee_id,))
+        query = "INSERT INTO password_resets (employee_id, token, expires_at) VALUES (%s, %s, %s)"
+        await cursor.execute(query, (employee_id, token, expires_at))
+
+async def get_password_reset(conn, token):
+    return await fetch_one(conn, "SELECT employee_id FROM password_resets WHERE token = %s AND expires_at > NOW()", (token,))
+
+async def update_password(conn, employee_id, password_hash, salt):
+    async with transaction(conn) as cursor:
+        update_query = "UPDATE employees SET password_hash = %s, salt = %s WHERE id = %s"
+        await cursor.execute(update_query, (password_hash, salt, employee_id))
+        delete_query = "DELETE FROM password_resets WHERE employee_id = %s"
+        await cursor.execute(delete_query, (employee_id,))
+
+# --- 電表資料相關查詢 ---
+# table_name 必須是機器登錄表 (devices.registry) 中的機器，才能安全地放進 SQL 字串；
+# FROM 子句由 storage.table_ref() 產生，依 STORAGE_LAYOUT 指向機器資料表或 readings
+
+def first_total_watt_hours_query(table_name, start_time_str):
+    """指定時間 (含) 之後的第一筆 'total_watt_hours'，回傳 (query, args)。"""
+    query = f"SELECT total_watt_hours FROM {storage.table_ref(table_name)} WHERE timestamp >= %s ORDER BY timestamp ASC LIMIT 1"
+    return query, (start_time_str,)
+
+def last_total_watt_hours_query(table_name, end_time_str):
+    """指定時間 (含) 之前的最後一筆 'total_watt_hours'，回傳 (query, args)。"""
+    query = f"SELECT total_watt_hours FROM {storage.table_ref(table_name)} WHERE timestamp <= %s ORDER BY timestamp DESC LIMIT 1"
+    return query, (end_time_str,)
+
+async def first_total_watt_hours_at_or_after(conn, table_name, start_time_str):
+    """取得指定時間 (含) 之後的第一筆 'total_watt_hours'，沒有資料時回傳 None。"""
+    row = await fetch_one(conn, *first_total_watt_hours_query(table_name, start_time_str))
+    return row['total_watt_hours'] if row else None
+
+async def last_total_watt_hours_at_or_before(conn, table_name, end_time_str):
+    """取得指定時間 (含) 之前的最後一筆 'total_watt_hours'，沒有資料時回傳 None。"""
+    row = await fetch_one(conn, *last_total_watt_hours_query(table_name, end_time_str))
+    return row['total_watt_hours'] if row else None
+
+async def latest_reading(conn, table_name):
+    """取得最新一筆資料 (timestamp、total_watt_hours、watt、pf)，沒有資料時回傳 None。"""
+    query = f"SELECT timestamp, total_watt_hours, watt, pf FROM {storage.table_ref(table_name)} ORDER BY timestamp DESC LIMIT 1"
+    return await fetch_one(conn, query)
+
+def chart_query(table_name, start_time_str, end_time_str):
+    """圖表用的原始資料查詢，回傳 (query, args)。"""
+    query = f"SELECT timestamp, watt, total_watt_hours, pf FROM {storage.table_ref(table_name)} WHERE timestamp BETWEEN %s AND %s ORDER BY timestamp"
+    return query, (start_time_str, end_time_str)
+
+async def fetch_chart_rows(conn, table_name, start_time_str, end_time_str):
+    query, args = chart_query(table_name, start_time_str, end_time_str)
+    return await fetch_all(conn, query, args)
+
+async def fetch_chart_columns(conn, table_name, start_time_str, end_time_str):
+    """
+    欄式格式用：以 tuple 取回 (epoch 秒數, watt, total_watt_hours, pf)，不為每列建立 dict。
+    epoch 秒數直接由 timestamp 欄位 (台灣時間) 計算，不經過時區轉換。
+    """
+    query = f"""
+        SELECT TIMESTAMPDIFF(SECOND, '1970-01-01 00:00:00', timestamp), watt, total_watt_hours, pf
+        FROM {storage.table_ref(table_name)} WHERE timestamp BETWEEN %s AND %s ORDER BY timestamp
+    """
+    async with conn.cursor() as cursor:
+        await cursor.execute(query, (start_time_str, end_time_str))
+        return await cursor.fetchall()
+
+async def insert_readings(cursor, rows_by_table):
+    """
+    將依資料表分組的多筆資料寫入資料庫，每張資料表一次 executemany (改寫為多列 INSERT)。
+    需在 transaction() 內呼叫，由呼叫端決定同一交易中還要一併寫入哪些資料。
+    rows 為 (voltage, current, frequency, pf, watt, total_watt_hours, timestamp) 的序列。
+    依 STORAGE_LAYOUT 寫入機器資料表、readings 或兩者。
+    """
+    if storage.writes_unified():
+        await storage.insert_unified(cursor, rows_by_table)
+    if not storage.writes_per_table():
+        return
+    for table_name, rows in rows_by_table.items():
+        query = f"""
+            INSERT INTO `{table_name}`
+            (voltage, current, frequency, pf, watt, total_watt_hours, timestamp)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """
+        await cursor.executemany(query, rows)
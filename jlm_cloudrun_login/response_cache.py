@@ -0,0 +1,91 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    查詢結果的快取 (每個 worker 各自一份，存放已序列化的 JSON 回應)。
+
+    key 由呼叫端以 (路由, 資料表, 正規化後的起訖時間, 解析度等參數) 組成。
+    結束時間早於現在的區間 (historical) 結果不會再改變，快取 historical_ttl_seconds 秒；
+    包含現在的區間 (live) 只快取 live_ttl_seconds 秒。
+    本服務寫入資料時以 invalidate 移除受影響的項目；ESP32 專用服務補傳的舊資料本服務看不到，
+    historical 的 TTL 即為此情況下的最長延遲。
+
+    以 LRU 淘汰，總大小不超過 max_bytes；單一回應超過 max_bytes 的八分之一時不快取，
+    避免一張大圖表把其他項目全部擠掉。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, live_ttl_seconds=30, historical_ttl_seconds=86400):
+        self.max_bytes = max_bytes
+        self.live_ttl_seconds = live_ttl_seconds
+        self.historical_ttl_seconds = historical_ttl_seconds
+        self._entries = OrderedDict()
+        self._keys_by_table = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """取得未過期的項目 (dict，含 body、etag、expires_at)，沒有時回傳 None。"""
+        entry = self._entries.get(key)
+        if entry is None or entry["expires_at"] <= time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, table_name, end_time, body, historical):
+        """
+        存入序列化後的回應並回傳項目。end_time 為區間結束時間 (不含時區的台灣時間)，供 invalidate 判斷。
+        """
+        ttl = self.historical_ttl_seconds if historical else self.live_ttl_seconds
+        entry = {
+            "body": body,
+            "etag": '"' + hashlib.sha1(body).hexdigest() + '"',
+            "expires_at": time.monotonic() + ttl,
+            "table_name": table_name,
+            "end_time": end_time,
+        }
+        if len(body) > self.max_bytes // 8:
+            return entry
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._keys_by_table.setdefault(table_name, set()).add(key)
+        self._bytes += len(body)
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        return entry
+
+    def max_age(self, entry):
+        """項目剩餘的有效秒數，作為 Cache-Control 的 max-age。"""
+        return max(0, int(entry["expires_at"] - time.monotonic()))
+
+    def invalidate(self, table_name, since):
+        """寫入 since (含) 之後的資料後呼叫，移除該資料表結束時間不早於 since 的項目。"""
+        for key in list(self._keys_by_table.get(table_name, ())):
+            if self._entries[key]["end_time"] >= since:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry["body"])
+        keys = self._keys_by_table[entry["table_name"]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_table[entry["table_name"]]
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
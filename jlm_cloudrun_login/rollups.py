@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pytz
+
+import devices
+import repository
+import storage
+
+# 預先彙總的 分/時/日 統計資料表 (rollup)
+# 每張電表資料表的讀數依時間區間 (bucket) 彙總成一列：watt 的最小/最大/總和、pf 總和、
+# 筆數，以及區間內第一筆與最後一筆 'total_watt_hours'。平均值 = 總和 / 筆數，
+# 因此新資料到達時可以直接累加 (ON DUPLICATE KEY UPDATE)，不需重新計算整個區間。
+#
+# 啟用方式：先執行 `python rollups.py create-schema` 與 `python rollups.py backfill`
+# 補齊歷史資料，再設定環境變數 ROLLUPS_ENABLED=true。
+ROLLUPS_ENABLED = os.environ.get("ROLLUPS_ENABLED", "false").lower() == "true"
+
+# 由細到粗排列
+RESOLUTIONS = ("minute", "hour", "day")
+RESOLUTION_SECONDS = {"minute": 60, "hour": 3600, "day": 86400}
+
+# 自動選擇解析度時，圖表至少要有的資料點數
+MIN_CHART_POINTS = 200
+
+ROLLUP_COLUMNS = """
+    (table_name, bucket_start, sample_count, min_watt, max_watt, sum_watt, sum_pf,
+     first_ts, first_total_watt_hours, last_ts, last_total_watt_hours)
+"""
+
+def rollup_table(resolution):
+    return f"rollup_{resolution}"
+
+def bucket_start(ts, resolution):
+    """取得時間所屬區間的起點。"""
+    if resolution == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if resolution == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def aligned_resolution(ts):
+    """回傳時間恰好落在其區間起點的最粗解析度，都不是時回傳 None。"""
+    for resolution in reversed(RESOLUTIONS):
+        if bucket_start(ts, resolution) == ts:
+            return resolution
+    return None
+
+def choose_resolution(start_time, end_time, min_points=MIN_CHART_POINTS):
+    """
+    選出仍能提供至少 min_points 個資料點的最粗解析度。
+    時間範圍太短、連分鐘彙總都不夠點數時回傳 'raw'，直接查原始資料。
+    """
+    span_seconds = (end_time - start_time).total_seconds()
+    for resolution in reversed(RESOLUTIONS):
+        if span_seconds / RESOLUTION_SECONDS[resolution] >= min_points:
+            return resolution
+    return "raw"
+
+def aggregate_readings(rows_by_table):
+    """
+    將即將寫入的原始資料依 (資料表, 解析度, 區間) 彙總。
+    rows 為 (voltage, current, frequency, pf, watt, total_watt_hours, timestamp) 的序列，
+    回傳 {解析度: [對應 ROLLUP_COLUMNS 的 tuple, ...]}。
+    """
+    buckets = {resolution: {} for resolution in RESOLUTIONS}
+    for table_name, rows in rows_by_table.items():
+        for voltage, current, frequency, pf, watt, total_watt_hours, timestamp in rows:
+            for resolution in RESOLUTIONS:
+                key = (table_name, bucket_start(timestamp, resolution))
+                bucket = buckets[resolution].get(key)
+                if bucket is None:
+                    buckets[resolution][key] = [1, watt, watt, watt, pf, timestamp, total_watt_hours, timestamp, total_watt_hours]
+                    continue
+                bucket[0] += 1
+                bucket[1] = min(bucket[1], watt)
+                bucket[2] = max(bucket[2], watt)
+                bucket[3] += watt
+                bucket[4] += pf
+                if timestamp < bucket[5]:
+                    bucket[5], bucket[6] = timestamp, total_watt_hours
+                if timestamp >= bucket[7]:
+                    bucket[7], bucket[8] = timestamp, total_watt_hours
+    return {
+        resolution: [(table_name, start, *values) for (table_name, start), values in items.items()]
+        for resolution, items in buckets.items()
+    }
+
+def upsert_query(resolution):
+    # MySQL 依序套用 UPDATE 子句，first/last 的值必須在對應時間欄位更新前先比較
+    return f"""
+        INSERT INTO `{rollup_table(resolution)}` {ROLLUP_COLUMNS}
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            first_total_watt_hours = IF(VALUES(first_ts) < first_ts, VALUES(first_total_watt_hours), first_total_watt_hours),
+            first_ts = LEAST(first_ts, VALUES(first_ts)),
+            last_total_watt_hours = IF(VALUES(last_ts) >= last_ts, VALUES(last_total_watt_hours), last_total_watt_hours),
+            last_ts = GREATEST(last_ts, VALUES(last_ts)),
+            min_watt = LEAST(min_watt, VALUES(min_watt)),
+            max_watt = GREATEST(max_watt, VALUES(max_watt)),
+            sum_watt = sum_watt + VALUES(sum_watt),
+            sum_pf = sum_pf + VALUES(sum_pf),
+            sample_count = sample_count + VALUES(sample_count)
+    """
+
+async def upsert_rollups(cursor, rows_by_table):
+    """在寫入原始資料的同一個交易中，累加更新各解析度的彙總資料。"""
+    for resolution, rows in aggregate_readings(rows_by_table).items():
+        if rows:
+            await cursor.executemany(upsert_query(resolution), rows)
+
+# --- 查詢 ---
+def chart_query(table_name, resolution, start_time, end_time):
+    """
+    圖表用的彙總資料查詢，回傳 (query, args)。欄位與原始資料相同 (timestamp、watt、total_watt_hours、pf)，
+    watt 與 pf 為區間平均，total_watt_hours 為區間最後一筆；另附 first_total_watt_hours 供計算基準值。
+    """
+    query = f"""
+        SELECT bucket_start AS timestamp,
+               sum_watt / sample_count AS watt,
+               last_total_watt_hours AS total_watt_hours,
+               sum_pf / sample_count AS pf,
+               first_total_watt_hours
+        FROM `{rollup_table(resolution)}`
+        WHERE table_name = %s AND bucket_start BETWEEN %s AND %s
+        ORDER BY bucket_start
+    """
+    start_str = bucket_start(start_time, resolution).strftime('%Y-%m-%d %H:%M:%S')
+    end_str = end_time.strftime('%Y-%m-%d %H:%M:%S')
+    return query, (table_name, start_str, end_str)
+
+async def fetch_chart_rows(conn, table_name, resolution, start_time, end_time):
+    """取得圖表用的彙總資料，欄位說明見 chart_query。"""
+    query, args = chart_query(table_name, resolution, start_time, end_time)
+    return await repository.fetch_all(conn, query, args)
+
+def first_total_watt_hours_query(table_name, resolution, start_time_str):
+    """從指定區間起點開始的第一筆 'total_watt_hours'，回傳 (query, args)。"""
+    query = f"""
+        SELECT first_total_watt_hours AS total_watt_hours FROM `{rollup_table(resolution)}`
+        WHERE table_name = %s AND bucket_start >= %s ORDER BY bucket_start ASC LIMIT 1
+    """
+    return query, (table_name, start_time_str)
+
+def last_total_watt_hours_query(table_name, resolution, end_time_str):
+    """
+    指定區間起點 (含) 之前的最後一筆 'total_watt_hours'，回傳 (query, args)。
+    通常為前一個有資料區間的最後一筆；若恰好有一筆資料落在起點上，則為該筆 (與 boundaries.py 及原始資料表相同)。
+    """
+    table = rollup_table(resolution)
+    query = f"""
+        SELECT total_watt_hours FROM (
+            (SELECT last_ts AS ts, last_total_watt_hours AS total_watt_hours FROM `{table}`
+             WHERE table_name = %s AND bucket_start < %s ORDER BY bucket_start DESC LIMIT 1)
+            UNION ALL
+            (SELECT first_ts, first_total_watt_hours FROM `{table}`
+             WHERE table_name = %s AND bucket_start = %s AND first_ts = %s)
+        ) AS candidates
+        ORDER BY ts DESC LIMIT 1
+    """
+    return query, (table_name, end_time_str, table_name, end_time_str, end_time_str)
+
+async def first_total_watt_hours_at_or_after(conn, table_name, resolution, start_time_str):
+    """取得從指定區間起點開始的第一筆 'total_watt_hours'，沒有資料時回傳 None。"""
+    row = await repository.fetch_one(conn, *first_total_watt_hours_query(table_name, resolution, start_time_str))
+    return row['total_watt_hours'] if row else None
+
+async def last_total_watt_hours_at_or_before(conn, table_name, resolution, end_time_str):
+    """取得指定區間起點 (含) 之前的最後一筆 'total_watt_hours'，沒有資料時回傳 None。"""
+    row = await repository.fetch_one(conn, *last_total_watt_hours_query(table_name, resolution, end_time_str))
+    return row['total_watt_hours'] if row else None
+
+# --- 建立資料表與回補歷史資料 ---
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS `{name}` (
+        table_name VARCHAR(64) NOT NULL,
+        bucket_start DATETIME NOT NULL,
+        sample_count INT NOT NULL,
+        min_watt DOUBLE,
+        max_watt DOUBLE,
+        sum_watt DOUBLE,
+        sum_pf DOUBLE,
+        first_ts DATETIME NOT NULL,
+        first_total_watt_hours DOUBLE,
+        last_ts DATETIME NOT NULL,
+        last_total_watt_hours DOUBLE,
+        PRIMARY KEY (table_name, bucket_start)
+    )
+"""
+
+# 回補時直接以重新計算的結果覆蓋
+BACKFILL_UPDATE = """
+    ON DUPLICATE KEY UPDATE
+        sample_count = VALUES(sample_count),
+        min_watt = VALUES(min_watt),
+        max_watt = VALUES(max_watt),
+        sum_watt = VALUES(sum_watt),
+        sum_pf = VALUES(sum_pf),
+        first_ts = VALUES(first_ts),
+        first_total_watt_hours = VALUES(first_total_watt_hours),
+        last_ts = VALUES(last_ts),
+        last_total_watt_hours = VALUES(last_total_watt_hours)
+"""
+
+BUCKET_FORMATS = {"minute": "%%Y-%%m-%%d %%H:%%i:00", "hour": "%%Y-%%m-%%d %%H:00:00", "day": "%%Y-%%m-%%d 00:00:00"}
+
+def backfill_queries(table_name):
+    """回補一段時間的 SQL：分鐘彙總由原始資料計算，小時由分鐘、日由小時彙總而來。"""
+    # GROUP_CONCAT 依時間排序後取第一個元素，即為區間內第一筆 (或最後一筆) 的值
+    minute = f"""
+        INSERT INTO `rollup_minute` {ROLLUP_COLUMNS}
+        SELECT %s, DATE_FORMAT(timestamp, '{BUCKET_FORMATS['minute']}') AS bucket,
+               COUNT(*), MIN(watt), MAX(watt), SUM(watt), SUM(pf),
+               MIN(timestamp), SUBSTRING_INDEX(GROUP_CONCAT(total_watt_hours ORDER BY timestamp ASC), ',', 1) + 0,
+               MAX(timestamp), SUBSTRING_INDEX(GROUP_CONCAT(total_watt_hours ORDER BY timestamp DESC), ',', 1) + 0
+        FROM {storage.table_ref(table_name)}
+        WHERE timestamp >= %s AND timestamp < %s
+        GROUP BY bucket
+        {BACKFILL_UPDATE}
+    """
+    queries = [minute]
+    for resolution, source in (("hour", "minute"), ("day", "hour")):
+        queries.append(f"""
+            INSERT INTO `{rollup_table(resolution)}` {ROLLUP_COLUMNS}
+            SELECT %s, DATE_FORMAT(bucket_start, '{BUCKET_FORMATS[resolution]}') AS bucket,
+                   SUM(sample_count), MIN(min_watt), MAX(max_watt), SUM(sum_watt), SUM(sum_pf),
+                   MIN(first_ts), SUBSTRING_INDEX(GROUP_CONCAT(first_total_watt_hours ORDER BY first_ts ASC), ',', 1) + 0,
+                   MAX(last_ts), SUBSTRING_INDEX(GROUP_CONCAT(last_total_watt_hours ORDER BY last_ts DESC), ',', 1) + 0
+            FROM `{rollup_table(source)}`
+            WHERE table_name = %s AND bucket_start >= %s AND bucket_start < %s
+            GROUP BY bucket
+            {BACKFILL_UPDATE}
+        """)
+    return queries
+
+async def create_schema(conn):
+    async with conn.cursor() as cursor:
+        for resolution in RESOLUTIONS:
+            await cursor.execute(CREATE_TABLE.format(name=rollup_table(resolution)))
+
+async def backfill_table(conn, table_name, since=None, until=None):
+    """以一天為單位回補指定資料表的彙總資料，每天一個交易。"""
+    if since is None:
+        row = await repository.fetch_one(conn, f"SELECT MIN(timestamp) AS first_ts FROM {storage.table_ref(table_name)}")
+        if not row or row['first_ts'] is None:
+            print(f"資料表 '{table_name}' 沒有資料，略過。")
+            return
+        since = row['first_ts']
+    day = bucket_start(since, "day")
+    until = until or datetime.now(pytz.timezone('Asia/Taipei')).replace(tzinfo=None)
+    minute_query, hour_query, day_query = backfill_queries(table_name)
+    while day < until:
+        next_day = day + timedelta(days=1)
+        start_str = day.strftime('%Y-%m-%d %H:%M:%S')
+        end_str = next_day.strftime('%Y-%m-%d %H:%M:%S')
+        async with repository.transaction(conn) as cursor:
+            await cursor.execute(minute_query, (table_name, start_str, end_str))
+            await cursor.execute(hour_query, (table_name, table_name, start_str, end_str))
+            await cursor.execute(day_query, (table_name, table_name, start_str, end_str))
+        print(f"已回補 '{table_name}' {day:%Y-%m-%d}")
+        day = next_day
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="建立彙總資料表並回補歷史資料")
+    parser.add_argument("command", choices=["create-schema", "backfill"])
+    parser.add_argument("--tables", nargs="*", default=None, help="要回補的資料表 (預設為全部)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="回補起始日期 (預設為資料表第一筆資料)")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="回補結束日期 (預設為現在)")
+    args = parser.parse_args(argv)
+
+    await repository.init_pool()
+    try:
+        async with repository.connection() as conn:
+            if args.command == "create-schema":
+                await create_schema(conn)
+                print("彙總資料表已建立。")
+                return
+            for table_name in args.tables or devices.registry.names():
+                if table_name not in devices.registry:
+                    raise SystemExit(f"Invalid table name: {table_name}")
+                await backfill_table(conn, table_name, args.since, args.until)
+    finally:
+        await repository.close_pool()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,14 +1,36 @@
 #!/bin/bash
 # 建議的 start.sh 內容
 
+# 容器開始執行的時間，供 startup.py 計算各啟動階段的秒數 (GET /api/startup)
+export STARTUP_BEGIN=$(date +%s.%N)
+
 # 1. 在背景啟動 Cloud SQL Auth Proxy
 /usr/local/bin/cloud-sql-proxy --unix-socket=/cloudsql/${DB_CONNECTION_NAME} &
 
-# 給 Proxy 一點時間啟動並建立連線
-sleep 5
+# 等待 Proxy 建立 unix socket (取代固定的 sleep 5)，每 0.1 秒檢查一次，最多 PROXY_WAIT_SECONDS 秒 (預設 10)
+# 逾時仍繼續啟動：連線池在服務開始接受請求後才於背景建立，失敗時之後的請求會自動重試
+# 設定 DB_HOST (以 TCP 連線本機的 MySQL) 時不等待
+SOCKET_PATH=/cloudsql/${DB_CONNECTION_NAME}
+if [ -z "$DB_HOST" ]; then
+    deadline=$(( $(date +%s) + ${PROXY_WAIT_SECONDS:-10} ))
+    # 依 Proxy 版本，socket 為 SOCKET_PATH 本身或其中的檔案
+    until [ -S "$SOCKET_PATH" ] || [ -n "$(find "$SOCKET_PATH" -maxdepth 1 -type s 2>/dev/null)" ]; do
+        if [ "$(date +%s)" -ge "$deadline" ]; then
+            echo "Cloud SQL Proxy 的 socket 在 ${PROXY_WAIT_SECONDS:-10} 秒內未就緒，繼續啟動" >&2
+            break
+        fi
+        sleep 0.1
+    done
+fi
+export STARTUP_PROXY_READY=$(date +%s.%N)
 
 # 2. 啟動 Gunicorn 伺服器來管理 Uvicorn workers
-#    -w 4: 指定 4 個 worker process 來處理請求 (可根據您的機器規格調整)
+#    -w: worker process 數 (WEB_CONCURRENCY，預設 4，可根據您的機器規格調整)
 #    -k uvicorn.workers.UvicornWorker: 告訴 Gunicorn 使用 Uvicorn 的 worker
 #    -b 0.0.0.0:8080: 綁定到容器的 8080 端口
-gunicorn -w 4 -k uvicorn.workers.UvicornWorker -b 0.0.0.0:8080 main:app
\ No newline at end of file
+#    --preload: 主程序載入程式一次後再 fork 出各 worker，不必每個 worker 各自載入 (GUNICORN_PRELOAD=false 關閉)
+PRELOAD=--preload
+if [ "${GUNICORN_PRELOAD:-true}" = "false" ]; then
+    PRELOAD=
+fi
+gunicorn -w ${WEB_CONCURRENCY:-4} -k uvicorn.workers.UvicornWorker -b 0.0.0.0:8080 $PRELOAD main:app
@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import os
+from datetime import date, datetime, timedelta
+
+import pytz
+from fastapi import HTTPException
+
+import devices
+import repository
+
+# 電表資料的儲存方式 (STORAGE_LAYOUT)
+#   per_table (預設)：每台機器一張資料表 (`冰水機`、`空壓機`、...)，即原本的結構
+#   dual：讀取仍使用各機器的資料表，寫入時同時寫入兩種結構，供遷移期間使用
+#   unified：所有機器共用 readings 資料表，以 devices 資料表對應機器名稱與 device_id
+#
+# readings 以 (device_id, ts) 為主鍵並依月份分區 (RANGE partition)，跨機器的彙總只需一次索引查詢，
+# 過期資料可以 DROP PARTITION 直接刪除整個月份。
+# 查詢一律透過 table_ref() 取得 FROM 子句：unified 時為只含單一機器、欄位名稱與原本相同的子查詢，
+# MySQL 會將其合併到外層查詢並使用主鍵索引，因此既有的 SQL 不必改寫。
+#
+# 遷移步驟 (兩個服務都要設定相同的 STORAGE_LAYOUT)：
+#   1. python storage.py create-schema        建立 devices (見 devices.py) 與 readings
+#   2. 設定 STORAGE_LAYOUT=dual 並重新部署，之後的新資料同時寫入 readings
+#   3. python storage.py backfill              複製各機器資料表的歷史資料 (可重複執行)
+#   4. python storage.py verify                比對兩種結構的筆數
+#   5. 設定 STORAGE_LAYOUT=unified 並重新部署
+#   之後每月執行 python storage.py add-partitions 預先建立分區，
+#   python storage.py drop-partitions --before 2024-01-01 刪除過期資料。
+STORAGE_LAYOUT = os.environ.get("STORAGE_LAYOUT", "per_table").lower()
+
+def reads_unified():
+    return STORAGE_LAYOUT == "unified"
+
+def writes_unified():
+    return STORAGE_LAYOUT in ("dual", "unified")
+
+def writes_per_table():
+    return STORAGE_LAYOUT in ("per_table", "dual")
+
+def device_id(table_name):
+    """機器的 device_id，由機器登錄表 (devices.registry) 取得。"""
+    device = devices.registry.get(table_name)
+    if device is None or device["device_id"] is None:
+        raise HTTPException(status_code=500, detail=f"裝置 '{table_name}' 尚未登錄到 devices 資料表。")
+    return device["device_id"]
+
+def unified_ref(table_name):
+    """readings 中單一機器的資料，欄位名稱與各機器的資料表相同。device_id 為整數，可直接放進 SQL。"""
+    return (
+        "(SELECT ts AS timestamp, voltage, current, frequency, pf, watt, total_watt_hours "
+        f"FROM readings WHERE device_id = {int(device_id(table_name))}) AS `{table_name}`"
+    )
+
+def table_ref(table_name):
+    """
+    查詢電表資料時的 FROM 子句。table_name 必須是機器登錄表中的機器。
+    """
+    if reads_unified():
+        return unified_ref(table_name)
+    return f"`{table_name}`"
+
+# --- 寫入 ---
+UNIFIED_INSERT_QUERY = """
+    INSERT INTO readings (device_id, ts, voltage, current, frequency, pf, watt, total_watt_hours)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        voltage = VALUES(voltage), current = VALUES(current), frequency = VALUES(frequency),
+        pf = VALUES(pf), watt = VALUES(watt), total_watt_hours = VALUES(total_watt_hours)
+"""
+
+async def insert_unified(cursor, rows_by_table):
+    """
+    將 (voltage, current, frequency, pf, watt, total_watt_hours, timestamp) 寫入 readings。
+    同一台機器同一秒的資料以主鍵合併，保留最後寫入的一筆。
+    """
+    rows = [
+        (device_id(table_name), timestamp, voltage, current, frequency, pf, watt, total_watt_hours)
+        for table_name, table_rows in rows_by_table.items()
+        for voltage, current, frequency, pf, watt, total_watt_hours, timestamp in table_rows
+    ]
+    if rows:
+        await cursor.executemany(UNIFIED_INSERT_QUERY, rows)
+
+# --- 跨機器查詢 ---
+def latest_readings_query(day_start_str):
+    """
+    所有啟用中機器的最新一筆讀數與當日第一筆 'total_watt_hours'，一次查詢完成，每台機器各以主鍵查兩次。
+    與 per_table 相同只包含啟用中的機器 (devices.registry.names())，停用的機器不計入每日總用電量。
+    """
+    query = """
+        SELECT d.name AS table_name, latest.ts AS timestamp, latest.total_watt_hours, latest.watt, latest.pf,
+               day_start.total_watt_hours AS day_start_watt_hours
+        FROM devices d
+        LEFT JOIN readings latest ON latest.device_id = d.device_id
+            AND latest.ts = (SELECT MAX(ts) FROM readings WHERE device_id = d.device_id)
+        LEFT JOIN readings day_start ON day_start.device_id = d.device_id
+            AND day_start.ts = (SELECT MIN(ts) FROM readings WHERE device_id = d.device_id AND ts >= %s)
+        WHERE d.active = 1
+    """
+    return query, (day_start_str,)
+
+# --- 建立資料表與分區 ---
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+def next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+def partition_name(month):
+    return f"p{month:%Y%m}"
+
+def partition_clause(month):
+    return f"PARTITION {partition_name(month)} VALUES LESS THAN (TO_DAYS('{next_month(month):%Y-%m-%d}'))"
+
+def create_readings_query(first_month, last_month):
+    """readings 資料表，first_month 至 last_month 每月一個分區，另有 pmax 接住更晚的資料。"""
+    partitions = []
+    month = first_month
+    while month <= last_month:
+        partitions.append(partition_clause(month))
+        month = next_month(month)
+    partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    partition_list = ",\n            ".join(partitions)
+    return f"""
+        CREATE TABLE IF NOT EXISTS readings (
+            device_id SMALLINT UNSIGNED NOT NULL,
+            ts DATETIME NOT NULL,
+            voltage DOUBLE,
+            current DOUBLE,
+            frequency DOUBLE,
+            pf DOUBLE,
+            watt DOUBLE,
+            total_watt_hours DOUBLE,
+            PRIMARY KEY (device_id, ts),
+            INDEX idx_ts (ts)
+        )
+        PARTITION BY RANGE (TO_DAYS(ts)) (
+            {partition_list}
+        )
+    """
+
+async def partition_months(conn):
+    """readings 現有的月份分區 (不含 pmax)，依時間排序。"""
+    rows = await repository.fetch_all(
+        conn,
+        """
+        SELECT partition_name AS name FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = 'readings' AND partition_name LIKE 'p2%'
+        """,
+    )
+    return sorted(datetime.strptime(row['name'][1:], "%Y%m").date() for row in rows)
+
+async def add_partitions(conn, months_ahead=3):
+    """將 pmax 拆出到 months_ahead 個月後為止的月份分區。pmax 應為空 (資料晚於最後一個分區時仍可拆分，只是較慢)。"""
+    months = await partition_months(conn)
+    today = month_start(datetime.now(pytz.timezone('Asia/Taipei')).date())
+    month = next_month(months[-1]) if months else today
+    target = today
+    for _ in range(months_ahead):
+        target = next_month(target)
+    new_partitions = []
+    while month <= target:
+        new_partitions.append(partition_clause(month))
+        month = next_month(month)
+    if not new_partitions:
+        print("分區已足夠，不需新增。")
+        return []
+    clauses = ", ".join(new_partitions + ["PARTITION pmax VALUES LESS THAN MAXVALUE"])
+    async with conn.cursor() as cursor:
+        await cursor.execute(f"ALTER TABLE readings REORGANIZE PARTITION pmax INTO ({clauses})")
+    print(f"已新增 {len(new_partitions)} 個分區。")
+    return new_partitions
+
+async def drop_partitions(conn, before):
+    """刪除早於 before 所在月份的分區 (整個月份的資料)，不需逐列刪除。"""
+    names = [partition_name(month) for month in await partition_months(conn) if next_month(month) <= month_start(before)]
+    if names:
+        async with conn.cursor() as cursor:
+            await cursor.execute(f"ALTER TABLE readings DROP PARTITION {', '.join(names)}")
+    print(f"已刪除分區: {', '.join(names) or '無'}")
+    return names
+
+async def create_schema(conn, table_names):
+    """建立 devices 與 readings，readings 的分區由最早的資料月份起算至三個月後。"""
+    await devices.create_schema(conn)
+    await devices.register(conn, table_names)
+
+    today = month_start(datetime.now(pytz.timezone('Asia/Taipei')).date())
+    first_month = today
+    for table_name in table_names:
+        row = await repository.fetch_one(conn, f"SELECT MIN(timestamp) AS first_ts FROM `{table_name}`")
+        if row and row['first_ts'] is not None:
+            first_month = min(first_month, month_start(row['first_ts'].date()))
+    last_month = today
+    for _ in range(3):
+        last_month = next_month(last_month)
+    async with conn.cursor() as cursor:
+        await cursor.execute(create_readings_query(first_month, last_month))
+
+# --- 由各機器的資料表回補 ---
+def backfill_query(table_name):
+    return f"""
+        INSERT IGNORE INTO readings (device_id, ts, voltage, current, frequency, pf, watt, total_watt_hours)
+        SELECT %s, timestamp, voltage, current, frequency, pf, watt, total_watt_hours
+        FROM `{table_name}`
+        WHERE timestamp >= %s AND timestamp < %s
+    """
+
+async def backfill_table(conn, table_name, since=None, until=None):
+    """以一天為單位將機器資料表的資料複製到 readings，每天一個交易；已存在的 (device_id, ts) 不變。"""
+    if since is None:
+        row = await repository.fetch_one(conn, f"SELECT MIN(timestamp) AS first_ts FROM `{table_name}`")
+        if not row or row['first_ts'] is None:
+            print(f"資料表 '{table_name}' 沒有資料，略過。")
+            return
+        since = row['first_ts']
+    day = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    until = until or datetime.now(pytz.timezone('Asia/Taipei')).replace(tzinfo=None) + timedelta(days=1)
+    query = backfill_query(table_name)
+    while day < until:
+        next_day = day + timedelta(days=1)
+        async with repository.transaction(conn) as cursor:
+            await cursor.execute(query, (device_id(table_name), day.strftime('%Y-%m-%d %H:%M:%S'), next_day.strftime('%Y-%m-%d %H:%M:%S')))
+        print(f"已回補 '{table_name}' {day:%Y-%m-%d}")
+        day = next_day
+
+async def verify(conn, table_names):
+    """比對各機器資料表與 readings 的筆數，回傳不一致的項目 (同一秒的重複資料在 readings 中會合併為一筆)。"""
+    problems = []
+    for table_name in table_names:
+        per_table = await repository.fetch_one(conn, f"SELECT COUNT(DISTINCT timestamp) AS n FROM `{table_name}`")
+        unified = await repository.fetch_one(
+            conn, "SELECT COUNT(*) AS n FROM readings WHERE device_id = %s", (device_id(table_name),)
+        )
+        if per_table['n'] != unified['n']:
+            problems.append(f"'{table_name}': 各機器資料表 {per_table['n']} 筆，readings {unified['n']} 筆")
+    return problems
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="電表資料遷移到單一 readings 資料表 (依月份分區)")
+    parser.add_argument("command", choices=["create-schema", "backfill", "verify", "add-partitions", "drop-partitions"])
+    parser.add_argument("--tables", nargs="*", default=None, help="要處理的機器資料表 (預設為全部)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="回補起始日期 (預設為資料表第一筆資料)")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="回補結束日期 (預設為現在)")
+    parser.add_argument("--months-ahead", type=int, default=3, help="add-partitions 預先建立幾個月的分區")
+    parser.add_argument("--before", type=date.fromisoformat, help="drop-partitions 刪除此日期所在月份之前的資料")
+    args = parser.parse_args(argv)
+
+    await repository.init_pool()
+    try:
+        # 機器登錄表在建立連線池時載入
+        table_names = args.tables or devices.registry.names()
+        for table_name in table_names:
+            if table_name not in devices.registry:
+                raise SystemExit(f"Invalid table name: {table_name}")
+        async with repository.connection() as conn:
+            if args.command == "create-schema":
+                await create_schema(conn, table_names)
+                print("devices 與 readings 資料表已建立。")
+            elif args.command == "add-partitions":
+                await add_partitions(conn, args.months_ahead)
+            elif args.command == "drop-partitions":
+                if args.before is None:
+                    raise SystemExit("drop-partitions 需要指定 --before")
+                await drop_partitions(conn, args.before)
+            else:
+                if args.command == "backfill":
+                    for table_name in table_names:
+                        await backfill_table(conn, table_name, args.since, args.until)
+                else:
+                    problems = await verify(conn, table_names)
+                    for problem in problems:
+                        print(problem)
+                    if problems:
+                        raise SystemExit(1)
+                    print("筆數一致。")
+    finally:
+        await repository.close_pool()
+
+if __name__ == "__main__":
+    asyncio.run(main())
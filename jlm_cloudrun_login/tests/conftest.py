@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 服務的模組皆為同一目錄下的平面模組 (以服務目錄為工作目錄執行)，測試時同樣由服務目錄匯入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
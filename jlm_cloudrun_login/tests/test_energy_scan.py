@@ -0,0 +1,95 @@
+"""
+energy.scan_query 的 SQL 以 SQLite 執行 (SQLite 3.28 起支援 window function 與 WINDOW 子句)。
+與 MySQL 語法不同之處在執行前轉換：%s → ?、TIMESTAMPDIFF(SECOND, ...) 以 Python 函式代替，
+以及 UNION ALL 的各段外層的括號 (每次只查一個區間即可去掉)。
+"""
+import re
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import energy
+
+TABLE = "冰水機"
+START = "2025-01-02 08:00:00"
+END = "2025-01-02 09:00:00"
+
+pytestmark = pytest.mark.skipif(
+    sqlite3.sqlite_version_info < (3, 28, 0), reason="SQLite 版本不支援 window function"
+)
+
+
+def timestampdiff_seconds(start, end):
+    if start is None or end is None:
+        return None
+    parse = lambda value: datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    return int((parse(end) - parse(start)).total_seconds())
+
+
+def to_sqlite(query):
+    query = query.strip().replace("%s", "?").replace("TIMESTAMPDIFF(SECOND, ", "TIMESTAMPDIFF_SECOND(")
+    # 單一區間：去掉 "(SELECT ...) ORDER BY range_index" 外層的括號
+    return re.sub(r"^\((.*)\)\s*ORDER BY range_index$", r"\1", query, flags=re.S)
+
+
+def scan(readings, start=START, end=END):
+    """readings 為 [(timestamp, total_watt_hours, watt)]，回傳 energy.scan_result 的結果。"""
+    db = sqlite3.connect(":memory:")
+    db.row_factory = sqlite3.Row
+    db.create_function("TIMESTAMPDIFF_SECOND", 2, timestampdiff_seconds)
+    db.execute(f'CREATE TABLE "{TABLE}" (timestamp TEXT, total_watt_hours REAL, watt REAL)')
+    db.executemany(f'INSERT INTO "{TABLE}" VALUES (?, ?, ?)', readings)
+    query, args = energy.scan_query([(TABLE, start, end)])
+    rows = db.execute(to_sqlite(query), args).fetchall()
+    assert len(rows) == 1 and rows[0]["range_index"] == 0
+    return energy.scan_result(rows[0])
+
+
+def test_reset_gap_and_missing_counter():
+    result = scan([
+        ("2025-01-02 08:00:00", 100.0, 1.0),
+        ("2025-01-02 08:05:00", 101.0, 1.0),
+        # total_watt_hours 缺漏：不中斷前後兩筆有效讀數的差值
+        ("2025-01-02 08:10:00", None, 1.0),
+        ("2025-01-02 08:15:00", 102.5, 1.0),
+        # 電表歸零，以歸零後的讀數計入
+        ("2025-01-02 08:20:00", 0.5, 1.0),
+        # 間隔 30 分鐘，超過 ENERGY_MAX_GAP_SECONDS (預設 900)
+        ("2025-01-02 08:50:00", 1.5, 1.0),
+        # 區間外的資料不計
+        ("2025-01-02 09:05:00", 9.0, 1.0),
+    ])
+    assert result["kilo_watt_hours"] == pytest.approx(1.0 + 1.5 + 0.5 + 1.0)
+    assert result["resets"] == 1
+    assert result["gaps"] == 1
+    assert result["readings"] == 6
+
+
+def test_no_counter_readings():
+    readings = [(f"2025-01-02 08:{minute:02d}:00", None, 2.0) for minute in range(0, 60, 5)]
+    assert scan(readings)["kilo_watt_hours"] is None
+    assert scan([])["kilo_watt_hours"] is None
+
+
+def test_integrate_watt_outside_counter_readings(monkeypatch):
+    monkeypatch.setattr(energy, "ENERGY_INTEGRATE_WATT", True)
+    # 整段都沒有 total_watt_hours：以 watt 積分 (2 kW × 55 分鐘)
+    readings = [(f"2025-01-02 08:{minute:02d}:00", None, 2.0) for minute in range(0, 60, 5)]
+    assert scan(readings)["kilo_watt_hours"] == pytest.approx(2.0 * 55 / 60)
+
+    # 第一筆有效讀數之前的區段以 watt 積分補上，有效讀數之間仍以 total_watt_hours 計算
+    result = scan([
+        ("2025-01-02 08:00:00", None, 1.2),
+        ("2025-01-02 08:05:00", 10.0, 1.2),
+        ("2025-01-02 08:10:00", 11.0, 1.2),
+    ])
+    assert result["kilo_watt_hours"] == pytest.approx(1.0 + 1.2 * 5 / 60)
+
+    # 斷線 (間隔超過 ENERGY_MAX_GAP_SECONDS) 的區段不積分
+    result = scan([
+        ("2025-01-02 08:00:00", None, 1.2),
+        ("2025-01-02 08:30:00", None, 1.2),
+    ])
+    assert result["kilo_watt_hours"] is None
+    assert result["gaps"] == 1
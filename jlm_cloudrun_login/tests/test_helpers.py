@@ -0,0 +1,68 @@
+import math
+from datetime import datetime
+
+import pytest
+
+import ingest_guard
+import packed
+from response_cache import ResponseCache
+
+
+def reading(total_watt_hours, minute):
+    """find_resets 的資料列：(voltage, current, frequency, pf, watt, total_watt_hours, timestamp)。"""
+    return (220.0, 1.0, 60.0, 0.9, 200.0, total_watt_hours, datetime(2025, 1, 2, 8, minute))
+
+
+def test_find_resets():
+    previous = (datetime(2025, 1, 2, 7, 59), 100.0)
+    # 資料未依時間排序；差值在 COUNTER_RESET_TOLERANCE 之內不視為歸零
+    rows = [reading(0.2, 2), reading(100.5, 1), reading(0.2 - ingest_guard.COUNTER_RESET_TOLERANCE / 2, 3)]
+    resets = ingest_guard.find_resets("冰水機", previous, rows)
+    assert resets == [("冰水機", datetime(2025, 1, 2, 8, 2), datetime(2025, 1, 2, 8, 1), 100.5, 0.2, 100.5)]
+    # 資料庫中沒有更早的資料時，第一筆不會被視為歸零
+    assert ingest_guard.find_resets("冰水機", None, [reading(5.0, 0)]) == []
+    # 與資料庫中的最後一筆比較
+    assert ingest_guard.find_resets("冰水機", previous, [reading(1.0, 0)])[0][5] == 100.0
+
+
+def test_packed_round_trip():
+    readings = [
+        (1, 5, 1735776000, 220.5, 1.25, 60.0, 0.9, 250.0, 1234.5),
+        (4, 2 ** 32 - 1, 0, 221.0, 2.0, 60.0, 0.95, 400.0, 99.0),
+    ]
+    body = packed.encode("24:6F:28:AB:CD:EF", readings)
+    assert len(body) == packed.HEADER.size + len(readings) * packed.RECORD.size
+    mac, records = packed.decode(body, 1000)
+    assert mac == "24:6F:28:AB:CD:EF"
+    for record, expected in zip(list(records), readings):
+        assert record[:3] == expected[:3]
+        # 數值以 float32 傳送
+        assert all(math.isclose(a, b, rel_tol=1e-6) for a, b in zip(record[3:], expected[3:]))
+
+
+def test_packed_rejects_malformed_frames():
+    body = packed.encode("24:6F:28:AB:CD:EF", [(1, 5, 0, 220.0, 1.0, 60.0, 0.9, 200.0, 1.0)] * 3)
+    for bad in (body[:-1], b"XXXX" + body[4:], body[:packed.HEADER.size - 1]):
+        with pytest.raises(ValueError):
+            packed.decode(bad, 1000)
+    with pytest.raises(ValueError):
+        packed.decode(body, 2)
+
+
+def test_response_cache_invalidate():
+    cache = ResponseCache()
+    cache.put("old", "冰水機", datetime(2025, 1, 2, 8), b"old", historical=True)
+    cache.put("new", "冰水機", datetime(2025, 1, 2, 12), b"new", historical=True)
+    cache.put("same", "冰水機", datetime(2025, 1, 2, 10), b"same", historical=True)
+    cache.put("other", "空壓機", datetime(2025, 1, 2, 12), b"other", historical=True)
+
+    # 移除該資料表結束時間不早於 since (含) 的項目，其他資料表不受影響
+    cache.invalidate("冰水機", datetime(2025, 1, 2, 10))
+    assert cache.get("old") is not None
+    assert cache.get("new") is None
+    assert cache.get("same") is None
+    assert cache.get("other") is not None
+    assert cache.stats()["bytes"] == len(b"old") + len(b"other")
+
+    # 沒有快取項目的資料表
+    cache.invalidate("不存在", datetime(2025, 1, 2))